@@ -1,552 +1,3439 @@
-import serial
-from serial.tools import list_ports
 import time
-import struct
 import warnings
+import os
+import threading
+import bisect
+import importlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from Py_P_Pump_codec import (FRAME_LENGTH, extract_frame, frame_value, read_request, encode,
+                             ERROR_CODES, SENSOR_TYPES, FLOW_CONVERSION)
 
 
-def find_address(identifier = None):
+class _LazyModule():
+    #Imports the module on first use. Keeps "import Py_P_Pump" fast for 
+    #code that does not open a serial port, use asyncio or stream data.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module == None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+serial = _LazyModule('serial')
+list_ports = _LazyModule('serial.tools.list_ports')
+asyncio = _LazyModule('asyncio')
+np = _LazyModule('numpy')
+
+#Register written by the last write of each recipe command, see run_recipe()
+RECIPE_COMMAND_REGISTERS = {
+    'idle' : 78,
+    'start' : 78,
+    'control' : 77,
+    'target' : 79,
+    }
+
+#Value of register 78 that starts a leak test. It is not in the documentation
+#of the pump, so there is no default: set it after checking your firmware, or
+#give it to P_pump.leak_test().
+LEAK_TEST_REQUEST = None
+
+#Options to confirm that the pump took a new value, see P_pump
+VERIFY_POLICIES = ('readback', 'on_failure', 'ack')
+
+#Default maximum age in seconds of cached registers, see RegisterCache. The
+#sensor type, control type and target only change by our own writes.
+CACHE_MAX_AGE = {
+    77 : 60,
+    79 : 60,
+    88 : 3600,
+    }
+
+def port_errors():
     """
-    Find the address of a serial device. It can either find the address using
-    an identifier given by the user or by manually unplugging and plugging in 
-    the device.
+    Returns the exceptions raised by a serial port that stopped working, like
+    an unplugged USB to serial converter.
+
+    """
+    try:
+        import termios
+        return (serial.SerialException, OSError, termios.error)
+    except ImportError:
+        return (serial.SerialException, OSError)
+
+#Registers read by get_status()
+STATUS_REGISTERS = [64, 65, 66, 67, 68, 69, 77, 79, 81, 82]
+
+class PumpCommunicationError(Exception):
+    """
+    Raised when no valid message could be exchanged with the pump.
+
+    """
+
+class PumpTimeoutError(PumpCommunicationError):
+    """
+    Raised when the pump did not send a complete message before the deadline.
+
+    """
+
+class PumpError(Exception):
+    """
+    Raised when the pump reports an error (mode 3). `code` is the error code
+    of register 82, see ERROR_CODES. The subclasses group the error codes.
+
+    """
+
+    def __init__(self, code, name=None, message=None):
+        self.code = code
+        self.name = name
+        if message == None:
+            message = ERROR_CODES.get(code, 'Unknown error code {}'.format(code))
+        self.message = message
+        super().__init__('{}: {}'.format(name, message) if name else message)
+
+class SupplyPressureError(PumpError):
+    """
+    Error 1: Supply pressure above the maximum.
+
+    """
+
+class TareError(PumpError):
+    """
+    Errors 2 and 3: Tare timed out or supply still connected.
+
+    """
+
+class ControlStartError(PumpError):
+    """
+    Error 4: Control did not start.
+
+    """
+
+class TargetError(PumpError):
+    """
+    Errors 5 and 6: Target too low or too high.
+
+    """
+
+class LeakTestError(PumpError):
+    """
+    Errors 7 and 8: Leak test supply pressure too low or timed out.
+
+    """
+
+class FlowSensorError(PumpError):
+    """
+    Error 9: Flow sensor lost during flow control.
+
+    """
+
+#Exception class per error code of register 82
+ERROR_EXCEPTIONS = {
+    1: SupplyPressureError,
+    2: TareError,
+    3: TareError,
+    4: ControlStartError,
+    5: TargetError,
+    6: TargetError,
+    7: LeakTestError,
+    8: LeakTestError,
+    9: FlowSensorError,
+    }
+
+def pump_error(code, name=None):
+    """
+    Returns the exception for error code `code` of register 82.
+
+    """
+    return ERROR_EXCEPTIONS.get(code, PumpError)(code, name)
+
+#Default histogram buckets: latency in seconds and number of repeats
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+RETRY_BUCKETS = (0, 1, 2, 3, 4, 5)
+
+class Metrics():
+    """
+    Counters and histograms of the communication with the pumps. Give a
+    Metrics object to P_pump or PumpBus with the `metrics` argument, one 
+    object can be shared by multiple pumps; the measurements are labeled with
+    the name of the pump. When no Metrics object is given nothing is 
+    measured.
+    Measurements:
+        pump_frames_sent_total, pump_frames_received_total: Messages.
+        pump_bytes_sent_total, pump_bytes_received_total: Bytes.
+        pump_checksum_errors_total: Discarded messages with a wrong checksum.
+        pump_timeouts_total: Responses that did not arrive in time.
+        pump_round_trip_seconds: Time of a read exchange, labeled with the 
+            read registers.
+        pump_set_retries: Number of repeats needed by a set function.
+        pump_set_failures_total: Set functions that failed after all repeats.
+        pump_set_seconds: Duration of the set functions, including repeats.
+        pump_mode_transition_seconds: Duration of a mode change (register 78),
+            labeled with the requested mode.
+    The values can be read with snapshot(), written in the Prometheus text
+    format with write_prometheus(), or passed on to a `callback` function.
+
+    """
+
+    def __init__(self, callback=None):
+        """
+        Input:
+        `callback`(function): Optional, called for every measurement with the
+            arguments: kind ('counter' or 'histogram'), name, value and labels
+            (tuple of (key, value) pairs).
+
+        """
+        self.callback = callback
+        self.counters = {}
+        self.histograms = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._export_stop = None
+
+    def count(self, name, value=1, labels=()):
+        """
+        Increase a counter. `labels` is a tuple of (key, value) pairs.
+
+        """
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.callback != None:
+            self.callback('counter', name, value, labels)
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Add a value to a histogram. The buckets of a histogram are set by the
+        first observation.
+
+        """
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                buckets = self._buckets.setdefault(name, tuple(buckets))
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0.0]
+            else:
+                buckets = self._buckets[name]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+        if self.callback != None:
+            self.callback('histogram', name, value, labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        Returns a copy of all measurements as a dictionary:
+        {'counters': {(name, labels): value}, 
+         'histograms': {(name, labels): {'buckets': {upper bound: count},
+                                         'count': n, 'sum': total}}}
+
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for (name, labels), (counts, n, total) in self.histograms.items():
+                bounds = list(self._buckets[name]) + [float('inf')]
+                histograms[(name, labels)] = {'buckets': dict(zip(bounds, counts)),
+                                              'count': n, 'sum': total}
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """
+        Returns all measurements in the Prometheus text format.
+
+        """
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), histogram in sorted(snapshot['histograms'].items()):
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', le)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write all measurements in the Prometheus text format to a file, for
+        instance for the node_exporter textfile collector. The file is 
+        replaced in one step, so readers never see a partial file.
+
+        """
+        temp = '{}.tmp'.format(path)
+        with open(temp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp, path)
+
+    def export_prometheus(self, path, interval=10):
+        """
+        Write the measurements to `path` every `interval` seconds in a
+        background thread, until stop_export() is called.
+
+        """
+        self.stop_export()
+        stop = self._export_stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.write_prometheus(path)
+            self.write_prometheus(path)
+        threading.Thread(target=run, name='Metrics_export', daemon=True).start()
+
+    def stop_export(self):
+        if self._export_stop != None:
+            self._export_stop.set()
+            self._export_stop = None
+
+def parse_hold(hold):
+    """
+    Convert a hold time in the format 'dd:hh:mm:ss' to seconds.
+
+    """
+    time_filt = [86400,3600,60,1]
+    return sum([a*b for a,b in zip(time_filt, map(int,hold.split(':')))])
+
+class FrameTransport():
+    """
+    Framed serial transport for the P-pump protocol. Writes messages to the
+    serial port and reads back exactly one 12 byte message at a time. The
+    reader synchronizes on the 0x02 start byte, verifies the checksum and
+    returns as soon as a full message has arrived, instead of waiting a fixed
+    time. Bytes that do not form a valid message are discarded.
+
+    """
+
+    def __init__(self, ser, timeout=2):
+        """
+        Input:
+        `ser`(obj): Open pyserial Serial object, or any object with the same
+            read(), write(), reset_input_buffer() and timeout attributes.
+        `timeout`(float): Default deadline in seconds to receive a message.
+
+        """
+        self.ser = ser
+        self.timeout = timeout
+        self.checksum_errors = 0
+        self.metrics = None
+        self.labels = ()
+        self._buffer = bytearray()
+
+    def flush(self):
+        """
+        Discard all received bytes that have not been read yet.
+
+        """
+        self._buffer.clear()
+        self.ser.reset_input_buffer()
+
+    def write(self, message):
+        """
+        Write a complete message to the pump.
+
+        """
+        self.ser.write(message)
+        if self.metrics != None:
+            self.metrics.count('pump_frames_sent_total', len(message) // FRAME_LENGTH, self.labels)
+            self.metrics.count('pump_bytes_sent_total', len(message), self.labels)
+
+    def read_frame(self, timeout=None):
+        """
+        Read one valid 12 byte message from the pump.
+        Input:
+        `timeout`(float): Deadline in seconds for this message. Defaults to
+            the transport timeout.
+        Returns:
+        `frame`(bytes): The 12 byte message, including start byte and
+            checksum.
+
+        """
+        if timeout == None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        buffer = self._buffer
+        metrics = self.metrics
+        while True:
+            frame, errors = extract_frame(buffer)
+            if errors:
+                self.checksum_errors += errors
+                if metrics != None:
+                    metrics.count('pump_checksum_errors_total', errors, self.labels)
+            if frame != None:
+                if metrics != None:
+                    metrics.count('pump_frames_received_total', 1, self.labels)
+                return frame
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if metrics != None:
+                    metrics.count('pump_timeouts_total', 1, self.labels)
+                raise PumpTimeoutError('No complete message received from pump within {}s'.format(timeout))
+            #Wait only for the time left, a partial message must not restart
+            #the full timeout
+            self.ser.timeout = remaining
+            data = self.ser.read(FRAME_LENGTH - len(buffer))
+            buffer += data
+            if metrics != None and data:
+                metrics.count('pump_bytes_received_total', len(data), self.labels)
+
+    def exchange(self, message, timeout=None):
+        """
+        Discard stale input, write a message and return the response.
+
+        """
+        self.flush()
+        self.write(message)
+        return self.read_frame(timeout)
+
+    def exchange_many(self, messages, timeout=None):
+        """
+        Discard stale input, write all messages back-to-back and return the
+        responses in the same order. `timeout` applies to each response.
+
+        """
+        self.flush()
+        self.write(b''.join(messages))
+        return [self.read_frame(timeout) for _ in messages]
+
+class ReconnectEvent():
+    """
+    Report of a recovered connection, given to the `on_reconnect` callbacks
+    of a ReconnectingTransport.
+
+    """
+
+    def __init__(self, address, reason, attempts, downtime):
+        self.address = address
+        self.reason = reason
+        self.attempts = attempts
+        self.downtime = downtime
+        #Filled in by the pump, see P_pump._restore_state()
+        self.restored = {}
+        self.mode = None
+        self.replayed = False
+
+    def __repr__(self):
+        return 'ReconnectEvent(address={}, reason={!r}, attempts={}, downtime={:.3f}, restored={}, replayed={})'.format(
+            self.address, self.reason, self.attempts, self.downtime, self.restored, self.replayed)
+
+def _is_idempotent(message):
+    #Reads, target and control type writes and setting idle can be repeated
+    #safely. Starting control, tare or leak test is not repeated.
+    if message[2] == 2:
+        return True
+    return message[4] in (77, 79) or (message[4] == 78 and frame_value(message) == 0)
+
+class ReconnectingTransport():
+    """
+    FrameTransport that recovers from a dead or stalled serial port. If the 
+    port raises an error, or `stall_timeouts` messages in a row time out, the
+    port is closed and opened again, if needed on a new address found with 
+    the `identifier` of the USB to serial converter. The frame alignment 
+    starts fresh on the new connection. Messages that can safely be repeated
+    are send again, others raise a PumpCommunicationError. Every recovery is
+    reported to the `on_reconnect` callbacks.
+
+    """
+
+    def __init__(self, address, identifier=None, timeout=2, reconnect_timeout=10,
+                 stall_timeouts=3, max_reconnects=3, settle=0.05, on_reconnect=None, ser=None,
+                 max_backoff=30):
+        """
+        Input:
+        `address`(str): Address of the serial port. If None, the port is
+            found with `identifier`.
+        `identifier`(str): Optional, identifier of the port to find it again
+            if the address changes after a reconnect, see find_address().
+            Exactly one port must match, otherwise a 
+            PumpCommunicationError is raised.
+        `timeout`(float): Default deadline in seconds to receive a message.
+        `reconnect_timeout`(float): Maximum time in seconds to reopen the 
+            port. A PumpCommunicationError is raised if it takes longer.
+        `stall_timeouts`(int): Number of timeouts in a row after which the 
+            port is considered stalled and reopened.
+        `max_reconnects`(int): Number of reconnects in a row, without a 
+            message received in between, after which a 
+            PumpCommunicationError is raised. After that, the port is only
+            tried again after a waiting time that doubles up to 
+            `max_backoff` seconds; until then commands fail directly.
+        `settle`(float): Time in seconds to wait after opening the port, 
+            before discarding the late responses to earlier messages.
+        `on_reconnect`(function): Optional, called with a ReconnectEvent 
+            after every recovery.
+        `ser`(obj): Optional, already opened serial object for the first 
+            connection.
+        `max_backoff`(float): Longest waiting time in seconds between 
+            attempts to reopen a failed port.
+
+        """
+        self.address = address
+        self.identifier = identifier
+        self.reconnect_timeout = reconnect_timeout
+        self.stall_timeouts = stall_timeouts
+        self.max_reconnects = max_reconnects
+        self.settle = settle
+        self.max_backoff = max_backoff
+        if address == None and ser == None:
+            #Without user interaction, unlike find_address()
+            self.address = self._find()
+        self.callbacks = [] if on_reconnect == None else [on_reconnect]
+        self.reconnects = 0
+        self._failed = 0
+        self._backoff = 0
+        self._retry_at = 0
+        self._timeouts = 0
+        self._last_written = None
+        self._reconnecting = False
+        self._transport = FrameTransport(ser if ser != None else open_serial(self.address, timeout=timeout),
+                                         timeout=timeout)
+        self._checksum_errors = 0
+
+    @property
+    def ser(self):
+        return self._transport.ser
+
+    @property
+    def metrics(self):
+        return self._transport.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._transport.metrics = metrics
+
+    @property
+    def labels(self):
+        return self._transport.labels
+
+    @labels.setter
+    def labels(self, labels):
+        self._transport.labels = labels
+
+    @property
+    def timeout(self):
+        return self._transport.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._transport.timeout = timeout
+
+    @property
+    def checksum_errors(self):
+        return self._checksum_errors + self._transport.checksum_errors
+
+    def _find(self):
+        if self.identifier == None:
+            return self.address
+        ports = list(list_ports.grep(self.identifier))
+        if len(ports) != 1:
+            raise PumpCommunicationError('{} ports found with identifier {}'.format(len(ports), self.identifier))
+        return ports[0].device
+
+    def reconnect(self, reason='manual'):
+        """
+        Close the serial port and open it again. Retries until the port is 
+        open or `reconnect_timeout` has passed. Raises a 
+        PumpCommunicationError if the port was reopened `max_reconnects` 
+        times in a row without receiving a message.
+        Returns:
+        `event`(ReconnectEvent): Report of the reconnect, also given to the
+            callbacks.
+
+        """
+        if self._failed >= self.max_reconnects:
+            #Failed port: only try again after a waiting time, instead of
+            #reopening on every command
+            now = time.monotonic()
+            if now < self._retry_at:
+                raise PumpCommunicationError('Connection to {} failed after {} reconnects, next attempt in {:.1f}s: {}'.format(
+                    self.address, self._failed, self._retry_at - now, reason))
+            if self._backoff == 0:
+                self._backoff = min(1, self.max_backoff)
+                self._retry_at = now + self._backoff
+                raise PumpCommunicationError('Connection to {} failed after {} reconnects: {}'.format(
+                    self.address, self._failed, reason))
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            self._retry_at = now + self._backoff
+        self._failed += 1
+        start = time.monotonic()
+        timeout = self._transport.timeout
+        self._checksum_errors += self._transport.checksum_errors
+        try:
+            self._transport.ser.close()
+        except Exception:
+            pass
+        attempts = 0
+        delay = 0.05
+        while True:
+            attempts += 1
+            try:
+                address = self._find()
+                ser = open_serial(address, timeout=timeout)
+                break
+            except port_errors() + (PumpCommunicationError,) as e:
+                if time.monotonic() - start + delay > self.reconnect_timeout:
+                    raise PumpCommunicationError('Could not reopen {} within {}s: {}'.format(
+                        self.address, self.reconnect_timeout, e))
+                time.sleep(delay)
+                delay = min(delay * 2, 1)
+        self.address = address
+        old = self._transport
+        self._transport = FrameTransport(ser, timeout=timeout)
+        self._transport.metrics = old.metrics
+        self._transport.labels = old.labels
+        #Resynchronize: drop everything that arrives for the old messages
+        time.sleep(self.settle)
+        try:
+            self._transport.flush()
+        except port_errors() as e:
+            raise PumpCommunicationError('{} reopened, but failed: {}'.format(address, e))
+        self._timeouts = 0
+        self.reconnects += 1
+        if self.metrics != None:
+            self.metrics.count('pump_reconnects_total', 1, self.labels)
+        event = ReconnectEvent(address, reason, attempts, time.monotonic() - start)
+        self._reconnecting = True
+        try:
+            for callback in self.callbacks:
+                callback(event)
+        finally:
+            self._reconnecting = False
+        return event
+
+    def _recover(self, error):
+        #Reconnect and send the last messages again if that is safe
+        if self._reconnecting:
+            raise error
+        messages = self._last_written
+        event = self.reconnect(repr(error))
+        if messages == None or not all(_is_idempotent(m) for m in messages):
+            raise PumpCommunicationError('Connection to {} restored, command not repeated'.format(self.address))
+        event.replayed = True
+        try:
+            self._transport.flush()
+            self._transport.write(b''.join(messages))
+        except port_errors() as e:
+            raise PumpCommunicationError('Connection to {} failed while repeating the command: {}'.format(
+                self.address, e))
+
+    def flush(self):
+        try:
+            self._transport.flush()
+        except port_errors() as e:
+            if self._reconnecting:
+                raise
+            #Nothing was send yet, only reconnect
+            self.reconnect(repr(e))
+
+    def write(self, message):
+        frames = [message[i:i + FRAME_LENGTH] for i in range(0, len(message), FRAME_LENGTH)]
+        self._last_written = frames
+        try:
+            self._transport.write(message)
+        except port_errors() as e:
+            self._recover(e)
+
+    def read_frame(self, timeout=None):
+        while True:
+            try:
+                frame = self._transport.read_frame(timeout)
+                self._timeouts = 0
+                self._failed = 0
+                self._backoff = 0
+                return frame
+            except PumpTimeoutError as e:
+                self._timeouts += 1
+                if self._timeouts < self.stall_timeouts:
+                    raise
+                self._recover(e)
+            except port_errors() as e:
+                self._recover(e)
+
+    def exchange(self, message, timeout=None):
+        self.flush()
+        self.write(message)
+        return self.read_frame(timeout)
+
+    def exchange_many(self, messages, timeout=None):
+        self.flush()
+        self.write(b''.join(messages))
+        responses = []
+        while len(responses) < len(messages):
+            count = self.reconnects
+            frame = self.read_frame(timeout)
+            if self.reconnects != count:
+                #All messages were send again, this is the first response
+                responses = []
+            responses.append(frame)
+        return responses
+
+class AsyncFrameTransport():
+    """
+    Non-blocking framed transport for use with asyncio. Incoming bytes are
+    collected by an event loop reader callback on the serial port, so waiting
+    for a response does not block the event loop. On platforms where the 
+    event loop can not watch the serial port (Windows), the blocking 
+    FrameTransport is run in a worker thread instead.
+
+    """
+
+    def __init__(self, ser, timeout=2):
+        """
+        Input:
+        `ser`(obj): Open pyserial Serial object.
+        `timeout`(float): Default deadline in seconds to receive a message.
+
+        """
+        self.ser = ser
+        self.timeout = timeout
+        self.checksum_errors = 0
+        self._buffer = bytearray()
+        self._data = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._loop = None
+        self._fallback = None
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._loop.add_reader(self.ser.fileno(), self._on_readable)
+            self.ser.timeout = 0
+        except (AttributeError, NotImplementedError):
+            self._fallback = FrameTransport(self.ser, timeout=self.timeout)
+
+    def _on_readable(self):
+        data = self.ser.read(self.ser.in_waiting or 1)
+        if data:
+            self._buffer += data
+            self._data.set()
+
+    def close(self):
+        """
+        Stop watching the serial port.
+
+        """
+        if self._loop != None and self._fallback == None:
+            self._loop.remove_reader(self.ser.fileno())
+        self._loop = None
+
+    async def read_frame(self, timeout=None):
+        """
+        Wait for one valid 12 byte message from the pump.
+
+        """
+        if timeout == None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            frame, errors = extract_frame(self._buffer)
+            self.checksum_errors += errors
+            if frame != None:
+                return frame
+            self._data.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PumpTimeoutError('No complete message received from pump within {}s'.format(timeout))
+            try:
+                await asyncio.wait_for(self._data.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def exchange(self, message, timeout=None):
+        """
+        Write a message and return the response. Exchanges are done one at a
+        time, concurrent callers wait for their turn.
+
+        """
+        async with self._lock:
+            if self._loop == None:
+                self._start()
+            if self._fallback != None:
+                return await asyncio.to_thread(self._fallback.exchange, message, timeout)
+            self._buffer.clear()
+            self.ser.reset_input_buffer()
+            self.ser.write(message)
+            return await self.read_frame(timeout)
+
+    async def exchange_many(self, messages, timeout=None):
+        """
+        Write all messages back-to-back and return the responses in order.
+
+        """
+        async with self._lock:
+            if self._loop == None:
+                self._start()
+            if self._fallback != None:
+                return await asyncio.to_thread(self._fallback.exchange_many, messages, timeout)
+            self._buffer.clear()
+            self.ser.reset_input_buffer()
+            self.ser.write(b''.join(messages))
+            return [await self.read_frame(timeout) for _ in messages]
+
+def open_serial(address, timeout=2):
+    """
+    Open the serial connection to a P-pump, or a bus with multiple P-pumps.
     Input:
-    `identifier`(str): Any attribute of the connection. Usually USB to Serial
-        converters use an FTDI chip. These chips store a number of attributes
-        like: name, serial number or manufacturer. This can be used to 
-        identify a serial connection as long as it is unique. See the pyserial
-        list_ports.grep() function for more details.
-    Returns:
-    The function prints the address.
-    `port`(obj): Retruns a pyserial port object. port.device stores the 
-        address.
-    
+    `address`(str): '/dev/ttyUSBX' on linux or 'COMX' on windows.
+    `timeout`(float): Read timeout in seconds.
+
     """
-    found = False
-    if identifier != None:
-        port = [i for i in list(list_ports.grep(identifier))]
-        
-        if len(port) == 1:
-            print('Device address: {}'.format(port[0].device))
-            found = True
-        elif len(port) == 0:
-            print('''No devices found using identifier: {}
-            \nContinue with manually finding USB address...\n'''.format(identifier))
-        else:
-            for p in connections:
-                print('{:15}| {:15} |{:15} |{:15} |{:15}'.format('Device', 'Name', 'Serial number', 'Manufacturer', 'Description') )
-                print('{:15}| {:15} |{:15} |{:15} |{:15}\n'.format(str(p.device), str(p.name), str(p.serial_number), str(p.manufacturer), str(p.description)))
-            raise Exception("""The input returned multiple devices, see above.""")
+    return serial.Serial(address, timeout=timeout, baudrate=115200,
+                         bytesize=serial.EIGHTBITS,
+                         stopbits=serial.STOPBITS_ONE,
+                         parity=serial.PARITY_NONE)
+
+class SerialLock():
+    """
+    Reentrant lock for the serial line that grants access in the order it
+    was requested. Used so that background polling and control commands
+    take turns on the line, and neither can starve the other.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._next_ticket = 0
+        self._serving = 0
+        self._owner = None
+        self._depth = 0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._cond.wait()
+            self._owner = me
+            self._depth = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner != threading.get_ident():
+                raise RuntimeError('Cannot release a lock that is not owned')
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._serving += 1
+                self._cond.notify_all()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+class TelemetryBuffer():
+    """
+    Preallocated ring buffer of timestamped register samples. Only one thread
+    should write to the buffer. Readers do not take a lock; they copy the 
+    requested rows and retry if the writer overwrote them while copying.
+    Values are stored as the raw register values, as returned by the pump.
+
+    """
+
+    def __init__(self, registers, capacity=100000):
+        """
+        Input:
+        `registers`(list): Register addresses stored in each sample.
+        `capacity`(int): Number of samples kept before the oldest samples
+            are overwritten.
+
+        """
+        self.registers = list(registers)
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, len(self.registers)), dtype=np.int64)
+        self.count = 0
+
+    def append(self, timestamp, values):
+        """
+        Add one sample. `values` holds one value per register.
+
+        """
+        i = self.count % self.capacity
+        self.times[i] = timestamp
+        self.values[i] = values
+        #Publish the sample only after it is completely written
+        self.count += 1
+
+    def latest(self):
+        """
+        Returns the newest sample as (timestamp, values), or None if the
+        buffer is empty.
+
+        """
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+            i = (count - 1) % self.capacity
+            timestamp = self.times[i]
+            values = self.values[i].copy()
+            #The writer may already be filling the slot after the newest
+            #sample, so one slot less than capacity is safe
+            if self.count - count < self.capacity - 1:
+                return timestamp, values
+
+    def last(self, n):
+        """
+        Returns the newest `n` samples in time order as (times, values). At
+        most capacity - 1 samples are returned, the slot after the newest
+        sample may be in the middle of being written.
+
+        """
+        while True:
+            count = self.count
+            n = min(n, count, self.capacity - 1)
+            idx = np.arange(count - n, count) % self.capacity
+            times = self.times[idx]
+            values = self.values[idx]
+            #Rows older than count + n + 1 - capacity may have been overwritten
+            if self.count - count <= self.capacity - n - 1:
+                return times, values
+
+    def window(self, seconds):
+        """
+        Returns all samples from the last `seconds` seconds, counted back from 
+        the newest sample, in time order as (times, values).
+
+        """
+        times, values = self.last(self.capacity)
+        if len(times) == 0:
+            return times, values
+        start = np.searchsorted(times, times[-1] - seconds, side='left')
+        return times[start:], values[start:]
+
+class _BusRequest():
+    def __init__(self, pump_id, message, timeout):
+        self.pump_id = pump_id
+        self.message = message
+        self.timeout = timeout
+        self.future = Future()
+
+class PumpBus():
+    """
+    Shared serial line for multiple P-pumps. The bus owns the serial port and
+    sends the messages of all connected P_pump objects one at a time from a
+    single worker thread. Every pump has its own queue and the queues are
+    served round-robin, so a pump with many requests (like a fast telemetry
+    stream) can not block the other pumps. Responses are matched to the
+    requesting pump by the pump_id in the message.
+    Usage:
+        bus = PumpBus('/dev/ttyUSB0')
+        pump_1 = P_pump(name='Pump_1', pump_id=1, bus=bus)
+        pump_2 = P_pump(name='Pump_2', pump_id=2, bus=bus)
+
+    """
+
+    def __init__(self, address, timeout=2, ser=None, metrics=None):
+        """
+        Input:
+        `address`(str): Address of the serial port. '/dev/ttyUSBX' on linux or
+            'COMX' on windows.
+        `timeout`(float): Time in seconds to wait for the response of a pump.
+        `ser`(obj): Optional, already opened serial object to use instead of
+            opening `address`.
+        `metrics`(Metrics): Optional, measure the traffic on the bus.
+
+        """
+        self.address = address
+        self.timeout = timeout
+        self.ser = ser if ser != None else open_serial(address, timeout=timeout)
+        self.transport = FrameTransport(self.ser, timeout=timeout)
+        self.metrics = metrics
+        self.transport.metrics = metrics
+        self.transport.labels = (('bus', str(address)),)
+        self.misrouted = 0
+        self._queues = {}
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='PumpBus_{}'.format(address), daemon=True)
+        self._worker.start()
+
+    def submit(self, pump_id, message, timeout=None):
+        """
+        Queue a message for the pump with `pump_id`. `message` can also be a 
+        list of messages, these are written back-to-back and the future 
+        resolves to the list of responses.
+        Returns:
+        `request`: The queued request. request.future resolves to the 12 byte
+            response of the pump, or to a PumpCommunicationError.
+
+        """
+        request = _BusRequest(pump_id, message, self.timeout if timeout == None else timeout)
+        with self._cond:
+            if self._closed:
+                raise PumpCommunicationError('Bus {} is closed'.format(self.address))
+            queue = self._queues.setdefault(pump_id, deque())
+            if not queue:
+                self._ready.append(pump_id)
+            queue.append(request)
+            self._cond.notify()
+        return request
+
+    def connect(self, pump_id):
+        """
+        Returns a transport for a single pump on this bus. Used by P_pump.
+
+        """
+        return BusTransport(self, pump_id)
+
+    def close(self):
+        """
+        Finish the queued messages, stop the worker and close the serial port.
+
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+        self.ser.close()
+
+    def _next_request(self):
+        with self._cond:
+            while not self._ready:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            #Round-robin: serve one message per pump, then move to the next
+            pump_id = self._ready.popleft()
+            queue = self._queues[pump_id]
+            request = queue.popleft()
+            if queue:
+                self._ready.append(pump_id)
+            return request
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request == None:
+                return
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            try:
+                request.future.set_result(self._exchange(request))
+            except Exception as e:
+                request.future.set_exception(e)
+
+    def _exchange(self, request):
+        self.transport.flush()
+        if isinstance(request.message, list):
+            self.transport.write(b''.join(request.message))
+            return [self._read_response(request.pump_id, request.timeout) for _ in request.message]
+        self.transport.write(request.message)
+        return self._read_response(request.pump_id, request.timeout)
+
+    def _read_response(self, pump_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.transport.read_frame(timeout)
+            #pump_id 0 is a broadcast, accept the response of any pump
+            if pump_id == 0 or frame[1] == pump_id:
+                return frame
+            self.misrouted += 1
+            timeout = max(deadline - time.monotonic(), 0)
+
+class BusTransport():
+    """
+    Transport of a single pump on a PumpBus. Has the same interface as 
+    FrameTransport: write() queues the message on the bus and read_frame() 
+    waits for its response.
+
+    """
+
+    def __init__(self, bus, pump_id):
+        self.bus = bus
+        self.pump_id = pump_id
+        self.timeout = bus.timeout
+        self._pending = deque()
+
+    @property
+    def checksum_errors(self):
+        return self.bus.transport.checksum_errors
+
+    def flush(self):
+        #Responses to earlier messages are no longer wanted
+        while self._pending:
+            self._pending.popleft().future.cancel()
+
+    def write(self, message):
+        self._pending.append(self.bus.submit(self.pump_id, message, self.timeout))
+
+    def read_frame(self, timeout=None):
+        if not self._pending:
+            raise PumpCommunicationError('No message send to pump {}, no response to read'.format(self.pump_id))
+        request = self._pending.popleft()
+        if timeout != None:
+            #Applies if the message is still waiting in the queue
+            request.timeout = timeout
+        return request.future.result()
+
+    def exchange(self, message, timeout=None):
+        self.flush()
+        self.write(message)
+        return self.read_frame(timeout)
+
+    def exchange_many(self, messages, timeout=None):
+        self.flush()
+        self.write(list(messages))
+        return self.read_frame(timeout)
+
+class AsyncBusTransport():
+    """
+    Transport of a single pump on a PumpBus for use with asyncio. The bus 
+    worker thread does the serial communication, the event loop only waits
+    for the result.
+
+    """
+
+    def __init__(self, bus, pump_id):
+        self.bus = bus
+        self.pump_id = pump_id
+        self.timeout = bus.timeout
+
+    @property
+    def checksum_errors(self):
+        return self.bus.transport.checksum_errors
+
+    def close(self):
+        pass
+
+    async def exchange(self, message, timeout=None):
+        request = self.bus.submit(self.pump_id, message, self.timeout if timeout == None else timeout)
+        return await asyncio.wrap_future(request.future)
+
+    async def exchange_many(self, messages, timeout=None):
+        return await self.exchange(list(messages), timeout)
+
+class RegisterCache():
+    """
+    Cache of register values with a maximum age per register. Only registers
+    with a maximum age are cached. The cache is filled by reads and by 
+    confirmed writes of the pump, and emptied when the pump changes mode or 
+    on errors.
+
+    """
+
+    def __init__(self, max_age=None):
+        """
+        Input:
+        `max_age`(dict): Maximum age in seconds per register address. 
+            Defaults to CACHE_MAX_AGE.
+
+        """
+        self.max_age = dict(CACHE_MAX_AGE if max_age == None else max_age)
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
+
+    def get(self, register):
+        """
+        Returns the cached value of `register`, or None if it is not cached
+        or older than its maximum age.
+
+        """
+        entry = self._values.get(register)
+        if entry != None and time.monotonic() - entry[1] <= self.max_age[register]:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def update(self, register, value):
+        if register in self.max_age:
+            self._values[register] = (value, time.monotonic())
+
+    def invalidate(self, register=None):
+        """
+        Remove `register` from the cache, or all registers if None.
+
+        """
+        if register == None:
+            self._values.clear()
+        else:
+            self._values.pop(register, None)
+
+class PumpStatus():
+    """
+    Snapshot of pump registers read in one exchange by read_registers(). The 
+    raw register values can be looked up by address: status[66]. The 
+    properties convert the values to the units used by the get functions and 
+    are None if the register was not read.
+
+    """
+
+    def __init__(self, registers, values, timestamp=None):
+        self.registers = list(registers)
+        self.values = dict(zip(self.registers, values))
+        self.timestamp = time.time() if timestamp == None else timestamp
+
+    def __getitem__(self, register):
+        return self.values[register]
+
+    def __contains__(self, register):
+        return register in self.values
+
+    def __repr__(self):
+        return 'PumpStatus({})'.format(self.values)
+
+    def _get(self, register, scale=1):
+        value = self.values.get(register)
+        if value == None:
+            return None
+        return value / scale if scale != 1 else value
+
+    @property
+    def pressure(self):
+        """
+        Atmospheric (mbar), Supply (mbar gauge) and Chamber (mbar gauge)
+        pressure.
+
+        """
+        return [self._get(64, 10), self._get(65), self._get(66)]
+
+    @property
+    def temperature(self):
+        """
+        Temperature in Celsius of the Atmospheric, Supply and Chamber pressure
+        sensors.
+
+        """
+        return [self._get(67, 10), self._get(68, 10), self._get(69, 10)]
+
+    @property
+    def control_type(self):
+        return self._get(77)
+
+    @property
+    def target(self):
+        return self._get(79)
+
+    @property
+    def mode(self):
+        return self._get(81)
+
+    @property
+    def error_code(self):
+        return self._get(82)
+
+    @property
+    def error(self):
+        """
+        Description of the error code, or None if there is no error.
+
+        """
+        return ERROR_CODES.get(self._get(82))
+
+class TimingEngine():
+    """
+    Timing of pump commands, used for holds and recipes. Measures how long 
+    commands take, so that a command can be send early enough to take effect
+    at its deadline, and remembers when the last write to every register 
+    took effect. All times are integer time.monotonic_ns() nanoseconds.
+    The pump acts on a write when the message arrives, which is estimated as
+    halfway between sending the message and receiving the acknowledgement.
+
+    """
+
+    def __init__(self, smoothing=0.2, spin=0.002):
+        """
+        Input:
+        `smoothing`(float): Weight of a new measurement in the running 
+            averages, between 0 and 1.
+        `spin`(float): The last part of a wait, in seconds, is done by 
+            checking the clock instead of sleeping, for a precise deadline.
+
+        """
+        self.smoothing = smoothing
+        self.spin_ns = int(spin * 1e9)
+        #Running average of the one way latency of writes, per register
+        self.latency_ns = {}
+        #Running average of the total duration of a command, per name
+        self.duration_ns = {}
+        #Estimated time the last acknowledged write took effect, per register
+        self.effective_ns = {}
+
+    def _average(self, table, key, value):
+        old = table.get(key)
+        table[key] = value if old == None else int(old + self.smoothing * (value - old))
+
+    def observe_write(self, location, sent_ns, ack_ns):
+        """
+        Record an acknowledged write that was send at `sent_ns` and 
+        acknowledged at `ack_ns`. Returns the estimated time it took effect.
+
+        """
+        one_way = (ack_ns - sent_ns) // 2
+        self._average(self.latency_ns, location, one_way)
+        self.effective_ns[location] = sent_ns + one_way
+        return sent_ns + one_way
+
+    def observe_command(self, name, duration_ns):
+        """
+        Record the total duration of a command, including verification.
+
+        """
+        self._average(self.duration_ns, name, duration_ns)
+
+    def effective_since(self, location, since_ns):
+        """
+        Returns when the last write to `location` took effect, if it was 
+        acknowledged after `since_ns`. Otherwise the write was only confirmed
+        by reading it back and the current time is returned.
+
+        """
+        effective = self.effective_ns.get(location)
+        if effective != None and effective >= since_ns:
+            return effective
+        return time.monotonic_ns()
+
+    def lead_ns(self, location, before=()):
+        """
+        Returns how long before its deadline a write to register `location` 
+        should be started: the estimated one way latency, plus the duration
+        of the commands in `before` that are send first.
+
+        """
+        return self.latency_ns.get(location, 0) + sum(self.duration_ns.get(c, 0) for c in before)
+
+    def wait_until(self, deadline_ns, check=None, poll_interval=None):
+        """
+        Wait until the monotonic deadline. Sleeps, and checks the clock for 
+        the last `spin` seconds.
+        Input:
+        `deadline_ns`(int): time.monotonic_ns() deadline.
+        `check`(function): Optional, called every `poll_interval` seconds 
+            during the wait, like P_pump.check_errors().
+        `poll_interval`(float): Time in seconds between calls of `check`.
+
+        """
+        poll_ns = None if poll_interval == None else int(poll_interval * 1e9)
+        next_check = None if check == None or poll_ns == None else time.monotonic_ns() + poll_ns
+        while True:
+            now = time.monotonic_ns()
+            remaining = deadline_ns - now
+            if remaining <= 0:
+                return
+            if next_check != None and now >= next_check:
+                check()
+                next_check += poll_ns
+                continue
+            if remaining > self.spin_ns:
+                wake = deadline_ns - self.spin_ns
+                if next_check != None:
+                    wake = min(wake, next_check)
+                time.sleep((wake - now) / 1e9)
+            else:
+                time.sleep(0)
+
+class HoldHandle():
+    """
+    Handle of a timed hold that runs in the background, returned by 
+    P_pump.hold(). The pump is set to idle when the hold time is over. During
+    the hold the pump is checked for errors, so that a pump error is noticed
+    within one poll interval. The idle command is send early by the measured
+    latency of the pump, so that it takes effect at the end of the hold.
+
+    """
+
+    def __init__(self, pump, duration, poll_interval=1, start_ns=None):
+        """
+        Input:
+        `pump`(P_pump): Pump that is holding.
+        `duration`(float): Hold time in seconds.
+        `poll_interval`(float): Time in seconds between error checks.
+        `start_ns`(int): Start of the hold as time.monotonic_ns(), like the
+            moment the pump started. Defaults to now.
+
+        """
+        self.pump = pump
+        self.duration = duration
+        self.poll_interval = poll_interval
+        self.start_ns = time.monotonic_ns() if start_ns == None else start_ns
+        self.deadline_ns = self.start_ns + int(round(duration * 1e9))
+        self.deadline = self.deadline_ns / 1e9
+        #Estimated time the idle command took effect
+        self.end_ns = None
+        self.cancelled = False
+        self.error = None
+        self._idle = True
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='{}_hold'.format(pump.name), daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        timing = self.pump.timing
+        try:
+            #Wake up shortly before the idle command has to be send
+            issue = self.deadline_ns - timing.lead_ns(78)
+            wake = issue - timing.spin_ns
+            while True:
+                remaining = wake - time.monotonic_ns()
+                if remaining <= 0:
+                    break
+                if self._cancel.wait(min(self.poll_interval, remaining / 1e9)):
+                    break
+                if wake - time.monotonic_ns() > 0:
+                    #Raises an exception and sets the pump to idle on errors
+                    self.pump.check_errors()
+            if not self._cancel.is_set():
+                timing.wait_until(issue)
+            if self._idle:
+                sent = time.monotonic_ns()
+                self.pump.set_idle()
+                self.end_ns = timing.effective_since(78, sent)
+        except Exception as e:
+            self.error = e
+            print('{}: Hold stopped: {}'.format(self.pump.name, e))
+        finally:
+            self._done.set()
+
+    def remaining(self):
+        """
+        Returns the remaining hold time in seconds.
+
+        """
+        if self._done.is_set():
+            return 0
+        return max(self.deadline - time.monotonic(), 0)
+
+    def done(self):
+        """
+        Returns True if the hold is over, cancelled or stopped by an error.
+
+        """
+        return self._done.is_set()
+
+    def cancel(self, idle=True):
+        """
+        Stop the hold now. 
+        Input:
+        `idle`(bool): If True the pump is set to idle, if False the pump keeps
+            running.
+
+        """
+        if self._done.is_set():
+            return False
+        self._idle = idle
+        self.cancelled = True
+        self._cancel.set()
+        self._done.wait()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait until the hold is over. Raises the pump error if the hold was 
+        stopped by an error.
+        Input:
+        `timeout`(float): Maximum time in seconds to wait, None to wait until
+            the hold is over.
+        Returns:
+        True if the hold is over, False if the timeout passed first.
+
+        """
+        if not self._done.wait(timeout):
+            return False
+        if self.error != None:
+            raise self.error
+        return True
+
+#Safe state actions of the Watchdog
+WATCHDOG_ACTIONS = ('idle', 'hold', 'none')
+
+class Watchdog():
+    """
+    Background check of the pump mode (register 81), started with 
+    P_pump.start_watchdog(). If the pump reports an error, the error code 
+    (register 82) is read and converted to a PumpError, the safe state action
+    is run and the error is raised by the next error check of the pump, like
+    in a hold. If a telemetry stream with register 81 is running, its samples
+    are used instead of reading the pump.
+
+    """
+
+    def __init__(self, pump, period=0.5, action='idle', on_fault=None):
+        """
+        Input:
+        `pump`(P_pump): Pump to watch.
+        `period`(float): Time in seconds between checks.
+        `action`(str or function): What to do on an error:
+            'idle': Set the pump to idle (default).
+            'hold': Restart control with the last target that was set. Only
+                useful for errors that do not repeat.
+            'none': Only report the error.
+            Or a function that is called with the pump and the error.
+        `on_fault`(function): Optional, called with the pump and the error 
+            after the action.
+
+        """
+        if not callable(action) and action not in WATCHDOG_ACTIONS:
+            raise ValueError('{}: {} is not a valid watchdog action. Choose from: {}'.format(
+                pump.name, action, WATCHDOG_ACTIONS))
+        self.pump = pump
+        self.period = period
+        self.action = action
+        self.on_fault = on_fault
+        self.fault = None
+        self.faults = 0
+        self.checks = 0
+        self.stream_checks = 0
+        self.errors = 0
+        #Last exception of the action or on_fault, the watchdog keeps running
+        self.exception = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='{}_watchdog'.format(pump.name), daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        #Returns the mode and, if available, the error code
+        pump = self.pump
+        buffer = pump.stream_buffer
+        if buffer != None and pump._stream_thread != None and 81 in buffer.registers:
+            sample = buffer.latest()
+            if sample != None and time.time() - sample[0] <= self.period:
+                self.stream_checks += 1
+                values = sample[1]
+                code = values[buffer.registers.index(82)] if 82 in buffer.registers else None
+                return values[buffer.registers.index(81)], code
+        return pump.read_registers([81], fresh=True).mode, None
+
+    def _run(self):
+        next_check = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.checks += 1
+                mode, code = self._sample()
+                if mode == 3:
+                    if code == None:
+                        code = self.pump.read_registers([82], fresh=True).error_code
+                    self._trip(pump_error(code, self.pump.name))
+            except PumpCommunicationError:
+                self.errors += 1
+            except Exception as e:
+                #A failing action or on_fault must not stop the watchdog
+                self.errors += 1
+                self.exception = e
+                print('{}: Watchdog error: {}'.format(self.pump.name, e))
+            next_check += self.period
+            if next_check < time.monotonic():
+                next_check = time.monotonic()
+            self._stop.wait(next_check - time.monotonic())
+
+    def _trip(self, error):
+        pump = self.pump
+        self.fault = error
+        self.faults += 1
+        if pump.cache != None:
+            pump.cache.invalidate()
+        print('{}: Pump error encountered: {}'.format(pump.name, error))
+        try:
+            if callable(self.action):
+                self.action(pump, error)
+            elif self.action == 'idle':
+                pump.set_idle(verify='ack')
+                print('{}: Pump set to idle.'.format(pump.name))
+            elif self.action == 'hold':
+                #The pump leaves error mode through idle
+                pump.set_idle(verify='ack')
+                target = pump.state.get(79)
+                if target != None:
+                    pump.set_target(target, verify='ack')
+                pump.start_flow(verify='ack')
+                print('{}: Pump restarted with target {}.'.format(pump.name, target))
+        finally:
+            if self.on_fault != None:
+                self.on_fault(pump, error)
+
+    def check(self):
+        """
+        Raise the last pump error found by the watchdog, and clear it.
+
+        """
+        fault = self.fault
+        if fault != None:
+            self.fault = None
+            raise fault
+
+    def stop(self):
+        """
+        Stop watching the pump.
+
+        """
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+class OperationHandle():
+    """
+    Handle of a pump operation that ends by itself, like a tare or a leak 
+    test, returned by P_pump.tare() and P_pump.leak_test(). The mode of the 
+    pump is polled in the background, slowly at first and faster near the
+    expected end of the operation. The handle can be awaited in asyncio code:
+    `await pump.tare()`.
+
+    """
+
+    def __init__(self, pump, mode, expected, timeout=None, error=PumpError,
+                 min_interval=0.05, max_interval=1):
+        """
+        Input:
+        `pump`(P_pump): Pump running the operation.
+        `mode`(int): Mode of the pump (register 81) during the operation.
+        `expected`(float): Expected duration of the operation in seconds.
+        `timeout`(float): Time in seconds after which the operation failed,
+            defaults to twice the expected duration plus 5 seconds.
+        `error`(class): PumpError subclass raised on a timeout, with code
+            None.
+        `min_interval`(float): Shortest time in seconds between polls.
+        `max_interval`(float): Longest time in seconds between polls.
+
+        """
+        self.pump = pump
+        self.mode = mode
+        self.expected = expected
+        self.timeout = expected * 2 + 5 if timeout == None else timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.start = time.monotonic()
+        self.polls = 0
+        self.future = Future()
+        self._error = error
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='{}_mode_{}'.format(pump.name, mode),
+                                        daemon=True)
+        self._thread.start()
+
+    def _interval(self, elapsed):
+        #Check quickly if the pump started, then poll at half of the expected
+        #remaining time, within the poll limits
+        if self.polls == 0:
+            return self.min_interval
+        remaining = self.expected - elapsed
+        return min(max(remaining / 2, self.min_interval), self.max_interval)
+
+    def _run(self):
+        try:
+            while True:
+                elapsed = time.monotonic() - self.start
+                if elapsed > self.timeout:
+                    self.pump.set_idle()
+                    raise self._error(None, self.pump.name,
+                        'Did not finish within {} s, pump set to idle'.format(self.timeout))
+                if self._cancel.wait(self._interval(elapsed)):
+                    return
+                self.polls += 1
+                #Raises the typed error and sets the pump to idle on errors
+                mode = self.pump.get_mode()
+                if mode == 0:
+                    self.future.set_result(time.monotonic() - self.start)
+                    return
+                if mode != self.mode:
+                    self.pump.set_idle()
+                    raise Exception('{}: Unexpected pump mode {}, pump set to idle'.format(
+                        self.pump.name, mode))
+        except Exception as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+
+    def done(self):
+        """
+        Returns True if the operation finished, failed or was cancelled.
+
+        """
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the end of the operation. Raises the pump error if the 
+        operation failed.
+        Input:
+        `timeout`(float): Maximum time in seconds to wait, None to wait until
+            the operation is over.
+        Returns:
+        `duration`(float): Duration of the operation in seconds.
+
+        """
+        return self.future.result(timeout)
+
+    wait = result
+
+    def cancel(self):
+        """
+        Stop the operation and set the pump to idle.
+
+        """
+        if self.future.done():
+            return False
+        self._cancel.set()
+        self._thread.join()
+        self.future.cancel()
+        self.pump.set_idle()
+        return True
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+class RecipeStep():
+    """
+    One step of a dispensing recipe, see P_pump.run_recipe().
+
+    """
+
+    def __init__(self, mode, target=0, unit='pl/s', duration=None, ramp=0):
+        """
+        Input:
+        `mode`(str): 'pressure', 'flow' or 'idle'.
+        `target`(float): Target pressure in mbar gauge, or target flow rate in
+            `unit`. Not used for 'idle'.
+        `unit`(str): Unit of the flow rate, see FLOW_CONVERSION. 
+        `duration`(float or str): Duration of the step in seconds or in the 
+            format 'dd:hh:mm:ss'. None for the last step to keep pumping 
+            after the recipe is finished.
+        `ramp`(float): Time in seconds to change linearly from the previous
+            target to this target. Part of the duration.
+
+        """
+        if mode not in ('pressure', 'flow', 'idle'):
+            raise ValueError('{} is not a valid step mode. Choose from: pressure, flow, idle'.format(mode))
+        if mode == 'flow' and unit not in FLOW_CONVERSION.keys():
+            raise ValueError('{} is not a valid unit. Choose from: {}'.format(unit, FLOW_CONVERSION.keys()))
+        if isinstance(duration, str):
+            duration = parse_hold(duration)
+        self.mode = mode
+        self.target = target
+        self.unit = unit
+        self.duration = duration
+        self.ramp = ramp
+
+    def __repr__(self):
+        return 'RecipeStep({}, target={}, unit={}, duration={}, ramp={})'.format(
+            self.mode, self.target, self.unit, self.duration, self.ramp)
+
+    @property
+    def control_type(self):
+        #Register 77: 0 = pressure control, 1 = flow control
+        return {'pressure': 0, 'flow': 1}.get(self.mode)
+
+    @property
+    def pump_target(self):
+        #Target as written to register 79, pl/s or mbar
+        if self.mode == 'flow':
+            return int(self.target * FLOW_CONVERSION[self.unit])
+        return int(self.target)
+
+def load_recipe(steps):
+    """
+    Convert a recipe to a list of RecipeStep objects. Steps can be given as
+    RecipeStep objects or as dictionaries with the RecipeStep arguments, like:
+    [{'mode': 'pressure', 'target': 100, 'duration': 10},
+     {'mode': 'flow', 'target': 2, 'unit': 'ul/s', 'duration': 30, 'ramp': 5},
+     {'mode': 'idle', 'duration': 5}]
+
+    """
+    return [s if isinstance(s, RecipeStep) else RecipeStep(**s) for s in steps]
+
+def compile_recipe(steps, control_type=None, target=None, mode=0):
+    """
+    Translate a recipe to the minimal list of pump commands per step, given
+    the current state of the pump. Commands that would not change the state 
+    of the pump are left out. The pump only goes to idle between steps if the
+    control type changes.
+    Input:
+    `steps`(list): RecipeStep objects.
+    `control_type`(int): Current control type of the pump, None if unknown.
+    `target`(int): Current target of the pump, None if unknown.
+    `mode`(int): Current mode of the pump, 0 = idle, 1 = pumping.
+    Returns:
+    `commands`(list): For every step a list of commands, in order: 
+        ('idle',), ('control', control_type), ('target', value), ('start',).
+        Ramps are not included, the first target of a ramp is the target of
+        the previous step.
+
+    """
+    compiled = []
+    for step in steps:
+        commands = []
+        if step.mode == 'idle':
+            if mode != 0:
+                commands.append(('idle',))
+                mode = 0
+        else:
+            if step.control_type != control_type:
+                if mode != 0:
+                    #Do not change control type while pumping
+                    commands.append(('idle',))
+                    mode = 0
+                commands.append(('control', step.control_type))
+                control_type = step.control_type
+            first_target = step.pump_target
+            if step.ramp and target != None and mode == 1:
+                first_target = target
+            if first_target != target:
+                commands.append(('target', first_target))
+            target = step.pump_target
+            if mode != 1:
+                commands.append(('start',))
+                mode = 1
+        compiled.append(commands)
+    return compiled
+
+class StepReport():
+    """
+    Timing of one executed recipe step. The *_ns attributes are integer 
+    time.monotonic_ns() nanoseconds, the other times time.monotonic() 
+    seconds.
+    Attributes:
+    `step`(RecipeStep): The executed step.
+    `planned_start`(float): Time the step should start.
+    `issued`(float): Time the first command of the step was send. Commands 
+        are send early by their measured latency.
+    `start`(float): Estimated time the last command of the step took effect,
+        from this moment the pump runs with the settings of the step.
+    `end`(float): Time the step ended, the start of the next step.
+    `commands`(list): Commands send to the pump, excluding ramp targets.
+    `ramp_writes`(int): Number of target changes during the ramp.
+
+    """
+
+    def __init__(self, step, planned_start_ns):
+        self.step = step
+        self.planned_start_ns = planned_start_ns
+        self.issued_ns = None
+        self.start_ns = None
+        self.end_ns = None
+        self.commands = []
+        self.ramp_writes = 0
+
+    @property
+    def planned_start(self):
+        return self.planned_start_ns / 1e9
+
+    @property
+    def issued(self):
+        return self.issued_ns / 1e9
+
+    @property
+    def start(self):
+        return self.start_ns / 1e9
+
+    @property
+    def end(self):
+        return self.end_ns / 1e9
+
+    @property
+    def delay(self):
+        #Time between the planned start and the moment the step was running
+        return (self.start_ns - self.planned_start_ns) / 1e9
+
+    @property
+    def duration(self):
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def __repr__(self):
+        return 'StepReport({}, delay={:.4f}s, duration={:.4f}s, writes={})'.format(
+            self.step.mode, self.delay, self.duration, len(self.commands) + self.ramp_writes)
+
+def find_address(identifier = None):
+    """
+    Find the address of a serial device. It can either find the address using
+    an identifier given by the user or by manually unplugging and plugging in 
+    the device.
+    Input:
+    `identifier`(str): Any attribute of the connection. Usually USB to Serial
+        converters use an FTDI chip. These chips store a number of attributes
+        like: name, serial number or manufacturer. This can be used to 
+        identify a serial connection as long as it is unique. See the pyserial
+        list_ports.grep() function for more details.
+    Returns:
+    The function prints the address.
+    `port`(obj): Retruns a pyserial port object. port.device stores the 
+        address.
+    
+    """
+    found = False
+    if identifier != None:
+        port = [i for i in list(list_ports.grep(identifier))]
+        
+        if len(port) == 1:
+            print('Device address: {}'.format(port[0].device))
+            found = True
+        elif len(port) == 0:
+            print('''No devices found using identifier: {}
+            \nContinue with manually finding USB address...\n'''.format(identifier))
+        else:
+            for p in connections:
+                print('{:15}| {:15} |{:15} |{:15} |{:15}'.format('Device', 'Name', 'Serial number', 'Manufacturer', 'Description') )
+                print('{:15}| {:15} |{:15} |{:15} |{:15}\n'.format(str(p.device), str(p.name), str(p.serial_number), str(p.manufacturer), str(p.description)))
+            raise Exception("""The input returned multiple devices, see above.""")
+
+    if found == False:
+        print('Performing manual USB address search.')
+        while True:
+            input('    Unplug the USB. Press Enter if unplugged...')
+            before = list_ports.comports()
+            input('    Plug in the USB. Press Enter if USB has been plugged in...')
+            after = list_ports.comports()
+            port = [i for i in after if i not in before]
+            if port != []:
+                break
+            print('    No port found. Try again.\n')
+        print('Device address: {}'.format(port[0].device))
+    
+    return port[0]
+
+class P_pump():
+    """
+    Control the Dolomite Mitos P-pump, a pressure pump used for microfluidic 
+    applications. 
+    Getting started:
+    Connect the pump using the supplied USB to serial converter and find the
+    address of the port using the "find_address()" function. Initiate the pump
+    by calling this class and providing the address. It is advised to tare the 
+    pump before each operation; use the "tare_pump()" function.
+    The pump can either be operated in pressure control mode, or flow control
+    mode. In pressure control mode, you set a pressure and the pump tries to 
+    keep that pressure. If a flow sensor is installed, you can control the 
+    flow rate directly.     
+    Use the "set_pressure()" and "set_flow()" functions to pump with a 
+    specified pressure or speed and with the option to control the duration
+    of the operation.
+    The pump can more finely be controled by calling the individual control 
+    set functions. 
+    Errors are always printed, other output can be toggled ON or OF using the
+    verbose option. 
+    
+    """
+    
+    def __init__(self, address=None, name=[], pump_id=0, verbose=True, timeout=2,
+                 bus=None, verify='readback', retries=5, backoff=0.01, cache=False,
+                 ser=None, metrics=None, reconnect=False, identifier=None, on_reconnect=None):
+        """
+        Input:
+        `address`(str): Address of the P-pump. '/dev/ttyUSBX' on linux or 'COMX'
+            on windows. Use the "find_address" function to find the address of 
+            your device. 
+        `name`(str): Optional, name to identify the P-pump for the user.
+        `pump_id`(int): If multiple P-pumps are connected, please provide the 
+            unique pump address. If pump_id is 0, the command will be accepted
+            by all connected pumps.
+        `verbose`(bool): Set to True to print extra output about the pump
+            operation.
+        `timeout`(float): Time in seconds to wait for the response of the 
+            pump to a single command.
+        `bus`(PumpBus): Optional, shared serial line if multiple P-pumps are
+            connected to the same port. If given, `address` is not used and
+            `pump_id` should be the unique address of this pump.
+        `verify`(str): How the set functions confirm that the pump took a new
+            value. Options:
+            'readback': Read the value back from the pump (default, safest).
+            'on_failure': Trust the acknowledgement of the pump, only read the
+                value back if the pump did not acknowledge the command.
+            'ack': Only trust the acknowledgement of the pump. Fastest.
+        `retries`(int): Number of times a set command is repeated before an
+            exception is raised.
+        `backoff`(float): Wait time in seconds before the first repeat of a
+            set command. Doubles with each further repeat.
+        `cache`(bool or dict): Optional, set to True to cache the sensor type,
+            control type and target, so that reading them does not need to 
+            communicate with the pump. Or give a dictionary with the maximum
+            age in seconds per register address, like {79: 10}. Use 
+            fresh=True in the get functions to bypass the cache.
+        `ser`(obj): Optional, already opened serial object to use instead of
+            opening `address`, like a simulated pump from Py_P_Pump_sim.
+        `metrics`(Metrics): Optional, collect counters and histograms of the 
+            communication with the pump. See Metrics.
+        `reconnect`(bool): Reopen the serial port if it stops working, and
+            restore the control type and target of the pump. Not available 
+            with `bus`. See ReconnectingTransport.
+        `identifier`(str): Optional, identifier of the USB to serial 
+            converter, see find_address(). Used to find the port if 
+            `address` is None, and to find it again after a reconnect. 
+            Exactly one port must match, there is no interactive search.
+            Enables `reconnect`.
+        `on_reconnect`(function): Optional, called with a ReconnectEvent 
+            after every reconnect.
+
+        """
+        if verify not in VERIFY_POLICIES:
+            raise ValueError('{}: {} is not a valid verify option. Choose from: {}'.format(name, verify, VERIFY_POLICIES))
+        if bus != None and (reconnect or identifier != None):
+            raise ValueError('{}: reconnect and identifier are not available with a bus, the bus owns the serial port.'.format(name))
+        self.address = address
+        self.name = name
+        self.pump_id = pump_id
+        self.verbose = verbose
+        self.verboseprint = print if verbose else lambda *a, **k: None
+        self.timeout = timeout
+        self.bus = bus
+        if bus != None:
+            self.address = bus.address
+            self.ser = bus.ser
+            self.transport = bus.connect(pump_id)
+            self.transport.timeout = timeout
+        elif reconnect or identifier != None:
+            self.transport = ReconnectingTransport(address, identifier, timeout=timeout,
+                                                   on_reconnect=self._restore_state, ser=ser)
+            self.address = self.transport.address
+            self.ser = self.transport.ser
+        else:
+            self.ser = ser if ser != None else open_serial(address, timeout=timeout)
+            self.transport = FrameTransport(self.ser, timeout=timeout)
+        self.on_reconnect = on_reconnect
+        #Last confirmed values of the writable registers
+        self.state = {}
+        self.verify = verify
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self.metric_labels = (('pump', str(name) if name else str(pump_id)),)
+        if bus == None:
+            self.transport.metrics = metrics
+            self.transport.labels = self.metric_labels
+        if cache == True:
+            self.cache = RegisterCache()
+        elif cache:
+            self.cache = RegisterCache(cache)
+        else:
+            self.cache = None
+        self.lock = SerialLock()
+        self.stream_buffer = None
+        self.stream_recorder = None
+        self.stream_errors = 0
+        self._stream_thread = None
+        self._stream_stop = threading.Event()
+        self.active_hold = None
+        self.watchdog = None
+        self.timing = TimingEngine()
+        
+    #_COMMUNICATION_WITH_THE_PUMP_____________________________________________
+    def message_builder(self, message_type, location, value=0, pump_id=None):
+        """
+        Construct a command message for the pump.
+        Input:
+        `message_type`(int): 1 to write a message to the pump. 2 to read a value
+            from the pump.
+        `location`(int): Address of the value to be written/read in the pump.
+        `value`(int): Value to be written
+        `pump_id`(int): Unique identifier of the pump. Use 0 to target all 
+            connected pumps.            
+
+        """
+        if pump_id == None:
+            pump_id = self.pump_id
+        #Read requests never change, they are built once and reused
+        if message_type == 2 and value == 0:
+            return read_request(pump_id, location)
+        return encode(pump_id, message_type, location, value)
+    
+    def send_message(self, message, timeout=None):
+        """
+        Send a message to the pump. The message needs to be a 12 bit byte
+        formatted by the message_builder() function. Write commands wait for 
+        the acknowledgement of the pump, read commands return directly and the
+        response can be read with read_message().
+        Input:
+        `message`(bytes): Message made by message_builder().
+        `timeout`(float): Deadline in seconds for the acknowledgement of a 
+            write command. Defaults to the timeout of the pump.
+        Returns:
+        True if a write command was acknowledged by the pump, False if not. 
+        None for read commands.
+
+        """
+        with self.lock:
+            #Make sure no message is already waiting to be read
+            self.transport.flush()
+            #Write message
+            sent = time.monotonic_ns()
+            self.transport.write(message)
+
+            #check if message is received after command is sent.
+            if message[2] != 2:
+                acknowledged = self.check_ok(timeout)
+                if acknowledged:
+                    self.timing.observe_write(message[4], sent, time.monotonic_ns())
+                return acknowledged
+
+    def request(self, message, timeout=None):
+        """
+        Send a read command to the pump and return the response. The serial
+        line is held for the whole exchange, so that other threads (like the
+        telemetry stream) can not interleave their messages.
+        Input:
+        `message`(bytes): Read command made by message_builder().
+        `timeout`(float): Deadline in seconds for the response.
+        Returns:
+        `response`(bytes): The 12 byte response of the pump.
+
+        """
+        with self.lock:
+            self.send_message(message)
+            return self.read_message(timeout)
+
+    def request_many(self, messages, timeout=None):
+        """
+        Send multiple read commands back-to-back, without waiting for each
+        response, and return the responses in the same order.
+        Input:
+        `messages`(list): Read commands made by message_builder().
+        `timeout`(float): Deadline in seconds for each response.
+
+        """
+        with self.lock:
+            try:
+                if self.metrics == None:
+                    return self.transport.exchange_many(messages, timeout)
+                start = time.perf_counter()
+                responses = self.transport.exchange_many(messages, timeout)
+                labels = self.metric_labels + (('registers', ','.join([str(m[4]) for m in messages])),)
+                self.metrics.observe('pump_round_trip_seconds', time.perf_counter() - start, labels)
+                return responses
+            except PumpCommunicationError:
+                if self.cache != None:
+                    self.cache.invalidate()
+                self.verboseprint('{}: No message send by pump. No message to read'.format(self.name))
+                raise
+
+    def read_registers(self, registers, timeout=None, fresh=False):
+        """
+        Read multiple registers of the pump in one pipelined exchange.
+        Input:
+        `registers`(list): Register addresses, like [64,65,66,81].
+        `timeout`(float): Deadline in seconds for each response.
+        `fresh`(bool): If the register cache is used, set to True to read all
+            registers from the pump instead of using cached values.
+        Returns:
+        `status`(PumpStatus): The raw register values, with properties for
+            the pressure, temperature, mode and target.
+
+        """
+        cache = self.cache
+        if cache == None:
+            responses = self.request_many([self.message_builder(2,r) for r in registers], timeout)
+            return PumpStatus(registers, [frame_value(r) for r in responses])
+
+        values = {}
+        if not fresh:
+            for r in registers:
+                if r in cache.max_age:
+                    value = cache.get(r)
+                    if value != None:
+                        values[r] = value
+        missing = [r for r in registers if r not in values]
+        if missing:
+            responses = self.request_many([self.message_builder(2,r) for r in missing], timeout)
+            for r, response in zip(missing, responses):
+                values[r] = frame_value(response)
+                cache.update(r, values[r])
+        return PumpStatus(registers, [values[r] for r in registers])
+            
+    def read_message(self, timeout=None):
+        """
+        Read a 12 byte message from the pump. Returns as soon as a complete
+        message with a valid checksum has been received. Raises a 
+        PumpTimeoutError if no message arrived within `timeout` seconds.
+
+        """
+        try:
+            response = self.transport.read_frame(timeout)
+        except PumpTimeoutError:
+            self.verboseprint('{}: No message send by pump. No message to read'.format(self.name))
+            raise
+
+        return response
+
+    def interpret_message(self, response):
+        """
+        Interpret the response of the pump. Prints the interpretation and returns
+        True if the message contains no error code. 
+        
+        """
+        if response[2] == 1:
+            response_message = frame_value(response)
+            print('{}: Read request response: {}'.format(self.name, response_message))
+            print('{}: Pump response: {}'.format(self.name, str(response)))
+            return True
+        elif response[2] == 2:
+            return True
+        elif response[2] == 3:
+            if response[3] == 1:
+                print('{}: Checksum error'.format(self.name))
+            elif response[3] == 2:
+                print('{}: Command unknown'.format(self.name))
+                print('{}: Pump response: {}'.format(self.name, str(response)))
+            elif response[3] == 3:
+                print('{}: Invalid data, out of range address of value'.format(self.name))
+                print('{}: Pump response: {}'.format(self.name, str(response)))
+            else:
+                print('{}: Timeout, Communications timeout failure'.format(self.name))
+                print('{}: Pump response: {}'.format(self.name, str(response)))
+            return False
+        elif response[2] == 4:
+            print('{}: Firmware version: {}'.format(self.name, str(response[3]), str(response[4]), str(response[5]), str(response[6])))
+            return True
+        else:
+            print('{}: Unidentifiable message type'.format(self.name))
+            return False
+        
+    def check_ok(self, timeout=None):
+        """
+        If the pump is given a command it will acknowledge it. This function
+        returns True if the pump confirmed the command and False if it did not
+        send a message back. Note that this function does not read back the
+        written value. 
+
+        """
+        try:
+            response = self.read_message(timeout)
+            if self.interpret_message(response) == True:
+                return True
+            else:
+                warnings.warn('{}: Pump error'.format(self.name))
+                self.interpret_message(response)
+                return False
+        except Exception:
+            warnings.warn('{}: No pump response'.format(self.name))
+
+            return False
+
+    def _write_register(self, location, value, read_back, description, 
+                        failure, verify=None):
+        """
+        Write a value to the pump and confirm it according to the verify 
+        policy. Repeats the command with exponential backoff if it could not
+        be confirmed. If all repeats fail the pump is set to idle and an 
+        exception is raised.
+        Input:
+        `location`(int): Register to write.
+        `value`(int): Value to write.
+        `read_back`(function): Returns True if the pump has the new value.
+        `description`(str): Printed when the value is set.
+        `failure`(str): Printed when the value could not be set.
+        `verify`(str): Verify policy, defaults to the policy of the pump.
+
+        """
+        if verify == None:
+            verify = self.verify
+        if verify not in VERIFY_POLICIES:
+            raise ValueError('{}: {} is not a valid verify option. Choose from: {}'.format(self.name, verify, VERIFY_POLICIES))
+        cache = self.cache
+        if cache != None:
+            if location == 78:
+                #Mode change, the pump may change other values as well
+                cache.invalidate()
+            else:
+                cache.invalidate(location)
+        metrics = self.metrics
+        if metrics != None:
+            start = time.perf_counter()
+            labels = self.metric_labels + (('register', str(location)),)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            acknowledged = self.send_message(self.message_builder(1,location,value))
+            if verify == 'ack':
+                confirmed = acknowledged
+            elif verify == 'on_failure':
+                confirmed = acknowledged or read_back()
+            else:
+                confirmed = read_back()
+            if confirmed:
+                self.state[location] = value
+                if cache != None:
+                    cache.update(location, value)
+                if metrics != None:
+                    self._record_write(labels, location, value, attempt, time.perf_counter() - start)
+                self.verboseprint('{}: {}'.format(self.name, description))
+                return
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+
+        if metrics != None:
+            self._record_write(labels, location, value, self.retries, time.perf_counter() - start)
+            metrics.count('pump_set_failures_total', 1, labels)
+        if cache != None:
+            cache.invalidate()
+        print('{}: Could not {}, checking for errors:'.format(self.name, failure))
+        #Read the error before setting idle, which clears it
+        status = self.read_registers([81, 82], fresh=True)
+        #Setting the pump to idle is the safe state, unless that failed
+        if location != 78 or value != 0:
+            self.set_idle()
+        if status.mode == 3:
+            raise pump_error(status.error_code, self.name)
+        print('{}: No pump errors'.format(self.name))
+        raise Exception("Stopped: pump error.")
+        
+    def _record_write(self, labels, location, value, retries, duration):
+        self.metrics.observe('pump_set_retries', retries, labels, RETRY_BUCKETS)
+        self.metrics.observe('pump_set_seconds', duration, labels)
+        if location == 78:
+            self.metrics.observe('pump_mode_transition_seconds', duration,
+                                 self.metric_labels + (('mode', str(value)),))
+
+    def _restore_state(self, event):
+        """
+        Called after the serial port was reopened. Writes the last confirmed
+        control type and target to the pump if it lost them, and reports the
+        reconnect.
+
+        """
+        self.ser = self.transport.ser
+        if self.cache != None:
+            self.cache.invalidate()
+        print('{}: Connection lost ({}), reopened {} after {:.2f}s'.format(
+            self.name, event.reason, event.address, event.downtime))
+        status = self.read_registers([77, 79, 81], fresh=True)
+        event.mode = status.mode
+        for location in (77, 79):
+            value = self.state.get(location)
+            if value != None and status[location] != value & 0xFFFFFFFF:
+                if self.send_message(self.message_builder(1, location, value)):
+                    event.restored[location] = value
+                    self.verboseprint('{}: Restored register {} to {}'.format(self.name, location, value))
+        if self.state.get(78) == 1 and status.mode != 1:
+            warnings.warn('{}: Pump is no longer in control mode after the reconnect'.format(self.name))
+        if self.on_reconnect != None:
+            self.on_reconnect(event)
+
+    #_GET_METHODS_____________________________________________________________    
+    def get_mode(self):
+        """
+        Get the mode of the pump. 
+        Returns mode:
+            0 = Pump idle
+            1 = Pump in Control mode (pumping)
+            2 = Pump performing tare
+            3 = Error. (function prints the specific error code)
+            4 = Pump performing leak test
+
+        """
+        #The error code is read in the same exchange
+        status = self.read_registers([81, 82], fresh=True)
+        mode = status.mode
+
+        if mode == 3: #pump error
+            if self.cache != None:
+                self.cache.invalidate()
+            self.set_idle()
+            print('{}: Pump error encountered, pump set to idle.'.format(self.name))
+            raise pump_error(status.error_code, self.name)
+
+        return mode
+
+    def get_control_type(self, fresh=False):
+        """
+        Check if the pump is into "Pressure" control mode (0).
+        Or if it in in "Flow" control mode (1).
+        Input:
+        `fresh`(bool): Read from the pump, also if the value is cached.
+        Returns:
+            control type (int): Zero for Pressure control, One for Flow control. 
+
+        """
+        return self.read_registers([77], fresh=fresh).control_type
+    
+    def get_target(self, fresh=False):
+        """
+        Get the target flow rate or pressure.
+        Input:
+        `fresh`(bool): Read from the pump, also if the value is cached.
+
+        """
+        return self.read_registers([79], fresh=fresh).target
+    
+    def get_sensor(self, fresh=False):
+        """
+        Get the type of the installed flow sensor.
+        Returns the model number, flow rate range and the unit.
+        Input:
+        `fresh`(bool): Read from the pump, also if the value is cached.
+
+        """
+        return SENSOR_TYPES[self.read_registers([88], fresh=fresh)[88]]
+
+    def get_temp(self):
+        """
+        Returns the temperature in Celsius of the Atmospheric, Supply and Chamber
+        pressure sensors, in that order. 
+        Returns:
+            temperatures(list): Temperatures of the Atmospheric, supply and Chamber
+            pressure sensors.
+
+        """
+        return self.read_registers([67, 68, 69]).temperature
+    
+    def get_pressure(self):
+        """
+        Returns the pressure of the Atmospheric, Supply and Chamber
+        pressure sensors, in that order. Note the units. Gauge means relative to
+        atmospheric pressure. 
+        Returns:
+            temperatures(list): Temperatures of the Atmospheric (mbar),
+            supply(mbar gauge) and Chamber(mbar gauge) pressure sensors.
+
+        """
+        return self.read_registers([64, 65, 66]).pressure
+
+    def get_status(self):
+        """
+        Read the pressures, temperatures, control type, target, mode and error
+        code of the pump in one exchange. Unlike get_mode(), this does not 
+        raise an exception if the pump is in error mode.
+        Returns:
+        `status`(PumpStatus): See read_registers().
+
+        """
+        return self.read_registers(STATUS_REGISTERS)
+
+    
+    #_SET_METHODS_____________________________________________________________
+    def start_flow(self, verify=None):
+        """
+        Set the pump into Control mode. Meaning that it will start pumping using 
+        the target flow or pressure value.
+        Input:
+        `verify`(str): Verification policy for this command, see "verify" in
+            the P_pump initiation. Defaults to the policy of the pump.
+
+        """
+        self._write_register(78, 1, lambda: self.read_registers([81], fresh=True).mode == 1,
+                             'Pump set to control mode, starting flow',
+                             'set pump to control mode', verify)
+                    
+    def set_idle(self, verify=None):
+        """
+        Set the pump in idle state. This will vent the chamber and stop the flow.
+
+        """
+        self._write_register(78, 0, lambda: self.read_registers([81], fresh=True).mode == 0,
+                             'Pump set to idle', 'set pump to idle', verify)
+                    
+    def set_target(self, target, verify=None):
+        """
+        Set the flow or pressure target of the pump. 
+        Input:
+        `target`(int): Target flow speed (picoliter/second) or pressure 
+            (mbar gauge) gauge means above atmospheric. 
+
+        """        
+        self._write_register(79, target, lambda: self.get_target(fresh=True) == target,
+                             'Pump target set to {}'.format(target),
+                             'set pump to target flow/pressure, target = {}'.format(target),
+                             verify)
+    
+    def set_flow_control(self, verify=None):
+        """
+        Set the pump into flow control mode.
+        This does not start the pump, use "start_flow()" to start pumping.
+
+        """
+        self._write_register(77, 1, lambda: self.get_control_type(fresh=True) == 1,
+                             'Pump set to Flow control mode', 'set pump to Flow control', 
+                             verify)
+
+    def set_pressure_control(self, verify=None):
+        """
+        Set the pump in Pressure control mode.
+        This does not start the pump, use "start_flow()" to start pumping.
+
+        """
+        self._write_register(77, 0, lambda: self.get_control_type(fresh=True) == 0,
+                             'Pump set to Pressure control mode', 'set pump to Pressure control',
+                             verify)
+                    
+    #_STREAMING_______________________________________________________________
+    def start_stream(self, registers=[64,65,66], rate_hz=None, capacity=100000, recorder=None):
+        """
+        Continuously read registers of the pump in a background thread and 
+        store the samples in a ring buffer. Other commands can be send to the
+        pump while streaming, they take turns with the stream on the serial
+        line.
+        Input:
+        `registers`(list): Register addresses to read in each sample. 
+            Defaults to the Atmospheric, Supply and Chamber pressure.
+        `rate_hz`(float): Samples per second. None to sample as fast as the
+            connection allows.
+        `capacity`(int): Number of samples kept in the ring buffer.
+        `recorder`(TelemetryRecorder): Optional, also write every sample to a
+            recording file, see Py_P_Pump_record. The recorder must have the
+            same registers. It is closed when the stream stops.
+        Returns:
+        `buffer`(TelemetryBuffer): Buffer the samples are written to. Use
+            latest() and window() to read the data.
+
+        """
+        if self._stream_thread != None:
+            raise Exception('{}: Stream already running, stop it first with "stop_stream()"'.format(self.name))
+        if recorder != None and list(recorder.registers) != list(registers):
+            raise ValueError('{}: The recorder registers {} do not match the streamed registers {}'.format(
+                self.name, recorder.registers, registers))
+        self.stream_buffer = TelemetryBuffer(registers, capacity=capacity)
+        self.stream_recorder = recorder
+        self.stream_errors = 0
+        self._stream_stop.clear()
+        messages = [self.message_builder(2, r) for r in registers]
+        period = 1 / rate_hz if rate_hz else 0
+        self._stream_thread = threading.Thread(target=self._stream_loop,
+                                               args=(messages, period),
+                                               name='{}_stream'.format(self.name),
+                                               daemon=True)
+        self._stream_thread.start()
+        self.verboseprint('{}: Streaming registers {}'.format(self.name, registers))
+        return self.stream_buffer
+
+    def _stream_loop(self, messages, period):
+        buffer = self.stream_buffer
+        recorder = self.stream_recorder
+        values = [0] * len(messages)
+        next_time = time.monotonic()
+        backoff = 0
+        try:
+            while not self._stream_stop.is_set():
+                try:
+                    for i, response in enumerate(self.request_many(messages)):
+                        values[i] = frame_value(response)
+                    backoff = 0
+                except (PumpCommunicationError,) + port_errors():
+                    #Wait at least one period, longer while the errors continue
+                    self.stream_errors += 1
+                    backoff = min(max(backoff * 2, period, 0.01), 1)
+                    self._stream_stop.wait(backoff)
+                    next_time = time.monotonic()
+                    continue
+                self._stream_sample(buffer, recorder, values)
+                if period:
+                    next_time += period
+                    delay = next_time - time.monotonic()
+                    if delay > 0:
+                        self._stream_stop.wait(delay)
+                    else:
+                        #Running behind, do not try to catch up
+                        next_time = time.monotonic()
+        except Exception as e:
+            #Unexpected error: end the stream, so a new one can be started
+            self.stream_errors += 1
+            print('{}: Stream stopped: {}'.format(self.name, e))
+            self._stream_thread = None
+            if recorder != None:
+                recorder.close()
+                self.stream_recorder = None
+
+    def _stream_sample(self, buffer, recorder, values):
+        timestamp = time.time()
+        buffer.append(timestamp, values)
+        if recorder != None:
+            recorder.append(timestamp, values)
+        if self.cache != None:
+            for register, value in zip(buffer.registers, values):
+                self.cache.update(register, value)
+
+    def stop_stream(self):
+        """
+        Stop the telemetry stream. The data stays available in the buffer.
+
+        """
+        thread = self._stream_thread
+        if thread == None:
+            return
+        self._stream_stop.set()
+        thread.join()
+        self._stream_thread = None
+        if self.stream_recorder != None:
+            self.stream_recorder.close()
+            self.stream_recorder = None
+        self.verboseprint('{}: Stream stopped'.format(self.name))
+
+    def latest(self):
+        """
+        Returns the newest streamed sample as (timestamp, values). Values are
+        the raw register values in the order of the streamed registers.
+
+        """
+        if self.stream_buffer == None:
+            raise Exception('{}: No stream started, use "start_stream()"'.format(self.name))
+        return self.stream_buffer.latest()
+
+    def window(self, seconds):
+        """
+        Returns the streamed samples of the last `seconds` seconds as 
+        (timestamps, values) arrays.
+
+        """
+        if self.stream_buffer == None:
+            raise Exception('{}: No stream started, use "start_stream()"'.format(self.name))
+        return self.stream_buffer.window(seconds)
+
+    #_WATCHDOG________________________________________________________________
+    def start_watchdog(self, period=0.5, action='idle', on_fault=None):
+        """
+        Check the pump for errors in the background, see Watchdog. While the
+        watchdog runs, holds and recipes use its result instead of reading
+        the mode of the pump themselves. Stream register 81 (and 82) to let
+        the watchdog use the stream instead of extra reads.
+        Input:
+        `period`(float): Time in seconds between checks. An error is acted 
+            on within this time.
+        `action`(str or function): 'idle', 'hold', 'none' or a function, see
+            Watchdog.
+        `on_fault`(function): Optional, called with the pump and the error.
+        Returns:
+        `watchdog`(Watchdog)
+
+        """
+        self.stop_watchdog()
+        self.watchdog = Watchdog(self, period, action, on_fault)
+        self.verboseprint('{}: Watchdog started, checking every {}s'.format(self.name, period))
+        return self.watchdog
+
+    def stop_watchdog(self):
+        """
+        Stop the watchdog.
+
+        """
+        if self.watchdog == None:
+            return
+        self.watchdog.stop()
+        self.watchdog = None
+
+    def check_errors(self):
+        """
+        Raise the pump error if the pump is in error mode. Uses the result of
+        the watchdog if its thread is running, otherwise reads the mode with
+        get_mode().
+
+        """
+        watchdog = self.watchdog
+        if watchdog != None and watchdog._thread.is_alive():
+            watchdog.check()
+        else:
+            #No watchdog, or its thread has ended
+            self.get_mode()
+
+    #_HIGHER_LEVEL_FUNCTIONS__________________________________________________
+    def tare_pump(self):
+        """
+        Tare the pump to the current atmospheric pressure. Advised to perform
+        before each operation. Asks the user to prepare the pump, use tare()
+        to tare without user interaction.
+
+        """
+        print('''\nTaring pump {}:\n
+            Please disconnect the air supply and open pump chamber.\n
+            Make sure there is not flow in the system.'''.format(self.name))
+        input('Press Enter when ready for tare...')
+        print('Performing tare. Expected duration ~15seconds')
+        self.tare().wait()
+        print('Performed pump {} tare.'.format(self.name))
+
+    def tare(self, expected=15, timeout=None):
+        """
+        Start a tare to the current atmospheric pressure, without user 
+        interaction. The air supply must be disconnected, the pump chamber 
+        open and there should be no flow in the system. 
+        Returns directly, the tare runs on the pump.
+        Input:
+        `expected`(float): Expected duration in seconds, the pump is polled
+            faster near the end.
+        `timeout`(float): Time in seconds after which the tare failed.
+            Defaults to twice the expected duration plus 5 seconds.
+        Returns:
+        `handle`(OperationHandle): Use handle.wait() or `await handle` to 
+            wait for the end of the tare. Raises a TareError if the tare 
+            failed.
+
+        """
+        return self._start_operation(2, 2, expected, timeout, TareError, 'Tare')
+
+    def leak_test(self, pressure=None, expected=10, timeout=None, request=None):
+        """
+        Start a leak test, without user interaction. Returns directly, the 
+        leak test runs on the pump. 
+        The leak test is requested by writing `request` to register 78. This 
+        value is not in the documentation of the pump, so it must be given, 
+        or set in LEAK_TEST_REQUEST, after checking it on your firmware.
+        Input:
+        `pressure`(int): Optional, test pressure in mbar gauge. If given, the
+            pump is set to pressure control with this target first. 
+        `expected`(float): Expected duration in seconds.
+        `timeout`(float): Time in seconds after which the test failed.
+            Defaults to twice the expected duration plus 5 seconds.
+        `request`(int): Value of register 78 that starts the leak test. 
+            Defaults to LEAK_TEST_REQUEST.
+        Returns:
+        `handle`(OperationHandle): Use handle.wait() or `await handle` to 
+            wait for the end of the test. Raises a LeakTestError if the test
+            failed.
+
+        """
+        if request == None:
+            request = LEAK_TEST_REQUEST
+        if request == None:
+            raise ValueError('{}: The leak test command of the pump is not documented. Give `request` or set Py_P_Pump.LEAK_TEST_REQUEST after checking your firmware'.format(self.name))
+        if pressure != None:
+            self.set_pressure_control()
+            self.set_target(pressure)
+        return self._start_operation(request, 4, expected, timeout, LeakTestError, 'Leak test')
+
+    def _start_operation(self, request, mode, expected, timeout, error, operation):
+        #The pump took the command if it runs the operation, or failed it
+        self._write_register(78, request, lambda: self.read_registers([81], fresh=True).mode in (mode, 3),
+                             '{} started'.format(operation), 'start {}'.format(operation.lower()))
+        return OperationHandle(self, mode, expected, timeout, error)
+
+    def hold(self, duration, poll_interval=1, start_ns=None):
+        """
+        Keep the current operation running for a set time, then set the pump
+        to idle. Returns directly, the hold runs in the background. A hold 
+        that is still running is cancelled without setting the pump to idle.
+        Input:
+            `duration`(str or float): Time to hold in the format 'dd:hh:mm:ss',
+                or in seconds. 
+            `poll_interval`(float): Time in seconds between checks for pump 
+                errors during the hold.
+            `start_ns`(int): Start of the hold as time.monotonic_ns(). 
+                Defaults to now.
+        Returns:
+            `handle`(HoldHandle): Use handle.wait() to wait for the end of the
+                hold, handle.remaining() for the remaining time and 
+                handle.cancel() to stop early. handle.start_ns and 
+                handle.end_ns are the estimated times the pump started and 
+                stopped.
+
+        """
+        if isinstance(duration, str):
+            duration = parse_hold(duration)
+        if self.active_hold != None:
+            self.active_hold.cancel(idle=False)
+        self.active_hold = HoldHandle(self, duration, poll_interval, start_ns)
+        return self.active_hold
+
+    def set_flow(self, speed, unit='pl/s', hold='00:00:00:00', wait=True, poll_interval=1):
+        """
+        Start pump in flow control mode with the target flow rate. Can pump for
+        a specified time. Progam will sleep until operation is finished, unless
+        `wait` is False.
+        Input:
+            `speed`(int): Flow rate to pump with
+            `unit`(str): The unit of the target flow rate. Options: 
+                ['pl/s', 'pl/m', 'nl/s', 'nl/m', 'ul/s', 'ul/m', 'ml/s', 'ml/m']
+                Default = 'pl/s'
+            `hold`(str): Time to hold the target pressure, in the format:
+                'dd:hh:mm:ss'. Defaults to indefinite hold until next command. 
+                Use the "set_idle()" function to stop the flow. 
+            `wait`(bool): If False, return directly and hold in the background.
+            `poll_interval`(float): Time in seconds between checks for pump 
+                errors during the hold.
+        Returns:
+            `handle`(HoldHandle): Handle of the hold, None for an indefinite
+                hold. See hold().
+
+        """
+        if self.active_hold != None:
+            self.active_hold.cancel(idle=False)
+
+        #Set pump in flow control mode
+        self.set_flow_control()
+
+        #Convert flow speed to pl/second
+        if unit not in FLOW_CONVERSION.keys():
+            raise ValueError('{}: {} is not a valid unit. Choose from: {}'.format(self.name, unit, FLOW_CONVERSION.keys()))
+        #Calculate speed in picoliter/second    
+        speed = int(speed * FLOW_CONVERSION[unit])
+        #Set flow speed
+        self.set_target(speed)
+
+        if hold == '00:00:00:00':
+            self.verboseprint('{}: Start flow with indefinite hold'.format(self.name))
+            self.start_flow()
+        else:
+            self.verboseprint('{}: Flow set, Will pump for: {}'.format(self.name, hold))
+            sent = time.monotonic_ns()
+            self.start_flow()
+            #The hold time counts from the moment the pump started
+            return self._hold(hold, wait, poll_interval, self.timing.effective_since(78, sent))
+            
+    def set_pressure(self, pressure, hold='00:00:00:00', wait=True, poll_interval=1):
+        """
+        Start pump in pressure control mode with the target pressure. Can pump for
+        a specified time. Program will sleep until operation is finished, unless
+        `wait` is False.
+        Input:
+            `pressure`(int): Target pressure in mbar gauge (gauge = difference with
+                atmospheric)
+            `hold`(str): Time to hold the target pressure, in the format:
+                'dd:hh:mm:ss'. Defaults to indefinite hold until next command. 
+                Use the "set_idle()" function to stop the flow.
+            `wait`(bool): If False, return directly and hold in the background.
+            `poll_interval`(float): Time in seconds between checks for pump 
+                errors during the hold.
+        Returns:
+            `handle`(HoldHandle): Handle of the hold, None for an indefinite
+                hold. See hold().
+
+        """
+        if self.active_hold != None:
+            self.active_hold.cancel(idle=False)
+
+        #Set pump in pressure control mode
+        self.set_pressure_control()
+
+        #Set pressure
+        self.set_target(pressure)
+
+        if hold == '00:00:00:00':
+            self.verboseprint('{}: Start pressure with indefinite hold'.format(self.name))
+            self.start_flow()
+        else:
+            self.verboseprint('{}: Pressure set, Will pump for: {}'.format(self.name, hold))
+            sent = time.monotonic_ns()
+            self.start_flow()
+            #The hold time counts from the moment the pump started
+            return self._hold(hold, wait, poll_interval, self.timing.effective_since(78, sent))
+
+    def run_recipe(self, steps, poll_interval=1, ramp_interval=0.1):
+        """
+        Execute a dispensing recipe: a list of steps with a mode, target, 
+        duration and optional ramp. See load_recipe() for the format. The 
+        recipe is compiled to the smallest number of pump commands: the 
+        control type is only written when it changes, and consecutive steps
+        with the same control type only change the target, without going to 
+        idle in between. Step boundaries are scheduled on time.monotonic_ns()
+        from the moment the first step took effect, so command latency does 
+        not add up over the steps. The commands of a step are send early by
+        their measured latency, so that they take effect at the planned 
+        start of the step.
+        Input:
+        `steps`(list): The recipe, RecipeStep objects or dictionaries.
+        `poll_interval`(float): Time in seconds between checks for pump 
+            errors during a step. None to not check.
+        `ramp_interval`(float): Time in seconds between target changes during
+            a ramp.
+        Returns:
+        `reports`(list): StepReport with the timing of every step.
+
+        """
+        steps = load_recipe(steps)
+        if self.active_hold != None:
+            self.active_hold.cancel(idle=False)
+        for step in steps[:-1]:
+            if step.duration == None:
+                raise ValueError('{}: Only the last step of a recipe can have an undefined duration'.format(self.name))
+
+        status = self.read_registers([77, 79, 81], fresh=True)
+        compiled = compile_recipe(steps, status.control_type, status.target, status.mode)
+        actions = {
+            'idle': lambda: self.set_idle(),
+            'control': lambda c: self.set_flow_control() if c == 1 else self.set_pressure_control(),
+            'target': lambda t: self.set_target(t),
+            'start': lambda: self.start_flow(),
+            }
+
+        timing = self.timing
+        reports = []
+        previous_target = status.target
+        #The schedule starts when the first step took effect
+        planned = None
+        for step, commands in zip(steps, compiled):
+            if planned != None:
+                #Send the commands early, so that the last one takes effect 
+                #at the planned start of the step
+                lead = 0
+                if commands:
+                    lead = timing.lead_ns(RECIPE_COMMAND_REGISTERS[commands[-1][0]],
+                                          [c[0] for c in commands[:-1]])
+                timing.wait_until(planned - lead, self.check_errors, poll_interval)
+            report = StepReport(step, planned)
+            report.issued_ns = time.monotonic_ns()
+            for command in commands:
+                sent = time.monotonic_ns()
+                actions[command[0]](*command[1:])
+                timing.observe_command(command[0], time.monotonic_ns() - sent)
+            report.commands = commands
+            if commands:
+                report.start_ns = timing.effective_since(RECIPE_COMMAND_REGISTERS[commands[-1][0]], sent)
+            else:
+                report.start_ns = report.issued_ns if planned == None else planned
+            if planned == None:
+                planned = report.planned_start_ns = report.start_ns
+            if reports:
+                reports[-1].end_ns = report.start_ns
+            reports.append(report)
+            self.verboseprint('{}: Recipe step {}: {}'.format(self.name, len(reports), step))
+
+            if step.duration == None:
+                report.end_ns = report.start_ns
+                break
+            step_end = planned + int(round(step.duration * 1e9))
+            #Ramp only if the pump was already running with this control type
+            ramped = ('target', step.pump_target) not in commands and ('start',) not in commands
+            if step.ramp and step.mode != 'idle' and ramped and previous_target != step.pump_target:
+                report.ramp_writes = self._ramp(previous_target, step.pump_target, planned,
+                                                min(planned + int(round(step.ramp * 1e9)), step_end),
+                                                ramp_interval)
+            if step.mode != 'idle':
+                previous_target = step.pump_target
+            planned = step_end
+        if reports[-1].end_ns == None:
+            timing.wait_until(planned, self.check_errors, poll_interval)
+            reports[-1].end_ns = time.monotonic_ns()
+        return reports
+
+    def _ramp(self, start_target, end_target, start_ns, end_ns, interval):
+        #Change the target linearly, on a fixed time grid. Every target is
+        #send early by the latency of the pump.
+        timing = self.timing
+        writes = 0
+        last = start_target
+        n = max(int(round((end_ns - start_ns) / 1e9 / interval)), 1)
+        for i in range(1, n + 1):
+            t = start_ns + (end_ns - start_ns) * i // n
+            timing.wait_until(t - timing.lead_ns(79))
+            value = int(round(start_target + (end_target - start_target) * i / n))
+            if value != last:
+                self.set_target(value)
+                last = value
+                writes += 1
+        return writes
+
+    def _hold(self, hold, wait, poll_interval, start_ns=None):
+        handle = self.hold(hold, poll_interval, start_ns)
+        if wait:
+            handle.wait()
+            self.verboseprint('    Pumped for {}'.format(hold))
+        return handle
+
+class PumpFleet():
+    """
+    Manage many P-pumps on one or more serial ports. Every port has its own
+    PumpBus with its own worker thread, so a slow or disconnected port does
+    not stall the pumps on the other ports. Fleet wide operations are run for
+    all pumps at the same time from a thread pool.
+    Usage:
+        fleet = PumpFleet.discover('FTDI', pump_ids=range(1, 9))
+        fleet.set_idle_all()
+        status = fleet.snapshot_all()
+
+    """
+
+    def __init__(self, pumps=None, max_workers=32):
+        """
+        Input:
+        `pumps`(list): Optional, P_pump objects to add to the fleet.
+        `max_workers`(int): Maximum number of pumps that are addressed at the
+            same time by the fleet operations.
+
+        """
+        self.pumps = {}
+        self.buses = {}
+        self.max_workers = max_workers
+        self._executor = None
+        for pump in pumps or []:
+            self.add(pump)
+
+    @classmethod
+    def discover(cls, identifier=None, ports=None, pump_ids=range(1, 17), probe_timeout=0.1,
+                 timeout=2, verbose=False, **kwargs):
+        """
+        Find all pumps on all matching serial ports, without user interaction.
+        The ports are probed at the same time, one thread per port. On each
+        port, every pump_id is asked for its mode, the pump_ids that respond
+        are added to the fleet.
+        Input:
+        `identifier`(str): Only use the ports that match the identifier, see 
+            find_address(). Note that probing sends messages to the devices 
+            on these ports.
+        `ports`(list): Addresses of the ports to probe instead of searching 
+            them with `identifier`. One of the two must be given, other 
+            serial devices are never probed.
+        `pump_ids`(list): Pump ids to probe on every port.
+        `probe_timeout`(float): Time in seconds to wait for the response of a 
+            pump_id during the search.
+        `timeout`(float): Time in seconds to wait for a response during 
+            normal operation.
+        `verbose`(bool): Print extra output of the pumps.
+        Other keyword arguments are passed to P_pump, like verify or cache.
+        Returns:
+        `fleet`(PumpFleet): The pumps are named '<port>_<pump_id>'.
+
+        """
+        if ports == None:
+            if identifier == None:
+                raise ValueError('Give an identifier or the ports to search for pumps')
+            ports = [p.device for p in list_ports.grep(identifier)]
+        fleet = cls()
+        if len(ports) == 0:
+            print('No serial ports found')
+            return fleet
+
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            found = list(executor.map(lambda a: cls._probe_port(a, pump_ids, probe_timeout), ports))
+        for address, (bus, ids) in zip(ports, found):
+            if bus == None:
+                continue
+            bus.timeout = timeout
+            fleet.buses[address] = bus
+            for i in ids:
+                fleet.add(P_pump(name='{}_{}'.format(address, i), pump_id=i, verbose=verbose,
+                                 timeout=timeout, bus=bus, **kwargs))
+        print('Found {} pumps on {} ports'.format(len(fleet.pumps), len(fleet.buses)))
+        return fleet
+
+    @staticmethod
+    def _probe_port(address, pump_ids, probe_timeout):
+        try:
+            bus = PumpBus(address, timeout=probe_timeout)
+        except port_errors() as e:
+            print('Could not open {}: {}'.format(address, e))
+            return None, []
+        #All probes are queued at once, the bus sends them one after the other
+        requests = [(i, bus.submit(i, read_request(i, 81), probe_timeout)) for i in pump_ids]
+        found = []
+        for i, request in requests:
+            try:
+                request.future.result()
+                found.append(i)
+            except PumpCommunicationError:
+                pass
+        if len(found) == 0:
+            bus.close()
+            return None, []
+        return bus, found
+
+    def add(self, pump):
+        """
+        Add a P_pump to the fleet. Its name must be unique in the fleet.
+
+        """
+        name = pump.name if pump.name else '{}_{}'.format(pump.address, pump.pump_id)
+        if name in self.pumps:
+            raise ValueError('Pump name {} is already in the fleet'.format(name))
+        self.pumps[name] = pump
+        if pump.bus != None:
+            self.buses.setdefault(pump.bus.address, pump.bus)
+
+    def __getitem__(self, name):
+        return self.pumps[name]
+
+    def __iter__(self):
+        return iter(self.pumps.values())
+
+    def __len__(self):
+        return len(self.pumps)
+
+    def map(self, function, names=None):
+        """
+        Call `function(pump)` for all pumps at the same time.
+        Input:
+        `function`(function): Called with the P_pump as only argument.
+        `names`(list): Optional, names of the pumps to use. Default all.
+        Returns:
+        `results`(dict): Result per pump name. If the function raised an
+            exception for a pump, the exception is the result.
+
+        """
+        names = list(self.pumps) if names == None else list(names)
+        if self._executor == None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='PumpFleet')
+        futures = {name: self._executor.submit(function, self.pumps[name]) for name in names}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+        return results
+
+    def _check(self, results, action):
+        failed = {name: r for name, r in results.items() if isinstance(r, Exception)}
+        if failed:
+            raise PumpCommunicationError('{} failed for {} pumps: {}'.format(
+                action, len(failed), ', '.join('{} ({})'.format(n, e) for n, e in failed.items())))
+        return results
+
+    def set_idle_all(self, verify=None):
+        """
+        Set all pumps to idle at the same time. All pumps are tried, an 
+        exception is raised afterwards if any of them failed.
+
+        """
+        return self._check(self.map(lambda p: p.set_idle(verify)), 'set_idle')
+
+    def start_flow_all(self, verify=None):
+        """
+        Start all pumps at the same time. An exception is raised if any of 
+        them failed.
+
+        """
+        return self._check(self.map(lambda p: p.start_flow(verify)), 'start_flow')
+
+    def tare_all(self, expected=15, timeout=None):
+        """
+        Tare all pumps at the same time, without user interaction, and wait
+        until all are done. See P_pump.tare().
+        Returns:
+        `durations`(dict): Duration of the tare in seconds per pump name, or
+            the exception if the tare failed.
+
+        """
+        return self._run_all(lambda p: p.tare(expected, timeout))
+
+    def leak_test_all(self, pressure=None, expected=10, timeout=None, request=None):
+        """
+        Leak test all pumps at the same time and wait until all are done. 
+        See P_pump.leak_test().
+        Returns:
+        `durations`(dict): Duration of the test in seconds per pump name, or
+            the exception if the test failed.
+
+        """
+        return self._run_all(lambda p: p.leak_test(pressure, expected, timeout, request))
+
+    def _run_all(self, start):
+        handles = self.map(start)
+        results = {}
+        for name, handle in handles.items():
+            try:
+                results[name] = handle if isinstance(handle, Exception) else handle.result()
+            except Exception as e:
+                results[name] = e
+        return results
 
-    if found == False:
-        print('Performing manual USB address search.')
-        while True:
-            input('    Unplug the USB. Press Enter if unplugged...')
-            before = list_ports.comports()
-            input('    Plug in the USB. Press Enter if USB has been plugged in...')
-            after = list_ports.comports()
-            port = [i for i in after if i not in before]
-            if port != []:
-                break
-            print('    No port found. Try again.\n')
-        print('Device address: {}'.format(port[0].device))
-    
-    return port[0]
+    def snapshot_all(self):
+        """
+        Read the status of all pumps at the same time, see P_pump.get_status().
+        Returns:
+        `status`(dict): PumpStatus per pump name, or the exception if the pump
+            did not respond.
 
-class P_pump():
+        """
+        return self.map(lambda p: p.get_status())
+
+    def close(self):
+        """
+        Stop the thread pool and close all serial ports of the fleet.
+
+        """
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
+        for bus in self.buses.values():
+            bus.close()
+        for pump in self.pumps.values():
+            if pump.bus == None:
+                pump.ser.close()
+        self.buses = {}
+
+class AsyncP_pump():
     """
-    Control the Dolomite Mitos P-pump, a pressure pump used for microfluidic 
-    applications. 
-    Getting started:
-    Connect the pump using the supplied USB to serial converter and find the
-    address of the port using the "find_address()" function. Initiate the pump
-    by calling this class and providing the address. It is advised to tare the 
-    pump before each operation; use the "tare_pump()" function.
-    The pump can either be operated in pressure control mode, or flow control
-    mode. In pressure control mode, you set a pressure and the pump tries to 
-    keep that pressure. If a flow sensor is installed, you can control the 
-    flow rate directly.     
-    Use the "set_pressure()" and "set_flow()" functions to pump with a 
-    specified pressure or speed and with the option to control the duration
-    of the operation.
-    The pump can more finely be controled by calling the individual control 
-    set functions. 
-    Errors are always printed, other output can be toggled ON or OF using the
-    verbose option. 
-    
+    asyncio version of P_pump. All communication methods are coroutines and
+    do not block the event loop, also not while holding a flow or pressure.
+    This makes it possible to run many pump operations concurrently from a 
+    single thread, for instance with asyncio.gather().
+    Usage:
+        pump = AsyncP_pump(address, name='Pump_1')
+        await pump.set_pressure(100, hold='00:00:01:05')
+    Multiple pumps on one serial port can share a PumpBus by passing `bus`.
+
     """
-    
-    def __init__(self, address, name=[], pump_id=0, verbose=True):
+
+    def __init__(self, address=None, name=[], pump_id=0, verbose=True, timeout=2,
+                 bus=None, verify='readback', retries=5, backoff=0.01, ser=None):
         """
         Input:
         `address`(str): Address of the P-pump. '/dev/ttyUSBX' on linux or 'COMX'
-            on windows. Use the "find_address" function to find the address of 
-            your device. 
+            on windows.
         `name`(str): Optional, name to identify the P-pump for the user.
-        `pump_id`(int): If multiple P-pumps are connected, please provide the 
-            unique pump address. If pump_id is 0, the command will be accepted
-            by all connected pumps.
+        `pump_id`(int): Unique pump address if multiple P-pumps are connected.
         `verbose`(bool): Set to True to print extra output about the pump
             operation.
+        `timeout`(float): Time in seconds to wait for the response of the 
+            pump to a single command.
+        `bus`(PumpBus): Optional, shared serial line for multiple P-pumps.
+        `verify`(str): 'readback', 'on_failure' or 'ack'. See P_pump.
+        `retries`(int): Number of times a set command is repeated.
+        `backoff`(float): Wait time in seconds before the first repeat.
+        `ser`(obj): Optional, already opened serial object to use instead of
+            opening `address`.
 
         """
+        if verify not in VERIFY_POLICIES:
+            raise ValueError('{}: {} is not a valid verify option. Choose from: {}'.format(name, verify, VERIFY_POLICIES))
+        self.verify = verify
+        self.retries = retries
+        self.backoff = backoff
         self.address = address
         self.name = name
         self.pump_id = pump_id
         self.verbose = verbose
         self.verboseprint = print if verbose else lambda *a, **k: None
-        self.ser = serial.Serial(address, timeout=2, baudrate=115200,
-                                 bytesize=serial.EIGHTBITS,
-                                 stopbits=serial.STOPBITS_ONE,
-                                 parity=serial.PARITY_NONE)
-        
+        self.timeout = timeout
+        self.bus = bus
+        if bus != None:
+            self.address = bus.address
+            self.ser = bus.ser
+            self.transport = AsyncBusTransport(bus, pump_id)
+            self.transport.timeout = timeout
+        else:
+            self.ser = ser if ser != None else open_serial(address, timeout=timeout)
+            self.transport = AsyncFrameTransport(self.ser, timeout=timeout)
+
+    message_builder = P_pump.message_builder
+    interpret_message = P_pump.interpret_message
+
     #_COMMUNICATION_WITH_THE_PUMP_____________________________________________
-    def message_builder(self, message_type, location, value=0, pump_id=None):
+    async def send_message(self, message, timeout=None):
         """
-        Construct a command message for the pump.
-        Input:
-        `message_type`(int): 1 to write a message to the pump. 2 to read a value
-            from the pump.
-        `location`(int): Address of the value to be written/read in the pump.
-        `value`(int): Value to be written
-        `pump_id`(int): Unique identifier of the pump. Use 0 to target all 
-            connected pumps.            
+        Send a message to the pump and return the response. For write commands
+        a warning is given if the pump did not acknowledge the command. 
 
         """
-        message = bytearray(b'\x02\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-        if pump_id == None:
-            pump_id = self.pump_id
-        message[1] = pump_id
-        message[2] = message_type
-        if message_type == 1 or message_type == 2:
-            message[4] = location
-        message[-4:] = struct.pack('>i', value)
-
-        #Add checksum: bitwise exclusive OR of all other bits.
-        checksum = 0
-        for b in message:
-            checksum ^= b
-        message.append(checksum)
-
-        return bytes(message)
-    
-    def send_message(self, message):
-        """
-        Send a message to the pump. The message needs to be a 12 bit byte
-        formatted by the message_builder() function. 
+        try:
+            response = await self.transport.exchange(message, timeout)
+        except PumpCommunicationError:
+            warnings.warn('{}: No pump response'.format(self.name))
+            raise
+        if message[2] != 2 and self.interpret_message(response) != True:
+            warnings.warn('{}: Pump error'.format(self.name))
+        return response
 
+    async def request(self, message, timeout=None):
         """
-        #Make sure no message is already waiting to be read
-        self.ser.read_all()
-        #Write message
-        self.ser.write(message)
-        time.sleep(0.1)
+        Send a read command to the pump and return the response.
 
-        #check if message is received after command is sent.
-        if message[2] != 2:
-            self.check_ok()
-            
-    def read_message(self):
         """
-        Read a 12bit message from the pump. Returns one byte. 
+        return await self.send_message(message, timeout)
 
+    async def read_register(self, location):
         """
-        try:
-            response = self.ser.read(12)
-        except Exception:
-            self.verboseprint('No message send by pump. No message to read')
-
-        return response
+        Read the value of a register of the pump.
 
-    def interpret_message(self, response):
-        """
-        Interpret the response of the pump. Prints the interpretation and returns
-        True if the message contains no error code. 
-        
         """
-        if response[2] == 1:
-            response_message = (response[7] * (256**3)) + (response[8] * (256**2)) + (response[9] * 256) + response[10]
-            print('{}: Read request response: {}'.format(self.name, response_message))
-            print('{}: Pump response: {}'.format(self.name, str(response)))
-            return True
-        elif response[2] == 2:
-            return True
-        elif response[2] == 3:
-            if response[3] == 1:
-                print('{}: Checksum error'.format(self.name))
-            elif response[3] == 2:
-                print('{}: Command unknown'.format(self.name))
-                print('{}: Pump response: {}'.format(self.name, str(response)))
-            elif response[3] == 3:
-                print('{}: Invalid data, out of range address of value'.format(self.name))
-                print('{}: Pump response: {}'.format(self.name, str(response)))
-            else:
-                print('{}: Timeout, Communications timeout failure'.format(self.name))
-                print('{}: Pump response: {}'.format(self.name, str(response)))
-            return False
-        elif response[2] == 4:
-            print('{}: Firmware version: {}'.format(self.name, str(response[3]), str(response[4]), str(response[5]), str(response[6])))
-            return True
-        else:
-            print('{}: Unidentifiable message type'.format(self.name))
-            return False
-        
-    def check_ok(self):
+        return frame_value(await self.request(self.message_builder(2,location)))
+
+    async def read_registers(self, registers, timeout=None):
         """
-        If the pump is given a command it will acknowledge it. This function
-        returns True if the pump confirmed the command and False if it did not
-        send a message back. Note that this function does not read back the
-        written value. 
+        Read multiple registers of the pump in one pipelined exchange. Returns
+        a PumpStatus, see P_pump.read_registers().
 
         """
-        response = self.read_message()
+        messages = [self.message_builder(2,r) for r in registers]
         try:
-            if self.interpret_message(response) == True:
-                return True
+            responses = await self.transport.exchange_many(messages, timeout)
+        except PumpCommunicationError:
+            warnings.warn('{}: No pump response'.format(self.name))
+            raise
+        return PumpStatus(registers, [frame_value(r) for r in responses])
+
+    async def _write_verified(self, location, value, read_back, description, verify=None):
+        #Write a register and confirm it, like P_pump._write_register()
+        if verify == None:
+            verify = self.verify
+        if verify not in VERIFY_POLICIES:
+            raise ValueError('{}: {} is not a valid verify option. Choose from: {}'.format(self.name, verify, VERIFY_POLICIES))
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.send_message(self.message_builder(1,location,value))
+                acknowledged = self.interpret_message(response) == True
+            except PumpCommunicationError:
+                acknowledged = False
+            if verify == 'ack':
+                confirmed = acknowledged
+            elif verify == 'on_failure':
+                confirmed = acknowledged or await read_back() == value
             else:
-                warnings.warn('{}: Pump error'.format(self.name))
-                self.interpret_message(response)
-        except Exception:
-            warnings.warn('{}: No pump response'.format(slef.name))
+                confirmed = await read_back() == value
+            if confirmed:
+                self.verboseprint('{}: {}'.format(self.name, description))
+                return
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+                delay *= 2
 
-            return False
-        
-    #_GET_METHODS_____________________________________________________________    
-    def get_mode(self):
-        """
-        Get the mode of the pump. 
-        Returns mode:
-            0 = Pump idle
-            1 = Pump in Control mode (pumping)
-            2 = Pump performing tare
-            3 = Error. (function prints the specific error code)
-            4 = Pump performing leak test
+        if location == 78 and value == 0:
+            #Do not use get_mode() here, it calls set_idle() on errors
+            print('{}: Could not set pump to idle'.format(self.name))
+            raise Exception("Stopped: pump error.")
+        await self.set_idle()
+        print('{}: Could not complete: {}, checking for errors:'.format(self.name, description))
+        if await self.get_mode() == 0:
+            print('{}: No pump errors'.format(self.name))
+        raise Exception("Stopped: pump error.")
 
+    #_GET_METHODS_____________________________________________________________
+    async def get_mode(self):
         """
-        self.send_message(self.message_builder(2,81))
+        Get the mode of the pump. See P_pump.get_mode(). Raises an exception
+        and sets the pump to idle if the pump is in error mode.
 
-        mess = self.read_message()
-        translate = struct.unpack('12B', mess)
-        mode = translate[-2]
-
-        if mode == 3: #pump error
-            self.send_message(self.message_builder(2,82))
-            error_mess = struct.unpack('12B', self.read_message())[-2]
-            error_values = {
-                1 : 'Supply > maximum pressure',
-                2 : 'Tare: timed out',
-                3 : 'Tare: Supply still connected',
-                4 : 'Control start timed out. Opening valves, but chamber pressure unchanged',
-                5 : 'Target too low',
-                6 : 'Target too high',
-                7 : 'Leak test: supply pressure too low',
-                8 : 'Leak test: time out if the pressure cannot reach target',
-                9 : 'Flow sensor lost during flow control',
-            }
-            self.set_idle()
+        """
+        status = await self.read_registers([81, 82])
+        if status.mode == 3: #pump error
+            await self.set_idle()
             print('{}: Pump error encountered, pump set to idle.'.format(self.name))
-            raise Exception(error_values[error_mess])
-
-        return translate[-2]
+            raise pump_error(status.error_code, self.name)
+        return status.mode
 
-    def get_control_type(self):
+    async def get_control_type(self):
         """
-        Check if the pump is into "Pressure" control mode (0).
-        Or if it in in "Flow" control mode (1).
-        Returns:
-            control type (int): Zero for Pressure control, One for Flow control. 
+        Zero for Pressure control, One for Flow control.
 
         """
-        self.send_message(self.message_builder(2,77))
-        response = self.read_message()
-        return int.from_bytes(response[-2:-1], byteorder='big', signed=False)
-    
-    def get_target(self):
+        return await self.read_register(77)
+
+    async def get_target(self):
         """
         Get the target flow rate or pressure.
 
         """
-        self.send_message(self.message_builder(2,79))
-        response = self.read_message()
-        return int.from_bytes(response[-5:-1], byteorder='big', signed=False)
-    
-    def get_sensor(self):
+        return await self.read_register(79)
+
+    async def get_sensor(self):
         """
         Get the type of the installed flow sensor.
-        Returns the model number, flow rate range and the unit.
 
         """
-        self.send_message(self.message_builder(2,88))
-        response = self.read_message()
-        sensor = int.from_bytes(response[-5:-1], byteorder='big', signed=False)
-        sensor_types = {
-            0: 'None connected',
-            1: 'LG16-0025, 0.07-1.5ul/min, unit=ul/min',
-            2: 'LG16-0150, 0.4-7ul/min, unit=ul/min',
-            3: 'LG16-0480, 1-50ul/min, unit=ul/min',
-            4: 'LG16-1000, 30-1000ul/min, unit=ul/min',
-            5: 'LG16-2000, 200-5000ul/min, unit=ml/min',
-            }
-        return sensor_types[sensor]
+        return SENSOR_TYPES[await self.read_register(88)]
 
-    def get_temp(self):
+    async def get_temp(self):
         """
-        Returns the temperature in Celsius of the Atmospheric, Supply and Chamber
-        pressure sensors, in that order. 
-        Returns:
-            temperatures(list): Temperatures of the Atmospheric, supply and Chamber
-            pressure sensors.
+        Returns the temperature in Celsius of the Atmospheric, Supply and 
+        Chamber pressure sensors, in that order.
 
         """
-        #Temperature of Atmospheric pressure sensor
-        self.send_message(self.message_builder(2,67))
-        response = self.read_message()
-        atm = int.from_bytes(response[-5:-1], byteorder='big', signed=False)/10
+        return (await self.read_registers([67, 68, 69])).temperature
 
-        #Temperature of Supply pressure sensor
-        self.send_message(self.message_builder(2,68))
-        response = self.read_message()
-        supp = int.from_bytes(response[-5:-1], byteorder='big', signed=False)/10
-
-        #Temperature of Chamber pressure sensor
-        self.send_message(self.message_builder(2,69))
-        response = self.read_message()
-        cham = int.from_bytes(response[-5:-1], byteorder='big', signed=False)/10
-
-        return [atm, supp, cham]
-    
-    def get_pressure(self):
+    async def get_pressure(self):
         """
-        Returns the pressure of the Atmospheric, Supply and Chamber
-        pressure sensors, in that order. Note the units. Gauge means relative to
-        atmospheric pressure. 
-        Returns:
-            temperatures(list): Temperatures of the Atmospheric (mbar),
-            supply(mbar gauge) and Chamber(mbar gauge) pressure sensors.
+        Returns the pressure of the Atmospheric (mbar), Supply (mbar gauge) and
+        Chamber (mbar gauge) pressure sensors, in that order.
 
         """
+        return (await self.read_registers([64, 65, 66])).pressure
 
-        #Pressure of Atmospheric pressure sensor
-        self.send_message(self.message_builder(2,64))
-        response = self.read_message()
-        atm = int.from_bytes(response[-5:-1], byteorder='big', signed=False)/10
-
-        #Pressure of Supply pressure sensor
-        self.send_message(self.message_builder(2,65))
-        response = self.read_message()
-        supp = int.from_bytes(response[-5:-1], byteorder='big', signed=False)
+    async def get_status(self):
+        """
+        Read all status registers in one exchange, see P_pump.get_status().
 
-        #Pressure of Chamber pressure sensor
-        self.send_message(self.message_builder(2,66))
-        response = self.read_message()
-        cham = int.from_bytes(response[-5:-1], byteorder='big', signed=False)
+        """
+        return await self.read_registers(STATUS_REGISTERS)
 
-        return [atm, supp, cham]
-    
-    
     #_SET_METHODS_____________________________________________________________
-    def start_flow(self):
+    async def start_flow(self, verify=None):
         """
-        Set the pump into Control mode. Meaning that it will start pumping using 
-        the target flow or pressure value.
+        Set the pump into Control mode, start pumping.
 
         """
-        counter = 0
-        while True:
-            self.send_message(self.message_builder(1,78,1))      
-            if self.get_mode()  == 1:
-                self.verboseprint('{}: Pump set to control mode, starting flow'.format(self.name))
-                break
-            else:
-                counter += 1
-                print(counter)
-                if counter > 5:
-                    self.set_idle()
-                    print('{}: Could not set pump to control mode, checking for errors:'.format(self.name))
-                    if self.get_mode() == 0:
-                        print('{}: No pump errors'.format(self.name))
-                    raise Exception("Stopped: pump error.")
-                    
-    def set_idle(self):
+        await self._write_verified(78, 1, self.get_mode, 'Pump set to control mode, starting flow', verify)
+
+    async def set_idle(self, verify=None):
         """
         Set the pump in idle state. This will vent the chamber and stop the flow.
 
         """
-        counter = 0
-        while True:
-            self.send_message(self.message_builder(1,78,0))
-            if self.get_mode() == 0:
-                self.verboseprint('{}: Pump set to idle'.format(self.name))
-                break
-            else:
-                counter += 1
-                if counter > 5:
-                    print('{}: Could not set pump to idle, checking for errors:'.format(self.name, target))
-                    if self.get_mode() == 0:
-                        print('{}: No pump errors'.format(self.name))
-                    raise Exception("Stopped: pump error.")
-                    
-    def set_target(self, target):
+        #Do not use get_mode() here, it calls set_idle() on errors
+        await self._write_verified(78, 0, lambda: self.read_register(81), 'Pump set to idle', verify)
+
+    async def set_target(self, target, verify=None):
         """
-        Set the flow or pressure target of the pump. 
-        Input:
-        `target`(int): Target flow speed (picoliter/second) or pressure 
-            (mbar gauge) gauge means above atmospheric. 
+        Set the flow (picoliter/second) or pressure (mbar gauge) target.
 
-        """        
-        counter = 0
-        while True:
-            self.send_message(self.message_builder(1,79,target))
-            if target == self.get_target():
-                self.verboseprint('{}: Pump target set to {} pl/s'.format(self.name, target))
-                break
-            else:
-                counter += 1
-                if counter > 5:
-                    self.set_idle()
-                    print('{}: Could not set pump to target flow/pressure, target = {}, checking for errors:'.format(self.name, target))
-                    if self.get_mode() == 0:
-                        print('{}: No pump errors'.format(self.name))
-                    raise Exception("Stopped: pump error.")
-    
-    def set_flow_control(self):
+        """
+        await self._write_verified(79, target, self.get_target, 'Pump target set to {}'.format(target), verify)
+
+    async def set_flow_control(self, verify=None):
         """
         Set the pump into flow control mode.
-        This does not start the pump, use "start_flow()" to start pumping.
 
         """
-        counter = 0
-        while True:
-            self.send_message(self.message_builder(1,77,1))
-            if self.get_control_type() == 1:
-                self.verboseprint('{}: Pump set to Flow control mode'.format(self.name))
-                break
-            else:
-                counter += 1
-                if counter > 5:
-                    self.set_idle()
-                    print('{}: Could not set pump to Flow control, checking for errors:'.format(self.name))
-                    if self.get_mode() == 0:
-                        print('{}: No pump errors'.format(self.name))
-                    raise Exception("Stopped: pump error.")
+        await self._write_verified(77, 1, self.get_control_type, 'Pump set to Flow control mode', verify)
 
-    def set_pressure_control(self):
+    async def set_pressure_control(self, verify=None):
         """
         Set the pump in Pressure control mode.
-        This does not start the pump, use "start_flow()" to start pumping.
 
         """
-        counter = 0
-        while True:
-            self.send_message(self.message_builder(1,77,0))
-            if self.get_control_type() == 0:
-                self.verboseprint('{}: Pump set to Flow control mode'.format(self.name))
-                break
-            else:
-                counter += 1
-                if counter > 5:
-                    self.set_idle()
-                    print('{}: Could not set pump to Flow control, checking for errors:'.format(self.name))
-                    if self.get_mode() == 0:
-                        print('{}: No pump errors'.format(self.name))
-                    raise Exception("Stopped: pump error.")
-                    
-                    
+        await self._write_verified(77, 0, self.get_control_type, 'Pump set to Pressure control mode', verify)
+
     #_HIGHER_LEVEL_FUNCTIONS__________________________________________________
-    def tare_pump(self):
+    async def hold(self, hold):
         """
-        Tare the pump to the current atmospheric pressure. Advised to perform
-        before each operation. 
+        Keep the current operation running for `hold` ('dd:hh:mm:ss') and
+        set the pump to idle afterwards. If the hold is cancelled, the pump
+        is also set to idle.
 
         """
-        print('''\nTaring pump {}:\n
-            Please disconnect the air supply and open pump chamber.\n
-            Make sure there is not flow in the system.'''.format(self.name))
-        input('Press Enter when ready for tare...')
-        self.send_message(self.message_builder(1,78,2))
-        print('Performing tare. Expected duration ~15seconds')
-        while True:
-            time.sleep(1)
-            if self.get_mode() == 0:
-                break
-        print('Performed pump {} tare.'.format(self.name))
+        try:
+            await asyncio.sleep(parse_hold(hold))
+        finally:
+            await self.set_idle()
+        self.verboseprint('{}: Pumped for {}'.format(self.name, hold))
 
-    def set_flow(self, speed, unit='pl/s', hold='00:00:00:00'):
+    async def set_flow(self, speed, unit='pl/s', hold='00:00:00:00'):
         """
-        Start pump in flow control mode with the target flow rate. Can pump for
-        a specified time. Progam will sleep until operation is finished.
-        Input:
-            `speed`(int): Flow rate to pump with
-            `unit`(str): The unit of the target flow rate. Options: 
-                ['pl/s', 'pl/m', 'nl/s', 'nl/m', 'ul/s', 'ul/m', 'ml/s', 'ml/m']
-                Default = 'pl/s'
-            `hold`(str): Time to hold the target pressure, in the format:
-                'dd:hh:mm:ss'. Defaults to indefinite hold until next command. 
-                Use the "set_idle()" function to stop the flow. 
+        Start pump in flow control mode with the target flow rate. See 
+        P_pump.set_flow(). The hold does not block the event loop.
 
         """
-        #Set pump in flow control mode
-        self.set_flow_control()
-
-        #Convert flow speed to pl/second
-        conversion = {
-        'pl/s' : 1,
-        'pl/m' : (1/60),
-        'nl/s' : 1000,
-        'nl/m' : (1000/60),
-        'ul/s' : 1000000,
-        'ul/m' : (1000000/60),
-        'ml/s' : 1000000000,
-        'ml/m' : (1000000000/60)
-        }
-        if unit not in conversion.keys():
-            raise ValueError('{}: {} is not a valid unit. Choose from: {}'.format(self.name, unit, conversion.keys()))
-        #Calculate speed in picoliter/second    
-        speed = int(speed * conversion[unit])
-        #Set flow speed
-        self.set_target(speed)
+        if unit not in FLOW_CONVERSION.keys():
+            raise ValueError('{}: {} is not a valid unit. Choose from: {}'.format(self.name, unit, FLOW_CONVERSION.keys()))
+        await self.set_flow_control()
+        await self.set_target(int(speed * FLOW_CONVERSION[unit]))
+        await self.start_flow()
+        if hold != '00:00:00:00':
+            await self.hold(hold)
 
-        if hold == '00:00:00:00':
-            self.verboseprint('{}: Start flow with indefinite hold'.format(self.name))
-            self.start_flow()
-        else:
-            time_filt = [86400,3600,60,1]
-            total_time = sum([a*b for a,b in zip(time_filt, map(int,hold.split(':')))])
-            self.verboseprint('{}: Flow set, Will pump for: {}'.format(self.name, hold))
-            self.start_flow()
-            time.sleep(total_time)
-            self.verboseprint('    Pumped for {}'.format(hold))
-            self.set_idle()
-            
-    def set_pressure(self, pressure, hold='00:00:00:00'):
+    async def set_pressure(self, pressure, hold='00:00:00:00'):
         """
-        Start pump in pressure control mode with the target pressure. Can pump for
-        a specified time. Program will sleep until operation is finished. 
-        Input:
-            `pressure`(int): Target pressure in mbar gauge (gauge = difference with
-                atmospheric)
-            `hold`(str): Time to hold the target pressure, in the format:
-                'dd:hh:mm:ss'. Defaults to indefinite hold until next command. 
-                Use the "set_idle()" function to stop the flow.
+        Start pump in pressure control mode with the target pressure. See
+        P_pump.set_pressure(). The hold does not block the event loop.
 
         """
-        #Set pump in pressure control mode
-        self.set_pressure_control()
+        await self.set_pressure_control()
+        await self.set_target(pressure)
+        await self.start_flow()
+        if hold != '00:00:00:00':
+            await self.hold(hold)
 
-        #Set flow speed
-        self.send_message(self.message_builder(1,79,pressure))
+    def close(self):
+        """
+        Close the connection to the pump. A shared PumpBus stays open.
 
-        if time == '00:00:00:00':
-            self.verboseprint('{}: Start pressure with indefinite hold'.format(self.name))
-            self.start_flow()
-        else:
-            time_filt = [86400,3600,60,1]
-            total_time = sum([a*b for a,b in zip(time_filt, map(int,hold.split(':')))])
-            self.verboseprint('{}: Pressure set, Will pump for: {}'.format(self.name, hold))
-            self.start_flow()
-            time.sleep(total_time)
-            self.verboseprint('    Pumped for {}'.format(hold))
-            self.set_idle()
+        """
+        self.transport.close()
+        if self.bus == None:
+            self.ser.close()
 
 if __name__ == "__main__":
 	find_address()
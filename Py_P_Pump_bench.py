@@ -0,0 +1,256 @@
+"""
+Latency and throughput benchmarks for the P-pump driver. Runs against the
+simulator (default) or against real pumps, and writes the results as JSON so
+that different versions of the driver can be compared.
+
+Usage:
+    python Py_P_Pump_bench.py --latency 0.001 --pumps 4 --output sim.json
+    python Py_P_Pump_bench.py --address /dev/ttyUSB0 --pump-ids 1 2 --control
+
+"""
+import json
+import time
+import argparse
+import platform
+import threading
+import numpy as np
+import Py_P_Pump
+import Py_P_Pump_sim
+
+
+def measure(function, repeat=100, warmup=5):
+    """
+    Time a function.
+    Input:
+    `function`(function): Called without arguments.
+    `repeat`(int): Number of timed calls.
+    `warmup`(int): Number of calls before the timed calls.
+    Returns:
+    `samples`(list): Duration of every timed call in seconds.
+
+    """
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def summarize(samples):
+    """
+    Returns the count, mean, min, max and the 50th, 95th and 99th percentile
+    of a list of durations, in milliseconds.
+
+    """
+    if len(samples) == 0:
+        return {'n': 0}
+    ms = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        'n': len(samples),
+        'mean_ms': float(ms.mean()),
+        'min_ms': float(ms.min()),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'max_ms': float(ms.max()),
+        }
+
+def benchmark_operations(pump, repeat=100, control=True):
+    """
+    Latency of the single driver operations of one pump.
+    Input:
+    `pump`(P_pump): Pump to test.
+    `repeat`(int): Number of measurements per operation.
+    `control`(bool): Also measure operations that write to the pump: 
+        setting the target and starting and stopping the pump.
+    Returns:
+    `results`(dict): Summary per operation, see summarize().
+
+    """
+    read_mode = pump.message_builder(2, 81)
+    operations = {
+        'round_trip': lambda: pump.request(read_mode),
+        'read_registers_8': lambda: pump.read_registers([64, 65, 66, 67, 68, 69, 81, 79], fresh=True),
+        'get_pressure': pump.get_pressure,
+        'get_temp': pump.get_temp,
+        'get_mode': pump.get_mode,
+        'get_target': pump.get_target,
+        }
+    if control:
+        target = pump.get_target(fresh=True)
+        operations['set_target'] = lambda: pump.set_target(target)
+    results = {name: summarize(measure(f, repeat)) for name, f in operations.items()}
+
+    if control:
+        start_samples, idle_samples = [], []
+        for _ in range(max(repeat // 10, 1)):
+            start = time.perf_counter()
+            pump.start_flow()
+            start_samples.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            pump.set_idle()
+            idle_samples.append(time.perf_counter() - start)
+        results['start_flow'] = summarize(start_samples)
+        results['set_idle'] = summarize(idle_samples)
+    return results
+
+def benchmark_throughput(pumps, duration=2, registers=[66]):
+    """
+    Sustained register reads per second, with one thread per pump reading
+    continuously.
+    Input:
+    `pumps`(list): P_pump objects, usually on one PumpBus.
+    `duration`(float): Test time in seconds.
+    `registers`(list): Registers read in each request.
+    Returns:
+    `results`(dict): Total and per pump reads per second.
+
+    """
+    counts = [0] * len(pumps)
+    errors = [0] * len(pumps)
+    stop = threading.Event()
+
+    def run(i, pump):
+        while not stop.is_set():
+            try:
+                pump.read_registers(registers, fresh=True)
+                counts[i] += len(registers)
+            except Py_P_Pump.PumpCommunicationError:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=run, args=(i, p), daemon=True) for i, p in enumerate(pumps)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'pumps': len(pumps),
+        'registers_per_request': len(registers),
+        'reads_per_s': sum(counts) / elapsed,
+        'reads_per_s_per_pump': [c / elapsed for c in counts],
+        'errors': sum(errors),
+        }
+
+def benchmark_recipe(pump, steps=10, step_time=0.1):
+    """
+    Timing of a recipe that alternates between two pressure targets.
+    Returns the delay between the planned and actual start of the steps and
+    the total error of the recipe end time.
+
+    """
+    recipe = [{'mode': 'pressure', 'target': 10 + 10 * (i % 2), 'duration': step_time}
+              for i in range(steps)]
+    recipe.append({'mode': 'idle', 'duration': 0})
+    start = time.monotonic()
+    reports = pump.run_recipe(recipe, poll_interval=None)
+    end = reports[-1].start
+    return {
+        'steps': steps,
+        'step_delay': summarize([r.delay for r in reports[1:-1]]),
+        'first_step': summarize([reports[0].start - start]),
+        'end_error_ms': (end - start - steps * step_time) * 1000,
+        }
+
+def simulated_pumps(pump_ids=[1], latency=0.001, baudrate=115200, **kwargs):
+    """
+    Create P_pump objects on a simulated bus. With a single pump, the pump is
+    connected directly, with multiple pumps a PumpBus is used.
+    Returns:
+    `pumps`(list): P_pump objects.
+    `bus`(PumpBus): The bus, None for a single pump.
+
+    """
+    sim = Py_P_Pump_sim.SimulatedBus([Py_P_Pump_sim.SimulatedPump(i, tau=0) for i in pump_ids],
+                                     latency=latency, baudrate=baudrate)
+    ser = Py_P_Pump_sim.SimulatedSerial(sim)
+    if len(pump_ids) == 1:
+        return [Py_P_Pump.P_pump(name='sim_{}'.format(pump_ids[0]), pump_id=pump_ids[0],
+                                 verbose=False, ser=ser, **kwargs)], None
+    bus = Py_P_Pump.PumpBus('simulated', ser=ser)
+    return [Py_P_Pump.P_pump(name='sim_{}'.format(i), pump_id=i, verbose=False, bus=bus, **kwargs)
+            for i in pump_ids], bus
+
+def run(pumps, repeat=100, duration=2, control=True, recipe=True):
+    """
+    Run all benchmarks. The first pump is used for the single pump tests.
+    Returns the results as a dictionary.
+
+    """
+    results = {'operations': benchmark_operations(pumps[0], repeat, control)}
+    results['throughput'] = [benchmark_throughput(pumps[:1], duration),
+                             benchmark_throughput(pumps[:1], duration, registers=[64, 65, 66])]
+    if len(pumps) > 1:
+        results['throughput'].append(benchmark_throughput(pumps, duration))
+    if recipe and control:
+        results['recipe'] = benchmark_recipe(pumps[0])
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the P-pump driver.')
+    parser.add_argument('--address', help='Serial port of real pumps. Without this the simulator is used.')
+    parser.add_argument('--pump-ids', type=int, nargs='+', default=None,
+                        help='Pump ids to test. Default: 0 for real pumps, 1 to --pumps for the simulator.')
+    parser.add_argument('--pumps', type=int, default=4, help='Number of simulated pumps.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Simulated response latency in seconds.')
+    parser.add_argument('--baudrate', type=int, default=115200, help='Simulated line speed.')
+    parser.add_argument('--repeat', type=int, default=100, help='Measurements per operation.')
+    parser.add_argument('--duration', type=float, default=2, help='Duration of throughput tests in seconds.')
+    parser.add_argument('--verify', default='readback', choices=Py_P_Pump.VERIFY_POLICIES)
+    parser.add_argument('--control', action='store_true',
+                        help='On real pumps, also test setting the target and starting and stopping the pump.')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args(argv)
+
+    bus = None
+    if args.address:
+        pump_ids = args.pump_ids or [0]
+        if len(pump_ids) == 1:
+            pumps = [Py_P_Pump.P_pump(args.address, pump_id=pump_ids[0], verbose=False, verify=args.verify)]
+        else:
+            bus = Py_P_Pump.PumpBus(args.address)
+            pumps = [Py_P_Pump.P_pump(pump_id=i, verbose=False, bus=bus, verify=args.verify) for i in pump_ids]
+        control = args.control
+    else:
+        pump_ids = args.pump_ids or list(range(1, args.pumps + 1))
+        #Single pump tests run on a direct connection, the bus for the rest
+        pumps, _ = simulated_pumps(pump_ids[:1], args.latency, args.baudrate, verify=args.verify)
+        if len(pump_ids) > 1:
+            bus_pumps, bus = simulated_pumps(pump_ids, args.latency, args.baudrate, verify=args.verify)
+        control = True
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': args.address or 'simulator',
+            'pump_ids': pump_ids,
+            'latency': None if args.address else args.latency,
+            'baudrate': None if args.address else args.baudrate,
+            'verify': args.verify,
+            'repeat': args.repeat,
+            },
+        }
+    results.update(run(pumps, args.repeat, args.duration, control))
+    if not args.address and len(pump_ids) > 1:
+        results['throughput'].append(benchmark_throughput(bus_pumps, args.duration))
+    if bus != None:
+        bus.close()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return results
+
+if __name__ == "__main__":
+    main()
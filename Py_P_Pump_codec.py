@@ -0,0 +1,212 @@
+"""
+Core of the P-pump protocol: building and decoding the 12 byte messages, the
+register map and the error and sensor tables. Does not need pyserial or NumPy
+(only for decode_frames()), so it can be imported quickly, for instance by 
+workers that analyse recorded messages.
+
+Read requests are built once per pump and register and reused. Write 
+requests and received responses are a single 12 byte bytes object each, the
+messages are not encoded or decoded in place.
+
+"""
+import struct
+
+
+#Every message to and from the pump is 12 bytes long, starts with 0x02 and
+#ends with the XOR checksum of the 11 bytes before it.
+FRAME_LENGTH = 12
+START_BYTE = 0x02
+
+#Message types (byte 2)
+WRITE = 1
+READ = 2
+
+#Layout of a message: start, pump_id, type, code, location, 2 unused bytes,
+#4 byte big endian value and the checksum.
+FRAME_FORMAT = struct.Struct('>BBBBBxxiB')
+VALUE_OFFSET = 7
+_VALUE = struct.Struct('>I')
+_HALVES = struct.Struct('>QI')
+
+#Register addresses of the pump
+REGISTERS = {
+    'atmospheric_pressure' : 64,
+    'supply_pressure' : 65,
+    'chamber_pressure' : 66,
+    'atmospheric_temperature' : 67,
+    'supply_temperature' : 68,
+    'chamber_temperature' : 69,
+    'control_type' : 77,
+    'mode_request' : 78,
+    'target' : 79,
+    'mode' : 81,
+    'error_code' : 82,
+    'sensor' : 88,
+    }
+
+#Error codes of the pump (register 82)
+ERROR_CODES = {
+    1 : 'Supply > maximum pressure',
+    2 : 'Tare: timed out',
+    3 : 'Tare: Supply still connected',
+    4 : 'Control start timed out. Opening valves, but chamber pressure unchanged',
+    5 : 'Target too low',
+    6 : 'Target too high',
+    7 : 'Leak test: supply pressure too low',
+    8 : 'Leak test: time out if the pressure cannot reach target',
+    9 : 'Flow sensor lost during flow control',
+}
+
+#Installed flow sensor (register 88)
+SENSOR_TYPES = {
+    0: 'None connected',
+    1: 'LG16-0025, 0.07-1.5ul/min, unit=ul/min',
+    2: 'LG16-0150, 0.4-7ul/min, unit=ul/min',
+    3: 'LG16-0480, 1-50ul/min, unit=ul/min',
+    4: 'LG16-1000, 30-1000ul/min, unit=ul/min',
+    5: 'LG16-2000, 200-5000ul/min, unit=ml/min',
+    }
+
+#Conversion of flow rate units to picoliter/second
+FLOW_CONVERSION = {
+    'pl/s' : 1,
+    'pl/m' : (1/60),
+    'nl/s' : 1000,
+    'nl/m' : (1000/60),
+    'ul/s' : 1000000,
+    'ul/m' : (1000000/60),
+    'ml/s' : 1000000000,
+    'ml/m' : (1000000000/60)
+    }
+
+_read_frames = {}
+
+
+def xor_checksum(data):
+    """
+    Bitwise exclusive OR of all bytes in `data`. For a complete and valid
+    12 byte message the checksum over all bytes is 0.
+
+    """
+    checksum = 0
+    for b in data:
+        checksum ^= b
+    return checksum
+
+def frame_is_valid(buffer, offset=0):
+    """
+    Returns True if the 12 bytes at `offset` in `buffer` have a valid
+    checksum. Computed on two integers instead of byte by byte.
+
+    """
+    high, low = _HALVES.unpack_from(buffer, offset)
+    x = (high ^ (high >> 32) ^ low) & 0xFFFFFFFF
+    x ^= x >> 16
+    x ^= x >> 8
+    return x & 0xFF == 0
+
+def _value_checksum(value):
+    v = value & 0xFFFFFFFF
+    return (v ^ (v >> 8) ^ (v >> 16) ^ (v >> 24)) & 0xFF
+
+def read_request(pump_id, location):
+    """
+    Returns the read request message for a register. The messages are
+    immutable and built only once per pump_id and register.
+
+    """
+    key = (pump_id, location)
+    frame = _read_frames.get(key)
+    if frame == None:
+        frame = encode(pump_id, READ, location)
+        _read_frames[key] = frame
+    return frame
+
+def encode(pump_id, message_type, location, value=0):
+    """
+    Build a 12 byte message.
+    Input:
+    `pump_id`(int): Address of the pump, 0 for all pumps.
+    `message_type`(int): 1 to write a value, 2 to read a value.
+    `location`(int): Register address.
+    `value`(int): Value to write, signed 32 bit.
+
+    """
+    if message_type != WRITE and message_type != READ:
+        location = 0
+    #Checksum of the fixed bytes combined with the checksum of the value
+    header = START_BYTE ^ pump_id ^ message_type ^ location
+    return FRAME_FORMAT.pack(START_BYTE, pump_id, message_type, 0, location,
+                             value, header ^ _value_checksum(value))
+
+def frame_value(frame, offset=0):
+    """
+    Value of a read request response: bytes 7 to 10 of the message as an
+    unsigned big endian integer.
+
+    """
+    return _VALUE.unpack_from(frame, offset + VALUE_OFFSET)[0]
+
+def extract_frame(buffer):
+    """
+    Take the first valid 12 byte message out of `buffer` (bytearray). Bytes
+    before the start byte of the message and messages with a wrong checksum
+    are removed from the buffer.
+    Returns:
+    `frame`(bytes): The message, or None if the buffer does not contain a
+        complete message yet.
+    `errors`(int): Number of discarded messages with a wrong checksum.
+
+    """
+    errors = 0
+    while True:
+        #Synchronize on the start byte
+        start = buffer.find(START_BYTE)
+        if start < 0:
+            buffer.clear()
+        elif start > 0:
+            del buffer[:start]
+
+        if len(buffer) < FRAME_LENGTH:
+            return None, errors
+        if frame_is_valid(buffer):
+            if len(buffer) == FRAME_LENGTH:
+                #Usual case, the buffer holds exactly one message
+                frame = bytes(buffer)
+                buffer.clear()
+            else:
+                frame = bytes(buffer[:FRAME_LENGTH])
+                del buffer[:FRAME_LENGTH]
+            return frame, errors
+        #Not a valid message, resync on the next start byte
+        errors += 1
+        del buffer[:1]
+
+def decode_frames(data):
+    """
+    Decode many 12 byte messages at once with NumPy, like messages recorded
+    from the serial line. The messages must be aligned: message i starts at 
+    byte 12 * i.
+    Input:
+    `data`(bytes, bytearray or array): The messages, a multiple of 12 bytes.
+    Returns:
+    `frames`(dict): NumPy arrays with one element per message: 'pump_id',
+        'message_type', 'code', 'location', 'value' (unsigned) and 'valid'
+        (start byte and checksum are correct). Apart from 'valid' and 
+        'value', these are views on `data`.
+
+    """
+    import numpy as np
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if raw.size % FRAME_LENGTH:
+        raise ValueError('Data length {} is not a multiple of {}'.format(raw.size, FRAME_LENGTH))
+    raw = raw.reshape(-1, FRAME_LENGTH)
+    value = raw[:, VALUE_OFFSET:VALUE_OFFSET + 4].astype(np.uint32)
+    return {
+        'pump_id': raw[:, 1],
+        'message_type': raw[:, 2],
+        'code': raw[:, 3],
+        'location': raw[:, 4],
+        'value': (value[:, 0] << 24) | (value[:, 1] << 16) | (value[:, 2] << 8) | value[:, 3],
+        'valid': (raw[:, 0] == START_BYTE) & (np.bitwise_xor.reduce(raw, axis=1) == 0),
+        }
@@ -0,0 +1,276 @@
+import math
+import time
+import threading
+from collections import deque
+import numpy as np
+from Py_P_Pump import FLOW_CONVERSION, PumpCommunicationError
+
+
+#_FLOW_PROFILES_______________________________________________________________
+#A flow profile is a function of the time in seconds since the start of the
+#controller, that returns the flow setpoint in pl/s.
+
+def constant_profile(flow, unit='pl/s'):
+    """
+    Constant flow rate.
+
+    """
+    flow = flow * FLOW_CONVERSION[unit]
+    return lambda t: flow
+
+def ramp_profile(start, end, duration, unit='pl/s'):
+    """
+    Linear change from `start` to `end` flow in `duration` seconds, then
+    constant.
+
+    """
+    start = start * FLOW_CONVERSION[unit]
+    end = end * FLOW_CONVERSION[unit]
+    return lambda t: start + (end - start) * min(max(t / duration, 0), 1)
+
+def pulse_profile(low, high, period, duty=0.5, unit='pl/s'):
+    """
+    Square wave between `low` and `high` flow. `duty` is the fraction of the
+    period at the high flow.
+
+    """
+    low = low * FLOW_CONVERSION[unit]
+    high = high * FLOW_CONVERSION[unit]
+    return lambda t: high if (t % period) < duty * period else low
+
+def sine_profile(mean, amplitude, period, unit='pl/s'):
+    """
+    Sinusoidal flow around `mean`.
+
+    """
+    mean = mean * FLOW_CONVERSION[unit]
+    amplitude = amplitude * FLOW_CONVERSION[unit]
+    return lambda t: mean + amplitude * math.sin(2 * math.pi * t / period)
+
+
+class FlowController():
+    """
+    Host side flow control. Follows a time varying flow profile by adjusting
+    the pressure target of the pump, which runs in pressure control mode.
+    Every cycle the chamber pressure (and the flow, if a flow sensor is fitted,
+    see get_sensor()) is read, and a new pressure target is calculated with a feed
+    forward term from the flow resistance of the system plus a PI correction
+    on the flow error. The target is only send to the pump when it changed
+    more than the deadband, to keep the serial line free.
+    If no flow measurement is given, the flow is estimated from the chamber
+    pressure and the flow resistance.
+    The controller runs on a fixed cycle time and reports the timing jitter
+    and the cycles that took longer than the cycle time (overruns).
+    Usage:
+        controller = FlowController(pump, sine_profile(2, 1, 10, unit='ul/m'),
+                                    resistance=0.006)
+        controller.run(60)
+        print(controller.report())
+
+    """
+
+    def __init__(self, pump, profile, resistance, period=0.02, kp=None, ki=None,
+                 deadband=1, max_pressure=None, flow_register=None, flow_scale=1,
+                 flow_reader=None, history=10000):
+        """
+        Input:
+        `pump`(P_pump): Pump to control.
+        `profile`(function): Flow setpoint in pl/s as function of the time in
+            seconds, see the *_profile functions.
+        `resistance`(float): Flow resistance of the fluidic system in mbar
+            per pl/s: the chamber pressure needed for a flow of 1 pl/s.
+        `period`(float): Cycle time of the controller in seconds.
+        `kp`(float): Proportional gain in mbar per pl/s of flow error.
+            Defaults to half the resistance.
+        `ki`(float): Integral gain in mbar per pl/s per second. Defaults to
+            twice the resistance.
+        `deadband`(float): Minimal change of the pressure target in mbar
+            before it is send to the pump.
+        `max_pressure`(float): Highest pressure target in mbar, defaults to
+            the supply pressure at the start, or at the first step() if
+            step() is used without start().
+        `flow_register`(int): Register address of the flow sensor reading.
+            It is read in the same exchange as the chamber pressure. The
+            address depends on the firmware and is not part of this driver.
+        `flow_scale`(float): Flow in pl/s per count of `flow_register`.
+        `flow_reader`(function): Optional, returns the measured flow in pl/s.
+            For instance from a flow sensor that is read by other software.
+        `history`(int): Number of cycles kept for the report.
+
+        """
+        self.pump = pump
+        self.profile = profile
+        self.resistance = resistance
+        self.period = period
+        self.kp = resistance * 0.5 if kp == None else kp
+        self.ki = resistance * 2 if ki == None else ki
+        self.deadband = deadband
+        self.max_pressure = max_pressure
+        self.flow_register = flow_register
+        self.flow_scale = flow_scale
+        self.flow_reader = flow_reader
+        self.registers = [66] if flow_register == None else [66, flow_register]
+        self.error = None
+        self.cycles = 0
+        self.overruns = 0
+        self.writes = 0
+        self.errors = 0
+        #Per cycle: time, setpoint, flow, chamber pressure, target, jitter, latency
+        self.history = deque(maxlen=history)
+        self._integral = 0.0
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _read(self):
+        #Use the telemetry stream if it streams the registers and is up to date
+        buffer = self.pump.stream_buffer
+        if (buffer != None and self.pump._stream_thread != None
+                and all(r in buffer.registers for r in self.registers)):
+            sample = buffer.latest()
+            if sample != None and time.time() - sample[0] < self.period:
+                return [float(sample[1][buffer.registers.index(r)]) for r in self.registers]
+        status = self.pump.read_registers(self.registers)
+        return [float(status[r]) for r in self.registers]
+
+    def _write_target(self, target):
+        target = int(round(target))
+        if self._target != None and abs(target - self._target) < self.deadband:
+            return
+        self.pump.set_target(target, verify='ack')
+        self._target = target
+        self.writes += 1
+
+    def step(self, t, dt):
+        """
+        Run one control cycle at time `t` seconds since the start.
+
+        """
+        if self.max_pressure == None:
+            self.max_pressure = self.pump.get_pressure()[1]
+        setpoint = self.profile(t)
+        values = self._read()
+        pressure = values[0]
+        if self.flow_reader != None:
+            flow = self.flow_reader()
+        elif self.flow_register != None:
+            flow = values[1] * self.flow_scale
+        else:
+            flow = pressure / self.resistance
+        error = setpoint - flow
+        target = setpoint * self.resistance + self.kp * error + self.ki * (self._integral + error * dt)
+        #Only integrate while the target is not limited (anti windup)
+        if 0 <= target <= self.max_pressure:
+            self._integral += error * dt
+        target = min(max(target, 0), self.max_pressure)
+        self._write_target(target)
+        return setpoint, flow, pressure, target
+
+    def start(self):
+        """
+        Start pumping in pressure control mode and run the controller in a
+        background thread until stop() is called.
+
+        """
+        if self._thread != None:
+            raise Exception('{}: Flow controller already running'.format(self.pump.name))
+        if self.max_pressure == None:
+            self.max_pressure = self.pump.get_pressure()[1]
+        self.pump.set_pressure_control()
+        self._target = None
+        self._integral = 0.0
+        self.error = None
+        self._write_target(min(self.profile(0) * self.resistance, self.max_pressure))
+        self.pump.start_flow()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='{}_flow_control'.format(self.pump.name),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        start = time.monotonic()
+        next_cycle = start
+        previous = start
+        while not self._stop.is_set():
+            now = time.monotonic()
+            jitter = now - next_cycle
+            try:
+                setpoint, flow, pressure, target = self.step(now - start, now - previous)
+            except PumpCommunicationError:
+                #Skip the cycle, the next one uses fresh data
+                self.errors += 1
+                setpoint = flow = pressure = target = float('nan')
+            except Exception as e:
+                #Pump error, stop controlling
+                self.errors += 1
+                self.error = e
+                print('{}: Flow control stopped: {}'.format(self.pump.name, e))
+                return
+            previous = now
+            done = time.monotonic()
+            latency = done - now
+            self.cycles += 1
+            if latency > self.period:
+                self.overruns += 1
+            self.history.append((now - start, setpoint, flow, pressure, target, jitter, latency))
+
+            next_cycle += self.period
+            if next_cycle < done:
+                #Overrun: skip the missed cycles instead of catching up
+                next_cycle = done + self.period - ((done - next_cycle) % self.period)
+            self._stop.wait(next_cycle - time.monotonic())
+
+    def stop(self, idle=True):
+        """
+        Stop the controller. Raises the exception that stopped the controller
+        early, if any.
+        Input:
+        `idle`(bool): Also set the pump to idle.
+
+        """
+        self._stop.set()
+        if self._thread != None:
+            self._thread.join()
+            self._thread = None
+        if idle:
+            self.pump.set_idle()
+        if self.error != None:
+            raise self.error
+
+    def run(self, duration, idle=True):
+        """
+        Run the controller for `duration` seconds, then stop. Blocks until
+        finished. Returns the report.
+
+        """
+        self.start()
+        try:
+            time.sleep(duration)
+        finally:
+            self.stop(idle)
+        return self.report()
+
+    def report(self):
+        """
+        Returns the timing and tracking performance of the controller:
+        cycles, overruns, writes, errors, the jitter and latency of the cycles
+        (mean, p50, p99, max in ms) and the root mean square flow error in
+        pl/s, over the cycles in the history.
+
+        """
+        report = {'cycles': self.cycles, 'overruns': self.overruns,
+                  'writes': self.writes, 'errors': self.errors}
+        if not self.history:
+            return report
+        data = np.array(self.history, dtype=np.float64)
+        for name, column in (('jitter', 5), ('latency', 6)):
+            ms = data[:, column] * 1000
+            report[name + '_ms'] = {
+                'mean': float(ms.mean()),
+                'p50': float(np.percentile(ms, 50)),
+                'p99': float(np.percentile(ms, 99)),
+                'max': float(ms.max()),
+                }
+        errors = data[:, 1] - data[:, 2]
+        report['flow_rms_error'] = float(np.sqrt(np.nanmean(errors ** 2)))
+        return report
@@ -0,0 +1,251 @@
+"""
+Recording of pump telemetry to compact binary files.
+
+A recording file has a fixed size header followed by one column per field:
+the timestamps (float64) and the raw value of every register (uint32, as send
+by the pump). The file is allocated for `capacity` samples when it is
+created, so every column has a fixed place in the file and can be read as a
+NumPy array directly from the memory map, also while the file is still being
+written. When a file is full, recording continues in a new file with the same
+name and a number, like run.1.ppr, run.2.ppr.
+
+Usage:
+    recorder = TelemetryRecorder('run.ppr')
+    my_pump.start_stream(RECORD_REGISTERS, rate_hz=10, recorder=recorder)
+    ...
+    recording = TelemetryFile('run.ppr')
+    times, chamber = recording.times, recording[66]
+
+"""
+import os
+import mmap
+import time
+import struct
+import numpy as np
+
+
+MAGIC = b'PPUMPREC'
+VERSION = 1
+#Magic, version, number of registers, capacity, sample count, start time
+HEADER = struct.Struct('<8sIIQQd')
+COUNT_OFFSET = 24
+ALIGNMENT = 4096
+TIME_DTYPE = np.dtype('<f8')
+VALUE_DTYPE = np.dtype('<u4')
+
+#Pressures, temperatures, control type, target, mode and error code
+RECORD_REGISTERS = [64, 65, 66, 67, 68, 69, 77, 79, 81, 82]
+
+
+def _layout(n_registers, capacity):
+    #Offsets of the time column and of the register columns
+    header_size = HEADER.size + 4 * n_registers
+    data_start = -(-header_size // ALIGNMENT) * ALIGNMENT
+    offsets = [data_start]
+    position = data_start + capacity * TIME_DTYPE.itemsize
+    for _ in range(n_registers):
+        position = -(-position // 8) * 8
+        offsets.append(position)
+        position += capacity * VALUE_DTYPE.itemsize
+    return offsets, position
+
+def part_path(path, part):
+    """
+    Returns the file name of part `part` of a recording. Part 0 is `path`
+    itself, part 1 of 'run.ppr' is 'run.1.ppr'.
+
+    """
+    if part == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, part, extension)
+
+class TelemetryRecorder():
+    """
+    Appends timestamped register samples to a recording file. Only the
+    current sample is held in memory; the data is written to the memory
+    mapped file and flushed to disk every `flush_interval` seconds. Only one
+    thread should append to a recorder.
+
+    """
+
+    def __init__(self, path, registers=RECORD_REGISTERS, capacity=1000000, flush_interval=1,
+                 rollover=True):
+        """
+        Input:
+        `path`(str): File name of the recording. An existing recording with
+            this name is overwritten.
+        `registers`(list): Register addresses in each sample. When used with
+            start_stream(), these must be the streamed registers.
+        `capacity`(int): Number of samples per file. The file size is about
+            capacity * (8 + 4 * number of registers) bytes.
+        `flush_interval`(float): Time in seconds between writes to disk.
+        `rollover`(bool): Continue in a new file when the file is full. If
+            False, samples are dropped when the file is full.
+
+        """
+        self.path = path
+        self.registers = list(registers)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.rollover = rollover
+        self.part = 0
+        self.dropped = 0
+        self.paths = []
+        self._mm = None
+        #Remove the parts of an earlier recording with the same name
+        part = 1
+        while os.path.exists(part_path(path, part)):
+            os.remove(part_path(path, part))
+            part += 1
+        self._open(path)
+
+    def _open(self, path):
+        offsets, size = _layout(len(self.registers), self.capacity)
+        with open(path, 'w+b') as f:
+            #The file is sparse, disk space is only used for written samples
+            f.truncate(size)
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.registers), self.capacity, 0, time.time()))
+            f.write(np.asarray(self.registers, dtype='<u4').tobytes())
+            f.flush()
+            self._mm = mmap.mmap(f.fileno(), size)
+        self._time = np.frombuffer(self._mm, TIME_DTYPE, self.capacity, offsets[0])
+        self._values = [np.frombuffer(self._mm, VALUE_DTYPE, self.capacity, o) for o in offsets[1:]]
+        self.paths.append(path)
+        self.count = 0
+        self._last_flush = time.monotonic()
+
+    def append(self, timestamp, values):
+        """
+        Add one sample.
+        Input:
+        `timestamp`(float): Time of the sample, like time.time().
+        `values`(list): Raw value of every register, in the order of
+            `registers`.
+
+        """
+        if self._mm == None:
+            raise ValueError('Recorder of {} is closed'.format(self.path))
+        if self.count == self.capacity:
+            if not self.rollover:
+                self.dropped += 1
+                return
+            self._close_file()
+            self.part += 1
+            self._open(part_path(self.path, self.part))
+        i = self.count
+        self._time[i] = timestamp
+        for column, value in zip(self._values, values):
+            column[i] = value & 0xFFFFFFFF
+        #Publish the sample only after it is completely written
+        self.count = i + 1
+        struct.pack_into('<Q', self._mm, COUNT_OFFSET, self.count)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the recorded samples to disk.
+
+        """
+        if self._mm != None:
+            self._mm.flush()
+        self._last_flush = time.monotonic()
+
+    def _close_file(self):
+        self._mm.flush()
+        #Release the views before closing the map
+        self._time = None
+        self._values = []
+        self._mm.close()
+        self._mm = None
+
+    def close(self):
+        """
+        Flush and close the recording.
+
+        """
+        if self._mm != None:
+            self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TelemetryFile():
+    """
+    Read a recording file without copying the data. The columns are NumPy
+    views on the memory mapped file and only contain the samples that were
+    completely written when they are requested, so the file can be read while
+    the pump is still recording.
+
+    """
+
+    def __init__(self, path):
+        """
+        Input:
+        `path`(str): File name of the recording.
+
+        """
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, n_registers, self.capacity, _, self.start_time = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a P-pump recording'.format(path))
+        self.registers = [int(r) for r in np.frombuffer(self._map, '<u4', n_registers, HEADER.size)]
+        offsets, _ = _layout(n_registers, self.capacity)
+        self._time = np.frombuffer(self._map, TIME_DTYPE, self.capacity, offsets[0])
+        self._values = {r: np.frombuffer(self._map, VALUE_DTYPE, self.capacity, o)
+                        for r, o in zip(self.registers, offsets[1:])}
+
+    def __len__(self):
+        return struct.unpack_from('<Q', self._map, COUNT_OFFSET)[0]
+
+    @property
+    def times(self):
+        """
+        Timestamps of the samples.
+
+        """
+        return self._time[:len(self)]
+
+    def __getitem__(self, register):
+        """
+        Raw values of `register`, like recording[66] for the chamber pressure.
+
+        """
+        return self._values[register][:len(self)]
+
+    def window(self, seconds):
+        """
+        Returns the samples of the last `seconds` seconds as (times, values),
+        with one column per register in `values`. The values are copied.
+
+        """
+        n = len(self)
+        times = self._time[:n]
+        start = np.searchsorted(times, times[-1] - seconds, side='left') if n else 0
+        values = np.column_stack([self._values[r][start:n] for r in self.registers])
+        return times[start:], values
+
+def load_recording(path):
+    """
+    Read all parts of a recording into memory.
+    Returns:
+    `times`(array): Timestamps of all samples.
+    `values`(dict): Array of raw values per register address.
+
+    """
+    parts = []
+    part = 0
+    while os.path.exists(part_path(path, part)):
+        parts.append(TelemetryFile(part_path(path, part)))
+        part += 1
+    if len(parts) == 0:
+        raise FileNotFoundError(path)
+    times = np.concatenate([p.times for p in parts])
+    values = {r: np.concatenate([p[r] for p in parts]) for r in parts[0].registers}
+    return times, values
@@ -0,0 +1,526 @@
+"""
+Pump server: one process owns the serial ports and serves the pumps to other
+local processes over a Unix domain socket. Clients use RemotePump, which has
+the same methods as P_pump, and can subscribe to telemetry. Identical reads
+that arrive at the same time from different clients are combined into one
+exchange with the pump.
+
+Usage, server:
+    python Py_P_Pump_server.py --socket /tmp/ppump.sock --address /dev/ttyUSB0 --pump-ids 1 2
+
+Usage, client:
+    pump = RemotePump('/tmp/ppump.sock', '/dev/ttyUSB0_1')
+    pump.set_pressure(100)
+    pump.subscribe([66], rate_hz=10, callback=print)
+
+Messages are JSON objects, one per line. A request is
+{"id": 1, "pump": name, "method": "get_pressure", "args": [], "kwargs": {}},
+the response {"id": 1, "result": ...} or {"id": 1, "error": {...}}.
+Telemetry samples are send as {"sample": subscription id, "time": t,
+"values": [...]}.
+
+"""
+import os
+import stat
+import json
+import socket
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+import Py_P_Pump
+from Py_P_Pump import (PumpStatus, PumpError, PumpCommunicationError, PumpTimeoutError,
+                       ERROR_EXCEPTIONS)
+
+
+#Methods of P_pump that clients can call. Reads can be combined when they
+#arrive at the same time.
+READ_METHODS = ('get_mode', 'get_control_type', 'get_target', 'get_sensor', 'get_temp',
+                'get_pressure', 'get_status', 'read_registers')
+WRITE_METHODS = ('start_flow', 'set_idle', 'set_target', 'set_flow_control',
+                 'set_pressure_control', 'set_flow', 'set_pressure', 'tare', 'leak_test')
+SERVED_METHODS = READ_METHODS + WRITE_METHODS
+#Methods that can take longer than the timeout of the client: a hold, a tare
+#or a leak test
+LONG_METHODS = ('set_flow', 'set_pressure', 'tare', 'leak_test')
+
+#Exceptions that are recreated by the client, other errors become Exception
+_EXCEPTION_TYPES = {cls.__name__: cls for cls in
+                    [PumpCommunicationError, PumpTimeoutError, ValueError, KeyError]}
+_PUMP_ERROR_TYPES = {cls.__name__: cls for cls in set(ERROR_EXCEPTIONS.values())}
+_PUMP_ERROR_TYPES['PumpError'] = PumpError
+
+
+def _encode(value):
+    #Results that are not plain JSON
+    if isinstance(value, PumpStatus):
+        return {'__status__': [value.registers, [value.values[r] for r in value.registers],
+                               value.timestamp]}
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+def _decode(value):
+    if isinstance(value, dict) and '__status__' in value:
+        registers, values, timestamp = value['__status__']
+        return PumpStatus(registers, values, timestamp)
+    return value
+
+def _error(e):
+    error = {'type': type(e).__name__, 'message': str(e)}
+    if isinstance(e, PumpError):
+        #Without the pump name, which is added again by the client
+        error['message'] = e.message
+        error['code'] = e.code
+        error['name'] = e.name
+    return error
+
+def _raise(error):
+    if error['type'] in _PUMP_ERROR_TYPES:
+        raise _PUMP_ERROR_TYPES[error['type']](error.get('code'), error.get('name'),
+                                                message=error['message'])
+    raise _EXCEPTION_TYPES.get(error['type'], Exception)(error['message'])
+
+class _Connection():
+    #A connected socket that sends and receives JSON lines
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode()
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.file.close()
+        self.sock.close()
+
+class _Subscription():
+    def __init__(self, subscription_id, connection, registers, rate_hz):
+        self.id = subscription_id
+        self.connection = connection
+        self.registers = list(registers)
+        self.period = 1 / rate_hz if rate_hz else 0
+        #Sample time at which the next sample is due
+        self.next_due = None
+
+class PumpServer():
+    """
+    Serve P_pump objects to other processes on a Unix domain socket.
+    Every request runs in a thread pool, so a long command (like a tare) of
+    one client does not block the others. Identical reads that are waiting
+    at the same time share one exchange with the pump. For telemetry, one
+    stream per pump reads the registers of all its subscriptions, see
+    P_pump.start_stream().
+
+    """
+
+    def __init__(self, path, pumps, max_workers=32):
+        """
+        Input:
+        `path`(str): File name of the socket. An existing socket file is
+            replaced, any other existing file raises a FileExistsError.
+        `pumps`(dict, list or PumpFleet): The pumps to serve. A dictionary
+            maps the names used by the clients to P_pump objects, otherwise
+            the names of the pumps are used.
+        `max_workers`(int): Maximum number of requests that run at the same
+            time.
+
+        """
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError('{} exists and is not a socket'.format(path))
+            os.remove(path)
+        if isinstance(pumps, dict):
+            self.pumps = dict(pumps)
+        elif isinstance(pumps, Py_P_Pump.PumpFleet):
+            self.pumps = dict(pumps.pumps)
+        else:
+            self.pumps = {str(p.name): p for p in pumps}
+        self.path = path
+        self.requests = 0
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='PumpServer')
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._subscriptions = {name: {} for name in self.pumps}
+        self._subscription_lock = threading.Lock()
+        self._next_subscription = 0
+        self._publishers = {}
+        self._connections = set()
+        self._closed = threading.Event()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen()
+        self._thread = None
+
+    def start(self):
+        """
+        Serve in a background thread. Returns the server.
+
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='PumpServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Accept clients until close() is called.
+
+        """
+        while not self._closed.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break
+            connection = _Connection(sock)
+            self._connections.add(connection)
+            threading.Thread(target=self._serve_client, args=(connection,),
+                             name='PumpServer_client', daemon=True).start()
+
+    def _serve_client(self, connection):
+        try:
+            while True:
+                try:
+                    request = connection.receive()
+                except (OSError, ValueError):
+                    break
+                if request == None:
+                    break
+                self.requests += 1
+                self._executor.submit(self._handle, connection, request)
+        finally:
+            self._unsubscribe_all(connection)
+            self._connections.discard(connection)
+            connection.close()
+
+    def _handle(self, connection, request):
+        response = {'id': request.get('id')}
+        try:
+            response['result'] = _encode(self._call(connection, request))
+        except Exception as e:
+            response['error'] = _error(e)
+        try:
+            connection.send(response)
+        except OSError:
+            pass
+
+    def _call(self, connection, request):
+        method = request.get('method')
+        args = request.get('args', [])
+        kwargs = request.get('kwargs', {})
+        if method == 'list':
+            return sorted(self.pumps)
+        if method == 'stats':
+            return {'requests': self.requests, 'coalesced': self.coalesced,
+                    'clients': len(self._connections)}
+        pump = self.pumps[request['pump']]
+        if method == 'subscribe':
+            return self._subscribe(connection, request['pump'], *args, **kwargs)
+        if method == 'unsubscribe':
+            return self._unsubscribe(request['pump'], *args)
+        if method not in SERVED_METHODS:
+            raise ValueError('{}: Method {} is not served'.format(request['pump'], method))
+        if method in READ_METHODS:
+            return self._read(pump, method, args, kwargs)
+        if method in ('set_flow', 'set_pressure'):
+            #With wait=False the hold runs on in the server and the client
+            #gets the answer directly
+            getattr(pump, method)(*args, **kwargs)
+            return None
+        if method in ('tare', 'leak_test'):
+            return getattr(pump, method)(*args, **kwargs).result()
+        return getattr(pump, method)(*args, **kwargs)
+
+    def _read(self, pump, method, args, kwargs):
+        #Identical reads that are waiting at the same time share one exchange
+        key = (id(pump), method, json.dumps([args, kwargs], sort_keys=True))
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future == None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(getattr(pump, method)(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+        return future.result()
+
+    #_TELEMETRY_______________________________________________________________
+    def _subscribe(self, connection, name, registers, rate_hz=10):
+        with self._subscription_lock:
+            self._next_subscription += 1
+            subscription = _Subscription(self._next_subscription, connection, registers, rate_hz)
+            self._subscriptions[name][subscription.id] = subscription
+            self._restart_stream(name)
+        return subscription.id
+
+    def _unsubscribe(self, name, subscription_id):
+        with self._subscription_lock:
+            removed = self._subscriptions[name].pop(subscription_id, None) != None
+            self._restart_stream(name)
+        return removed
+
+    def _unsubscribe_all(self, connection):
+        with self._subscription_lock:
+            for name, subscriptions in self._subscriptions.items():
+                ids = [i for i, s in subscriptions.items() if s.connection is connection]
+                for i in ids:
+                    del subscriptions[i]
+                if ids:
+                    self._restart_stream(name)
+
+    def _restart_stream(self, name):
+        #One stream per pump with the registers of all subscriptions, at the
+        #highest requested rate
+        pump = self.pumps[name]
+        publisher = self._publishers.pop(name, None)
+        if publisher != None:
+            publisher[1].set()
+            publisher[0].join()
+        pump.stop_stream()
+        subscriptions = list(self._subscriptions[name].values())
+        if not subscriptions:
+            return
+        registers = sorted(set(r for s in subscriptions for r in s.registers))
+        periods = [s.period for s in subscriptions]
+        rate_hz = None if 0 in periods else 1 / min(periods)
+        buffer = pump.start_stream(registers, rate_hz=rate_hz)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._publish, args=(name, buffer, subscriptions, stop),
+                                  name='PumpServer_{}_telemetry'.format(name), daemon=True)
+        self._publishers[name] = (thread, stop)
+        thread.start()
+
+    def _publish(self, name, buffer, subscriptions, stop):
+        columns = {s.id: [buffer.registers.index(r) for r in s.registers] for s in subscriptions}
+        period = min([s.period for s in subscriptions if s.period] or [0.01])
+        sent = buffer.count
+        while not stop.wait(period / 2):
+            count = buffer.count
+            if count == sent:
+                continue
+            times, values = buffer.last(min(count - sent, buffer.capacity))
+            sent = count
+            for t, row in zip(times, values):
+                for s in subscriptions:
+                    #Paced on a fixed grid, with half a period tolerance so
+                    #that samples that arrive slightly early are not skipped
+                    if s.next_due != None and t < s.next_due - s.period / 2:
+                        continue
+                    if s.next_due == None or t - s.next_due >= s.period:
+                        #First sample, or the stream fell behind
+                        s.next_due = t + s.period
+                    else:
+                        s.next_due += s.period
+                    try:
+                        s.connection.send({'sample': s.id, 'time': float(t),
+                                           'values': [int(row[i]) for i in columns[s.id]]})
+                    except OSError:
+                        pass
+
+    def close(self):
+        """
+        Stop serving, stop the telemetry streams and remove the socket file.
+        The pumps are not closed.
+
+        """
+        self._closed.set()
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+        with self._subscription_lock:
+            for name in self._subscriptions:
+                self._subscriptions[name] = {}
+                self._restart_stream(name)
+        for connection in list(self._connections):
+            connection.close()
+        self._executor.shutdown()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class RemotePump():
+    """
+    Client of a PumpServer with the same methods as P_pump: get_mode(),
+    get_pressure(), set_pressure(), tare(), etc. Pump errors are raised as
+    the same exception types. Like on P_pump, set_flow() and set_pressure()
+    wait until the hold is over, unless `wait` is False; then the hold runs
+    on in the server. tare() and leak_test() wait for the result.
+    Usage:
+        pump = RemotePump('/tmp/ppump.sock', 'Pump_1')
+        pump.set_pressure(100, hold='00:00:00:10')
+
+    """
+
+    def __init__(self, path, name, timeout=30):
+        """
+        Input:
+        `path`(str): File name of the server socket.
+        `name`(str): Name of the pump on the server, see pumps().
+        `timeout`(float): Time in seconds to wait for the answer of the
+            server, None to wait without limit. Not used for holds, tares
+            and leak tests that are waited for.
+
+        """
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self._connection = _Connection(sock)
+        self._pending = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read, name='RemotePump_{}'.format(name), daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                message = self._connection.receive()
+            except (OSError, ValueError):
+                message = None
+            if message == None:
+                break
+            if 'sample' in message:
+                callback = self._callbacks.get(message['sample'])
+                if callback != None:
+                    callback(message['time'], message['values'])
+                continue
+            future = self._pending.pop(message.get('id'), None)
+            if future != None:
+                future.set_result(message)
+        #Connection closed, fail the waiting requests
+        for future in list(self._pending.values()):
+            future.set_exception(PumpCommunicationError('Connection to the pump server closed'))
+        self._pending.clear()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a method of the pump on the server and return the result.
+
+        """
+        future = Future()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = future
+        try:
+            self._connection.send({'id': request_id, 'pump': self.name, 'method': method,
+                                   'args': list(args), 'kwargs': kwargs})
+        except OSError as e:
+            self._pending.pop(request_id, None)
+            raise PumpCommunicationError('Pump server not reachable: {}'.format(e))
+        timeout = self.timeout
+        if method in LONG_METHODS and kwargs.get('wait', True):
+            timeout = None
+        try:
+            response = future.result(timeout)
+        except TimeoutError:
+            self._pending.pop(request_id, None)
+            raise PumpTimeoutError('{}: No answer of the pump server within {}s'.format(self.name, timeout))
+        if 'error' in response:
+            _raise(response['error'])
+        return _decode(response['result'])
+
+    def __getattr__(self, method):
+        if method in SERVED_METHODS:
+            return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+        raise AttributeError(method)
+
+    def pumps(self):
+        """
+        Returns the names of the pumps on the server.
+
+        """
+        return self.call('list')
+
+    def subscribe(self, registers, rate_hz=10, callback=None):
+        """
+        Receive the raw values of `registers` about `rate_hz` times per
+        second.
+        Input:
+        `registers`(list): Register addresses.
+        `rate_hz`(float): Samples per second, None for as fast as possible.
+        `callback`(function): Called with the timestamp and the list of
+            values of every sample, from the client thread.
+        Returns:
+        `subscription`(int): Id to use with unsubscribe().
+
+        """
+        subscription = self.call('subscribe', list(registers), rate_hz)
+        self._callbacks[subscription] = callback
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._callbacks.pop(subscription, None)
+        return self.call('unsubscribe', subscription)
+
+    def close(self):
+        """
+        Close the connection. The pump keeps running on the server.
+
+        """
+        self._connection.close()
+        self._reader.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve P-pumps to local processes.')
+    parser.add_argument('--socket', default='/tmp/ppump.sock', help='File name of the server socket.')
+    parser.add_argument('--address', help='Serial port of the pumps.')
+    parser.add_argument('--identifier', help='Find all pumps on the ports that match the identifier.')
+    parser.add_argument('--pump-ids', type=int, nargs='+', default=[0], help='Pump ids on --address.')
+    parser.add_argument('--simulate', type=int, default=0, help='Serve this number of simulated pumps.')
+    parser.add_argument('--verify', default='readback', choices=Py_P_Pump.VERIFY_POLICIES)
+    args = parser.parse_args(argv)
+
+    bus = None
+    if args.simulate:
+        import Py_P_Pump_bench
+        pumps, bus = Py_P_Pump_bench.simulated_pumps(list(range(1, args.simulate + 1)), verify=args.verify)
+    elif args.identifier:
+        pumps = Py_P_Pump.PumpFleet.discover(args.identifier, verify=args.verify)
+    elif args.address:
+        if len(args.pump_ids) == 1:
+            pumps = [Py_P_Pump.P_pump(args.address, name='{}_{}'.format(args.address, args.pump_ids[0]),
+                                      pump_id=args.pump_ids[0], verbose=False, verify=args.verify)]
+        else:
+            bus = Py_P_Pump.PumpBus(args.address)
+            pumps = [Py_P_Pump.P_pump(name='{}_{}'.format(args.address, i), pump_id=i, verbose=False,
+                                      bus=bus, verify=args.verify) for i in args.pump_ids]
+    else:
+        parser.error('Give --address, --identifier or --simulate')
+
+    server = PumpServer(args.socket, pumps)
+    print('Serving {} on {}'.format(', '.join(sorted(server.pumps)), args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if bus != None:
+            bus.close()
+
+if __name__ == "__main__":
+    main()
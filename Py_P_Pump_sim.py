@@ -0,0 +1,539 @@
+import os
+import math
+import time
+import random
+import struct
+import threading
+import heapq
+from Py_P_Pump_codec import FRAME_LENGTH, START_BYTE, xor_checksum
+
+
+#Response message types
+READ_RESPONSE = 1
+WRITE_ACK = 2
+ERROR_RESPONSE = 3
+
+#Error codes of an error response (byte 3)
+CHECKSUM_ERROR = 1
+UNKNOWN_COMMAND = 2
+INVALID_DATA = 3
+
+#Values written to register 78 to request a pump mode
+REQUEST_IDLE = 0
+REQUEST_CONTROL = 1
+REQUEST_TARE = 2
+#The leak test request of the real pump is not documented, this is the value
+#the simulator uses. Give it to P_pump.leak_test(request=REQUEST_LEAK_TEST).
+REQUEST_LEAK_TEST = 3
+
+#Registers that can be written
+WRITABLE_REGISTERS = (77, 78, 79)
+
+#Kinds of faults that can be injected, see SimulatedBus.inject_fault()
+FAULTS = ('checksum', 'timeout', 'drop', 'garbage')
+
+
+class SimulatedPump():
+    """
+    Simulated Dolomite Mitos P-pump. Keeps the registers of the pump and
+    models the chamber pressure as a first order system that follows the
+    target. The state is updated when the pump is asked for a value, based on
+    the time since the last update.
+    Supported registers:
+        64-66: Atmospheric (0.1 mbar), Supply and Chamber pressure (mbar)
+        67-69: Temperature of the pressure sensors (0.1 C)
+        77: Control type, 0 = pressure, 1 = flow
+        78: Requested mode, 0 = idle, 1 = control, 2 = tare, 3 = leak test
+        79: Target, mbar or pl/s
+        81: Mode, 0 = idle, 1 = control, 2 = tare, 3 = error, 4 = leak test
+        82: Error code, see Py_P_Pump.ERROR_CODES
+        88: Flow sensor type, see Py_P_Pump.SENSOR_TYPES
+
+    """
+
+    def __init__(self, pump_id=1, atmospheric=1013.0, supply=2000, max_supply=10000,
+                 max_target=None, temperature=25.0, sensor=0, tau=0.2,
+                 resistance=0.01, tare_time=15, leak_test_time=10,
+                 control_start_time=None, supply_connected=False):
+        """
+        Input:
+        `pump_id`(int): Address of the pump on the bus.
+        `atmospheric`(float): Atmospheric pressure in mbar.
+        `supply`(int): Supply pressure in mbar gauge.
+        `max_supply`(int): Supply pressure above which the pump is in error.
+        `max_target`(int): Highest valid target, defaults to the supply
+            pressure.
+        `temperature`(float): Temperature of all sensors in Celsius.
+        `sensor`(int): Installed flow sensor type, 0 for none.
+        `tau`(float): Time constant in seconds of the chamber pressure.
+        `resistance`(float): Flow resistance of the fluidic system in
+            mbar per pl/s, used in flow control.
+        `tare_time`(float): Duration of a tare in seconds.
+        `leak_test_time`(float): Duration of a leak test in seconds.
+        `control_start_time`(float): If given, starting control mode fails
+            with error 4 after this many seconds. Used to simulate a blocked
+            chamber.
+        `supply_connected`(bool): If True, a tare fails with error 3.
+
+        """
+        self.pump_id = pump_id
+        self.atmospheric = atmospheric
+        self.supply = supply
+        self.max_supply = max_supply
+        self.max_target = max_target
+        self.temperature = temperature
+        self.sensor = sensor
+        self.tau = tau
+        self.resistance = resistance
+        self.tare_time = tare_time
+        self.leak_test_time = leak_test_time
+        self.control_start_time = control_start_time
+        self.supply_connected = supply_connected
+        self.chamber = 0.0
+        self.control_type = 0
+        self.target = 0
+        self.mode = 0
+        self.error = 0
+        self._mode_end = None
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def fail(self, error):
+        """
+        Put the pump in error mode with the given error code.
+
+        """
+        with self._lock:
+            self._fail(error)
+
+    def _fail(self, error):
+        self.mode = 3
+        self.error = error
+        self._mode_end = None
+
+    def _goal(self):
+        if self.mode != 1:
+            return 0.0
+        if self.control_type == 0:
+            return min(self.target, self.supply)
+        return min(self.target * self.resistance, self.supply)
+
+    def update(self, now=None):
+        """
+        Advance the simulation to `now` (time.monotonic() seconds).
+
+        """
+        if now == None:
+            now = time.monotonic()
+        dt = now - self._last_update
+        self._last_update = now
+        if self.supply > self.max_supply and self.mode != 3:
+            self._fail(1)
+        if self._mode_end != None and now >= self._mode_end:
+            if self.mode == 2:
+                self.mode = 0
+            elif self.mode == 4:
+                self.mode = 0
+            elif self.mode == 1:
+                #Control did not start within the control start time
+                self._fail(4)
+            self._mode_end = None
+        if self.mode == 1 and self.control_type == 1 and self.sensor == 0:
+            self._fail(9)
+        if self.tau > 0:
+            self.chamber += (self._goal() - self.chamber) * (1 - math.exp(-dt / self.tau))
+        else:
+            self.chamber = self._goal()
+
+    def read(self, register):
+        """
+        Returns the raw value of a register, or None if it does not exist.
+
+        """
+        with self._lock:
+            self.update()
+            values = {
+                64: int(round(self.atmospheric * 10)),
+                65: int(self.supply),
+                66: int(round(self.chamber)),
+                67: int(round(self.temperature * 10)),
+                68: int(round(self.temperature * 10)),
+                69: int(round(self.temperature * 10)),
+                77: self.control_type,
+                78: self.mode if self.mode in (0, 1, 2) else 0,
+                79: self.target,
+                81: self.mode,
+                82: self.error,
+                88: self.sensor,
+                }
+            return values.get(register)
+
+    def write(self, register, value):
+        """
+        Write a register. Returns False if the register can not be written or
+        the value is out of range.
+
+        """
+        with self._lock:
+            self.update()
+            now = time.monotonic()
+            if register == 77:
+                if value not in (0, 1):
+                    return False
+                self.control_type = value
+            elif register == 79:
+                max_target = self.supply if self.max_target == None else self.max_target
+                self.target = value
+                if self.mode == 1 and self.control_type == 0:
+                    if value < 0:
+                        self._fail(5)
+                    elif value > max_target:
+                        self._fail(6)
+            elif register == 78:
+                if value == REQUEST_IDLE:
+                    self.mode = 0
+                    self._mode_end = None
+                elif value == REQUEST_CONTROL:
+                    if self.mode == 3:
+                        return True
+                    max_target = self.supply if self.max_target == None else self.max_target
+                    if self.control_type == 0 and self.target < 0:
+                        self._fail(5)
+                    elif self.control_type == 0 and self.target > max_target:
+                        self._fail(6)
+                    elif self.control_type == 1 and self.sensor == 0:
+                        self._fail(9)
+                    else:
+                        self.mode = 1
+                        self.error = 0
+                        if self.control_start_time != None:
+                            self._mode_end = now + self.control_start_time
+                elif value == REQUEST_TARE:
+                    if self.supply_connected:
+                        self._fail(3)
+                    else:
+                        self.mode = 2
+                        self.error = 0
+                        self._mode_end = now + self.tare_time
+                elif value == REQUEST_LEAK_TEST:
+                    if self.supply < self.target:
+                        self._fail(7)
+                    else:
+                        self.mode = 4
+                        self.error = 0
+                        self._mode_end = now + self.leak_test_time
+                else:
+                    return False
+            else:
+                return False
+            return True
+
+
+def build_frame(pump_id, message_type, byte3=0, location=0, value=0):
+    """
+    Build a 12 byte response frame as send by the pump.
+
+    """
+    frame = bytearray(11)
+    frame[0] = START_BYTE
+    frame[1] = pump_id
+    frame[2] = message_type
+    frame[3] = byte3
+    frame[4] = location
+    frame[7:11] = struct.pack('>I', value & 0xFFFFFFFF)
+    frame.append(xor_checksum(frame))
+    return bytes(frame)
+
+
+class SimulatedBus():
+    """
+    Serial line with one or more simulated pumps. Receives the bytes written
+    by the host, answers complete messages like the real pumps do, and
+    schedules the responses after the configured latency. Faults can be
+    injected to test the error handling of the driver.
+
+    """
+
+    def __init__(self, pumps=None, latency=0.0005, baudrate=115200, seed=None):
+        """
+        Input:
+        `pumps`(list): SimulatedPump objects on the bus. Defaults to one pump
+            with pump_id 1 that also answers to pump_id 0.
+        `latency`(float): Time in seconds the pumps take to answer a message.
+        `baudrate`(int): Speed of the simulated line, used to add the
+            transmission time of each message. None for no transmission time.
+        `seed`(int): Seed of the random fault generator.
+
+        """
+        if pumps == None:
+            pumps = [SimulatedPump(pump_id=1)]
+        self.pumps = {p.pump_id: p for p in pumps}
+        self.latency = latency
+        self.baudrate = baudrate
+        self.received = 0
+        self.answered = 0
+        self.fault_rates = {}
+        self._faults = []
+        self._random = random.Random(seed)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+
+    def add_pump(self, pump):
+        self.pumps[pump.pump_id] = pump
+        return pump
+
+    def inject_fault(self, kind, count=1, rate=None):
+        """
+        Disturb the next responses of the pumps.
+        Input:
+        `kind`(str): 'checksum' to corrupt the checksum, 'timeout' to not
+            respond, 'drop' to drop one byte of the response, 'garbage' to
+            send random bytes before the response.
+        `count`(int): Number of responses to disturb.
+        `rate`(float): Instead of `count`, disturb this fraction of all
+            following responses at random. 0 to stop.
+
+        """
+        if kind not in FAULTS:
+            raise ValueError('{} is not a valid fault. Choose from: {}'.format(kind, FAULTS))
+        with self._lock:
+            if rate != None:
+                self.fault_rates[kind] = rate
+            else:
+                self._faults.extend([kind] * count)
+
+    def message_time(self, n_bytes=FRAME_LENGTH):
+        #Transmission time of n bytes, 10 bits per byte
+        if not self.baudrate:
+            return 0
+        return n_bytes * 10 / self.baudrate
+
+    def _respond(self, message):
+        if xor_checksum(message) != 0:
+            return build_frame(message[1], ERROR_RESPONSE, CHECKSUM_ERROR)
+        pump_id, message_type, location = message[1], message[2], message[4]
+        if pump_id == 0:
+            pump = next(iter(self.pumps.values()), None)
+        else:
+            pump = self.pumps.get(pump_id)
+        if pump == None:
+            #No pump with this address, nobody answers
+            return b''
+        value = struct.unpack('>i', message[7:11])[0]
+        if message_type == 2:
+            result = pump.read(location)
+            if result == None:
+                return build_frame(pump.pump_id, ERROR_RESPONSE, INVALID_DATA, location)
+            return build_frame(pump.pump_id, READ_RESPONSE, 0, location, result)
+        elif message_type == 1:
+            if pump_id == 0:
+                ok = all([p.write(location, value) for p in self.pumps.values()])
+            else:
+                ok = pump.write(location, value)
+            if not ok:
+                return build_frame(pump.pump_id, ERROR_RESPONSE, INVALID_DATA, location)
+            return build_frame(pump.pump_id, WRITE_ACK, 0, location)
+        return build_frame(pump.pump_id, ERROR_RESPONSE, UNKNOWN_COMMAND)
+
+    def _disturb(self, response):
+        kind = None
+        if self._faults:
+            kind = self._faults.pop(0)
+        else:
+            for k, rate in self.fault_rates.items():
+                if rate and self._random.random() < rate:
+                    kind = k
+                    break
+        if kind == None or not response:
+            return response
+        if kind == 'timeout':
+            return b''
+        response = bytearray(response)
+        if kind == 'checksum':
+            response[-1] ^= 0xFF
+        elif kind == 'drop':
+            del response[self._random.randrange(len(response))]
+        elif kind == 'garbage':
+            noise = bytes(self._random.randrange(256) for _ in range(self._random.randrange(1, 12)))
+            response = bytearray(noise) + response
+        return bytes(response)
+
+    def feed(self, data):
+        """
+        Process bytes written by the host.
+        Returns:
+        `responses`(list): (delay, bytes) for every answered message, with
+            the delay in seconds after the message was received.
+
+        """
+        responses = []
+        with self._lock:
+            self._buffer += data
+            buffer = self._buffer
+            while True:
+                start = buffer.find(START_BYTE)
+                if start < 0:
+                    buffer.clear()
+                    break
+                if start > 0:
+                    del buffer[:start]
+                if len(buffer) < FRAME_LENGTH:
+                    break
+                message = bytes(buffer[:FRAME_LENGTH])
+                del buffer[:FRAME_LENGTH]
+                self.received += 1
+                response = self._disturb(self._respond(message))
+                if response:
+                    self.answered += 1
+                    #Messages are answered one after the other
+                    delay = (len(responses) + 1) * (self.latency + self.message_time())
+                    responses.append((delay, response))
+        return responses
+
+
+class SimulatedSerial():
+    """
+    Stand-in for a pyserial Serial object that is connected to a
+    SimulatedBus. Can be given to P_pump, AsyncP_pump or PumpBus with the
+    `ser` argument:
+        sim = SimulatedSerial(SimulatedBus([SimulatedPump(pump_id=1)]))
+        pump = P_pump(name='Sim', pump_id=1, ser=sim)
+
+    """
+
+    def __init__(self, bus=None, timeout=2):
+        """
+        Input:
+        `bus`(SimulatedBus): Simulated pumps, defaults to a bus with one pump.
+        `timeout`(float): Read timeout in seconds, like pyserial.
+
+        """
+        self.bus = bus if bus != None else SimulatedBus()
+        self.timeout = timeout
+        self.is_open = True
+        self.port = 'simulated'
+        self.bytes_written = 0
+        self._pending = []
+        self._rx = bytearray()
+        self._cond = threading.Condition()
+
+    def _collect(self, now):
+        #Move responses that have arrived to the receive buffer
+        while self._pending and self._pending[0][0] <= now:
+            self._rx += heapq.heappop(self._pending)[2]
+
+    def write(self, data):
+        if not self.is_open:
+            raise IOError('Port is closed')
+        data = bytes(data)
+        self.bytes_written += len(data)
+        now = time.monotonic() + self.bus.message_time(len(data))
+        with self._cond:
+            for delay, response in self.bus.feed(data):
+                heapq.heappush(self._pending, (now + delay, id(response), response))
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout == None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._collect(now)
+                if len(self._rx) >= size:
+                    break
+                wait = None
+                if self._pending:
+                    wait = self._pending[0][0] - now
+                if deadline != None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        break
+                    wait = remaining if wait == None else min(wait, remaining)
+                self._cond.wait(wait)
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            return data
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._collect(time.monotonic())
+            return len(self._rx)
+
+    def read_all(self):
+        return self.read(self.in_waiting)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._collect(time.monotonic())
+            self._rx.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class SimulatedPty():
+    """
+    Simulated pumps behind a pseudo terminal (POSIX only). The `port`
+    attribute is a device name that can be opened like a real serial port,
+    also from another process:
+        sim = SimulatedPty()
+        pump = P_pump(sim.port, pump_id=1)
+
+    """
+
+    def __init__(self, bus=None):
+        """
+        Input:
+        `bus`(SimulatedBus): Simulated pumps, defaults to a bus with one pump.
+
+        """
+        import pty
+        import tty
+        self.bus = bus if bus != None else SimulatedBus()
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._pending = []
+        self._cond = threading.Condition()
+        self._running = True
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._reader.start()
+        self._writer.start()
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            now = time.monotonic() + self.bus.message_time(len(data))
+            with self._cond:
+                for delay, response in self.bus.feed(data):
+                    heapq.heappush(self._pending, (now + delay, id(response), response))
+                self._cond.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._pending or self._pending[0][0] > time.monotonic()):
+                    self._cond.wait(self._pending[0][0] - time.monotonic() if self._pending else None)
+                if not self._running:
+                    return
+                response = heapq.heappop(self._pending)[2]
+            try:
+                os.write(self._master, response)
+            except OSError:
+                return
+
+    def close(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        os.close(self._master)
+        os.close(self._slave)
@@ -0,0 +1,43 @@
+import os
+import sys
+import warnings
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Py_P_Pump
+import Py_P_Pump_sim
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    #Missing acknowledgements of the pump are reported as warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+@pytest.fixture
+def sim():
+    """
+    One simulated pump without pressure dynamics on a fast simulated bus.
+    Returns the SimulatedPump, the SimulatedBus and a function that connects
+    a P_pump to it with the given keyword arguments.
+
+    """
+    pump = Py_P_Pump_sim.SimulatedPump(1, tau=0, tare_time=0.2, leak_test_time=0.2)
+    bus = Py_P_Pump_sim.SimulatedBus([pump], latency=0.0002, baudrate=0, seed=1)
+    pumps = []
+
+    def connect(**kwargs):
+        kwargs.setdefault('timeout', 0.1)
+        kwargs.setdefault('ser', Py_P_Pump_sim.SimulatedSerial(bus))
+        p = Py_P_Pump.P_pump(name='sim', pump_id=1, verbose=False, **kwargs)
+        pumps.append(p)
+        return p
+
+    yield pump, bus, connect
+    for p in pumps:
+        p.stop_watchdog()
+        p.stop_stream()
+        if p.active_hold != None:
+            p.active_hold.cancel(idle=False)
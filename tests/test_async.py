@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import Py_P_Pump
+import Py_P_Pump_sim
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def async_pumps(pump_ids):
+    sim_pumps = [Py_P_Pump_sim.SimulatedPump(i, tau=0) for i in pump_ids]
+    ser = Py_P_Pump_sim.SimulatedSerial(Py_P_Pump_sim.SimulatedBus(sim_pumps, latency=0.0002, baudrate=0))
+    if len(pump_ids) == 1:
+        return sim_pumps, [Py_P_Pump.AsyncP_pump(pump_id=pump_ids[0], verbose=False, timeout=0.2, ser=ser)]
+    bus = Py_P_Pump.PumpBus('simulated', ser=ser, timeout=0.2)
+    return sim_pumps, [Py_P_Pump.AsyncP_pump(pump_id=i, verbose=False, bus=bus) for i in pump_ids]
+
+
+def test_reads():
+    sim_pumps, (pump,) = async_pumps([1])
+
+    async def main():
+        return await pump.get_pressure(), await pump.get_mode()
+
+    assert run(main()) == ([1013.0, 2000, 0], 0)
+    pump.close()
+
+def test_hold_does_not_block_the_loop():
+    sim_pumps, (pump,) = async_pumps([1])
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def main():
+        task = asyncio.ensure_future(ticker())
+        await pump.set_pressure(150, hold='00:00:00:01')
+        task.cancel()
+
+    run(main())
+    assert len(ticks) >= 15
+    assert sim_pumps[0].mode == 0
+    assert sim_pumps[0].target == 150
+    pump.close()
+
+def test_gather_on_a_bus():
+    sim_pumps, pumps = async_pumps([1, 2])
+
+    async def main():
+        await asyncio.gather(*[p.set_pressure(100 + p.pump_id, hold='00:00:00:01') for p in pumps])
+
+    start = time.monotonic()
+    run(main())
+    #Both holds run at the same time
+    assert time.monotonic() - start < 1.5
+    assert [p.target for p in sim_pumps] == [101, 102]
+    assert [p.mode for p in sim_pumps] == [0, 0]
+    pumps[0].bus.close()
+
+def test_cancelled_hold_sets_idle():
+    sim_pumps, (pump,) = async_pumps([1])
+
+    async def main():
+        task = asyncio.ensure_future(pump.set_pressure(150, hold='00:00:01:00'))
+        await asyncio.sleep(0.2)
+        assert sim_pumps[0].mode == 1
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    run(main())
+    assert sim_pumps[0].mode == 0
+    pump.close()
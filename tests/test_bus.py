@@ -0,0 +1,57 @@
+import threading
+import pytest
+
+import Py_P_Pump
+import Py_P_Pump_sim
+from Py_P_Pump_bench import simulated_pumps
+from Py_P_Pump_codec import read_request, frame_value
+
+
+@pytest.fixture
+def bus_pumps():
+    pumps, bus = simulated_pumps([1, 2, 3], latency=0.0002, baudrate=0, timeout=0.2)
+    yield pumps, bus
+    bus.close()
+
+
+def test_messages_reach_their_pump(bus_pumps):
+    pumps, bus = bus_pumps
+    pumps[1].set_pressure_control()
+    pumps[1].set_target(120)
+    assert [p.get_target() for p in pumps] == [0, 120, 0]
+    assert bus.misrouted == 0
+
+def test_pumps_share_the_bus_from_threads(bus_pumps):
+    pumps, bus = bus_pumps
+    results = {}
+
+    def read(pump):
+        results[pump.pump_id] = [pump.get_pressure()[1] for _ in range(20)]
+
+    threads = [threading.Thread(target=read, args=(p,)) for p in pumps]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {i: [2000] * 20 for i in (1, 2, 3)}
+
+def test_round_robin(bus_pumps):
+    pumps, bus = bus_pumps
+    bus.ser.bus.latency = 0.005
+    done = []
+    requests = [bus.submit(1, read_request(1, 65)) for _ in range(10)]
+    requests.append(bus.submit(2, read_request(2, 65)))
+    for request in requests:
+        request.future.add_done_callback(lambda f, r=request: done.append(r.pump_id))
+    assert [frame_value(r.future.result()) for r in requests] == [2000] * 11
+    #Pump 2 does not wait for the whole queue of pump 1
+    assert done.index(2) <= 2
+
+def test_bus_and_reconnect_are_exclusive():
+    bus = Py_P_Pump.PumpBus('simulated', ser=Py_P_Pump_sim.SimulatedSerial(
+        Py_P_Pump_sim.SimulatedBus([Py_P_Pump_sim.SimulatedPump(1)], baudrate=0)))
+    with pytest.raises(ValueError):
+        Py_P_Pump.P_pump(pump_id=1, verbose=False, bus=bus, reconnect=True)
+    with pytest.raises(ValueError):
+        Py_P_Pump.P_pump(pump_id=1, verbose=False, bus=bus, identifier='FT232R')
+    bus.close()
@@ -0,0 +1,45 @@
+import time
+import pytest
+
+import Py_P_Pump
+
+
+def test_cache_serves_reads(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(cache=True)
+    pump.set_target(100)
+    before = bus.received
+    assert pump.get_target() == 100
+    assert pump.get_control_type() == pump.get_control_type()
+    assert bus.received - before == 1
+    assert pump.get_target(fresh=True) == 100
+    assert bus.received - before == 2
+
+def test_cache_invalidated_by_mode_change(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(cache=True)
+    pump.set_target(100)
+    #Changed on the pump, not by this driver
+    sim_pump.target = 50
+    assert pump.get_target() == 100
+    pump.set_idle()
+    assert pump.get_target() == 50
+
+def test_cache_invalidated_by_communication_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(cache=True)
+    pump.set_target(100)
+    sim_pump.target = 50
+    bus.inject_fault('timeout')
+    with pytest.raises(Py_P_Pump.PumpCommunicationError):
+        pump.read_registers([66])
+    assert pump.get_target() == 50
+
+def test_cache_max_age(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(cache={79: 0.05})
+    pump.set_target(100)
+    sim_pump.target = 50
+    assert pump.get_target() == 100
+    time.sleep(0.06)
+    assert pump.get_target() == 50
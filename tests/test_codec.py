@@ -0,0 +1,65 @@
+import os
+import sys
+import subprocess
+import pytest
+
+from Py_P_Pump_codec import (FRAME_LENGTH, WRITE, READ, encode, read_request, frame_value,
+                             frame_is_valid, extract_frame, decode_frames, xor_checksum)
+
+
+def test_encode_checksum():
+    for value in (0, 1, 100, -1, 2**31 - 1, -2**31):
+        frame = encode(3, WRITE, 79, value)
+        assert len(frame) == FRAME_LENGTH
+        assert xor_checksum(frame) == 0
+        assert frame_is_valid(frame)
+
+def test_encode_layout():
+    frame = encode(3, WRITE, 79, 0x01020304)
+    assert frame == bytes([0x02, 3, 1, 0, 79, 0, 0, 1, 2, 3, 4, frame[-1]])
+    assert frame_value(frame) == 0x01020304
+    assert frame_value(encode(1, WRITE, 79, -1)) == 2**32 - 1
+
+def test_read_requests_are_reused():
+    frame = read_request(2, 66)
+    assert frame == encode(2, READ, 66)
+    assert read_request(2, 66) is frame
+
+def test_frame_is_valid_at_offset():
+    data = bytearray(b'\x00' * 5) + encode(1, READ, 64)
+    assert frame_is_valid(data, 5)
+    data[-2] ^= 0x10
+    assert not frame_is_valid(data, 5)
+
+def test_extract_frame_resyncs_on_garbage():
+    frame = read_request(1, 66)
+    buffer = bytearray(b'\x00\x02\xff') + frame + frame[:5]
+    extracted, errors = extract_frame(buffer)
+    assert extracted == frame
+    assert errors == 1
+    assert buffer == bytearray(frame[:5])
+    assert extract_frame(buffer) == (None, 0)
+
+def test_extract_frame_without_start_byte():
+    buffer = bytearray(b'\x00' * 20)
+    assert extract_frame(buffer) == (None, 0)
+    assert buffer == bytearray()
+
+def test_decode_frames_matches_frame_value():
+    frames = [encode(1, 2, 66, v) for v in (0, 5, 1000, -1)]
+    data = b''.join(frames)
+    bad = bytearray(frames[0])
+    bad[-1] ^= 1
+    decoded = decode_frames(data + bytes(bad))
+    assert list(decoded['value'][:4]) == [frame_value(f) for f in frames]
+    assert list(decoded['location']) == [66] * 5
+    assert list(decoded['valid']) == [True, True, True, True, False]
+    with pytest.raises(ValueError):
+        decode_frames(data[:-1])
+
+def test_import_is_lazy():
+    code = ('import sys, Py_P_Pump; '
+            'print(sorted(m for m in ("serial", "numpy", "asyncio") if m in sys.modules))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.decode().strip() == '[]'
@@ -0,0 +1,61 @@
+import pytest
+
+from Py_P_Pump_control import (FlowController, constant_profile, ramp_profile, pulse_profile,
+                               sine_profile)
+
+
+def test_profiles():
+    assert constant_profile(2, unit='nl/s')(5) == 2000
+    ramp = ramp_profile(0, 10, 2)
+    assert [ramp(t) for t in (-1, 0, 1, 2, 3)] == [0, 0, 5, 10, 10]
+    pulse = pulse_profile(1, 3, 2, duty=0.25)
+    assert [pulse(t) for t in (0, 0.4, 0.6, 2.1)] == [3, 3, 1, 3]
+    sine = sine_profile(10, 5, 4)
+    assert [round(sine(t), 9) for t in (0, 1, 3)] == [10, 15, 5]
+
+def test_step_without_start(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    controller = FlowController(pump, constant_profile(10000), resistance=0.01)
+    setpoint, flow, pressure, target = controller.step(0, 0.02)
+    #Limited by the supply pressure read in the first step
+    assert controller.max_pressure == 2000
+    assert (setpoint, flow) == (10000, 0)
+    assert target == 100 + 0.005 * 10000 + 0.02 * 10000 * 0.02
+    assert sim_pump.target == 154
+
+def test_target_limited(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    controller = FlowController(pump, constant_profile(10**6), resistance=0.01, max_pressure=500)
+    assert controller.step(0, 0.02)[3] == 500
+    assert controller._integral == 0
+
+def test_deadband(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    controller = FlowController(pump, constant_profile(10000), resistance=0.01, kp=0, ki=0,
+                                deadband=5)
+    controller.step(0, 0.02)
+    controller.step(0.02, 0.02)
+    assert controller.writes == 1
+
+def test_run(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    controller = FlowController(pump, constant_profile(10000), resistance=0.01, period=0.01)
+    report = controller.run(0.3)
+    assert report['cycles'] >= 10
+    assert report['errors'] == 0
+    assert report['flow_rms_error'] < 10000
+    assert sim_pump.mode == 0
+
+def test_start_twice(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    controller = FlowController(pump, constant_profile(10000), resistance=0.01)
+    controller.start()
+    with pytest.raises(Exception):
+        controller.start()
+    controller.stop()
+    assert sim_pump.mode == 0
@@ -0,0 +1,66 @@
+import pytest
+
+import Py_P_Pump
+import Py_P_Pump_sim
+from Py_P_Pump import PumpFleet, PumpStatus
+
+
+@pytest.fixture
+def ports():
+    ptys = [Py_P_Pump_sim.SimulatedPty(Py_P_Pump_sim.SimulatedBus(
+                [Py_P_Pump_sim.SimulatedPump(i, tau=0) for i in ids], baudrate=0))
+            for ids in ([1, 3], [2])]
+    yield ptys
+    for pty in ptys:
+        pty.close()
+
+@pytest.fixture
+def fleet(ports):
+    fleet = PumpFleet.discover(ports=[p.port for p in ports], pump_ids=range(1, 5),
+                               probe_timeout=0.05, timeout=0.2)
+    yield fleet
+    fleet.close()
+
+
+def test_discover(ports, fleet):
+    a, b = [p.port for p in ports]
+    assert sorted(fleet.pumps) == sorted(['{}_1'.format(a), '{}_3'.format(a), '{}_2'.format(b)])
+    assert sorted(fleet.buses) == sorted([a, b])
+    assert fleet['{}_3'.format(a)].pump_id == 3
+
+def test_discover_needs_identifier_or_ports():
+    with pytest.raises(ValueError):
+        PumpFleet.discover()
+
+def test_discover_skips_ports_without_pumps(ports):
+    fleet = PumpFleet.discover(ports=[ports[1].port], pump_ids=[5, 6], probe_timeout=0.05)
+    assert len(fleet) == 0
+    assert fleet.buses == {}
+
+def test_broadcast(ports, fleet):
+    for pump in fleet:
+        pump.set_pressure_control()
+        pump.set_target(100 + pump.pump_id)
+    fleet.start_flow_all()
+    sim_pumps = [p for pty in ports for p in pty.bus.pumps.values()]
+    assert [p.mode for p in sim_pumps] == [1, 1, 1]
+    status = fleet.snapshot_all()
+    assert all(isinstance(s, PumpStatus) for s in status.values())
+    assert sorted(s.target for s in status.values()) == [101, 102, 103]
+    fleet.set_idle_all()
+    assert [p.mode for p in sim_pumps] == [0, 0, 0]
+
+def test_map_reports_failures(fleet):
+    def fail(pump):
+        if pump.pump_id == 2:
+            raise Py_P_Pump.PumpCommunicationError('unplugged')
+        return pump.pump_id
+
+    results = fleet.map(fail)
+    assert sorted(r for r in results.values() if not isinstance(r, Exception)) == [1, 3]
+    with pytest.raises(Py_P_Pump.PumpCommunicationError):
+        fleet._check(results, 'fail')
+
+def test_names_are_unique(fleet):
+    with pytest.raises(ValueError):
+        fleet.add(next(iter(fleet)))
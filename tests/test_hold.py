@@ -0,0 +1,61 @@
+import time
+import pytest
+
+from Py_P_Pump import TargetError
+
+
+def start_pressure(pump, target=100):
+    pump.set_pressure_control()
+    pump.set_target(target)
+    pump.start_flow()
+
+def test_hold_ends_in_idle(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump)
+    start = time.monotonic()
+    handle = pump.hold(0.2, poll_interval=0.05)
+    assert handle.wait(2)
+    assert 0.15 <= time.monotonic() - start < 1
+    assert handle.end_ns != None
+    assert sim_pump.mode == 0
+
+def test_hold_cancel(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump)
+    handle = pump.hold(10, poll_interval=0.05)
+    assert handle.remaining() > 9
+    assert handle.cancel()
+    assert handle.cancelled
+    assert handle.done()
+    assert sim_pump.mode == 0
+    assert not handle.cancel()
+
+def test_hold_cancel_without_idle(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump)
+    handle = pump.hold(10, poll_interval=0.05)
+    handle.cancel(idle=False)
+    assert sim_pump.mode == 1
+
+def test_new_hold_replaces_running_hold(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump)
+    first = pump.hold(10, poll_interval=0.05)
+    second = pump.hold(10, poll_interval=0.05)
+    assert first.cancelled and first.done()
+    assert sim_pump.mode == 1
+    second.cancel()
+
+def test_hold_raises_pump_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump)
+    handle = pump.set_pressure(100, hold=5, wait=False, poll_interval=0.02)
+    sim_pump.fail(6)
+    with pytest.raises(TargetError):
+        handle.wait(2)
+    assert sim_pump.mode == 0
@@ -0,0 +1,65 @@
+from Py_P_Pump import Metrics
+
+
+def test_counters_and_histograms():
+    metrics = Metrics()
+    metrics.count('frames_total', 2, (('pump', 'a'),))
+    metrics.count('frames_total', 1, (('pump', 'a'),))
+    metrics.observe('seconds', 0.002, buckets=(0.001, 0.01))
+    metrics.observe('seconds', 5, buckets=(0.001, 0.01))
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {('frames_total', (('pump', 'a'),)): 3}
+    histogram = snapshot['histograms'][('seconds', ())]
+    assert histogram['buckets'] == {0.001: 0, 0.01: 1, float('inf'): 1}
+    assert (histogram['count'], histogram['sum']) == (2, 5.002)
+    metrics.reset()
+    assert metrics.snapshot() == {'counters': {}, 'histograms': {}}
+
+def test_callback():
+    calls = []
+    metrics = Metrics(callback=lambda *args: calls.append(args))
+    metrics.count('frames_total')
+    metrics.observe('seconds', 0.5)
+    assert calls == [('counter', 'frames_total', 1, ()), ('histogram', 'seconds', 0.5, ())]
+
+def test_prometheus_text():
+    metrics = Metrics()
+    metrics.count('pump_frames_sent_total', 4, (('pump', 'p1'),))
+    metrics.observe('pump_set_seconds', 0.002, (('pump', 'p1'),), buckets=(0.001, 0.01))
+    assert metrics.to_prometheus().splitlines() == [
+        '# TYPE pump_frames_sent_total counter',
+        'pump_frames_sent_total{pump="p1"} 4',
+        '# TYPE pump_set_seconds histogram',
+        'pump_set_seconds_bucket{pump="p1",le="0.001"} 0',
+        'pump_set_seconds_bucket{pump="p1",le="0.01"} 1',
+        'pump_set_seconds_bucket{pump="p1",le="+Inf"} 1',
+        'pump_set_seconds_sum{pump="p1"} 0.002',
+        'pump_set_seconds_count{pump="p1"} 1']
+
+def test_write_prometheus(tmp_path):
+    metrics = Metrics()
+    metrics.count('pump_timeouts_total')
+    path = tmp_path / 'pump.prom'
+    metrics.write_prometheus(str(path))
+    assert path.read_text() == metrics.to_prometheus()
+    assert [p.name for p in tmp_path.iterdir()] == ['pump.prom']
+
+def test_pump_measurements(sim):
+    sim_pump, bus, connect = sim
+    metrics = Metrics()
+    pump = connect(metrics=metrics)
+    pump.get_pressure()
+    pump.set_target(100)
+    bus.inject_fault('checksum')
+    try:
+        pump.get_pressure()
+    except Exception:
+        pass
+    snapshot = metrics.snapshot()
+    counters = {name: value for (name, labels), value in snapshot['counters'].items()}
+    assert counters['pump_frames_sent_total'] == 3 + 2 + 3
+    assert counters['pump_checksum_errors_total'] >= 1
+    assert counters['pump_timeouts_total'] == 1
+    histograms = snapshot['histograms']
+    assert histograms[('pump_round_trip_seconds', (('pump', 'sim'), ('registers', '64,65,66')))]['count'] == 1
+    assert histograms[('pump_set_seconds', (('pump', 'sim'), ('register', '79')))]['count'] == 1
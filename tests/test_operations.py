@@ -0,0 +1,55 @@
+import pytest
+
+from Py_P_Pump import TareError, LeakTestError
+import Py_P_Pump_sim
+
+
+
+#_TARE_AND_LEAK_TEST__________________________________________________________
+def test_tare(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    duration = pump.tare(expected=0.2, timeout=2).wait()
+    assert 0.15 < duration < 2
+    assert sim_pump.mode == 0
+
+def test_tare_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    sim_pump.supply_connected = True
+    with pytest.raises(TareError) as error:
+        pump.tare(expected=0.2, timeout=2).wait()
+    assert error.value.code == 3
+
+def test_leak_test_needs_request(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    before = bus.received
+    with pytest.raises(ValueError):
+        pump.leak_test()
+    assert bus.received == before
+
+def test_leak_test_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    pump.set_target(5000)
+    with pytest.raises(LeakTestError) as error:
+        pump.leak_test(request=Py_P_Pump_sim.REQUEST_LEAK_TEST, expected=0.2, timeout=2).wait()
+    assert error.value.code == 7
+
+def test_leak_test(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    handle = pump.leak_test(pressure=100, request=Py_P_Pump_sim.REQUEST_LEAK_TEST, expected=0.2,
+                            timeout=2)
+    assert 0.15 < handle.wait() < 2
+    assert sim_pump.target == 100
+    assert sim_pump.mode == 0
+
+def test_tare_timeout(sim):
+    sim_pump, bus, connect = sim
+    sim_pump.tare_time = 10
+    pump = connect()
+    with pytest.raises(Exception):
+        pump.tare(expected=0.05, timeout=0.2).wait()
+    assert sim_pump.mode == 0
@@ -0,0 +1,39 @@
+import Py_P_Pump
+
+
+def count_writes(ser):
+    writes = []
+    write = ser.write
+
+    def counted(data):
+        writes.append(len(data))
+        return write(data)
+
+    ser.write = counted
+    return writes
+
+
+def test_read_registers_status(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    status = pump.read_registers([64, 65, 66, 81, 82])
+    assert isinstance(status, Py_P_Pump.PumpStatus)
+    assert status[65] == 2000
+    assert status.pressure == [1013.0, 2000, 0]
+    assert (status.mode, status.error_code) == (0, 0)
+
+def test_get_pressure_is_one_exchange(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    writes = count_writes(pump.transport.ser)
+    assert pump.get_pressure() == [1013.0, 2000, 0]
+    assert len(pump.get_temp()) == 3
+    #All requests of a read are written back-to-back in a single write
+    assert writes == [36, 36]
+
+def test_status_does_not_raise_on_pump_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    sim_pump.fail(6)
+    status = pump.get_status()
+    assert (status.mode, status.error_code) == (3, 6)
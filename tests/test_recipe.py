@@ -0,0 +1,77 @@
+import pytest
+
+from Py_P_Pump import RecipeStep, load_recipe, compile_recipe, FLOW_CONVERSION
+
+
+def compile_steps(steps, **state):
+    return compile_recipe(load_recipe(steps), **state)
+
+
+def test_first_step_from_unknown_state():
+    assert compile_steps([{'mode': 'pressure', 'target': 100, 'duration': 1}]) == [
+        [('control', 0), ('target', 100), ('start',)]]
+
+def test_only_changes_are_send():
+    commands = compile_steps([
+        {'mode': 'pressure', 'target': 100, 'duration': 1},
+        {'mode': 'pressure', 'target': 200, 'duration': 1},
+        {'mode': 'pressure', 'target': 200, 'duration': 1}])
+    assert commands[1] == [('target', 200)]
+    assert commands[2] == []
+
+def test_known_state_is_used():
+    commands = compile_steps([{'mode': 'pressure', 'target': 100, 'duration': 1}],
+                             control_type=0, target=100, mode=1)
+    assert commands == [[]]
+
+def test_control_type_change_goes_through_idle():
+    commands = compile_steps([
+        {'mode': 'pressure', 'target': 100, 'duration': 1},
+        {'mode': 'flow', 'target': 2, 'unit': 'ul/s', 'duration': 1}])
+    assert commands[1] == [('idle',), ('control', 1), ('target', int(2 * FLOW_CONVERSION['ul/s'])), ('start',)]
+
+def test_ramp_starts_at_previous_target():
+    commands = compile_steps([
+        {'mode': 'pressure', 'target': 100, 'duration': 1},
+        {'mode': 'pressure', 'target': 300, 'duration': 2, 'ramp': 1}])
+    #The ramp itself writes the targets
+    assert commands[1] == []
+
+def test_ramp_from_idle_starts_at_target():
+    commands = compile_steps([{'mode': 'pressure', 'target': 300, 'duration': 2, 'ramp': 1}])
+    assert commands == [[('control', 0), ('target', 300), ('start',)]]
+
+def test_idle_steps():
+    commands = compile_steps([
+        {'mode': 'idle', 'duration': 1},
+        {'mode': 'pressure', 'target': 100, 'duration': 1},
+        {'mode': 'idle', 'duration': 1},
+        {'mode': 'pressure', 'target': 100, 'duration': 1}])
+    assert commands == [[], [('control', 0), ('target', 100), ('start',)], [('idle',)], [('start',)]]
+
+def test_step_validation():
+    with pytest.raises(ValueError):
+        RecipeStep('vacuum')
+    with pytest.raises(ValueError):
+        RecipeStep('flow', 1, unit='l/h')
+    assert RecipeStep('pressure', 100, duration='00:00:01:05').duration == 65
+
+def test_run_recipe(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    reports = pump.run_recipe([
+        {'mode': 'pressure', 'target': 100, 'duration': 0.1},
+        {'mode': 'pressure', 'target': 300, 'duration': 0.3, 'ramp': 0.2},
+        {'mode': 'idle', 'duration': 0.05}], poll_interval=0.05, ramp_interval=0.05)
+    #The simulated pump starts in pressure control
+    assert [r.commands for r in reports] == [[('target', 100), ('start',)], [], [('idle',)]]
+    assert reports[1].ramp_writes == 4
+    assert sim_pump.target == 300
+    assert sim_pump.mode == 0
+
+def test_only_last_step_can_be_open_ended(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    with pytest.raises(ValueError):
+        pump.run_recipe([{'mode': 'pressure', 'target': 100}, {'mode': 'idle', 'duration': 1}])
+    assert sim_pump.mode == 0
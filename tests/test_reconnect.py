@@ -0,0 +1,142 @@
+import time
+import warnings
+import pytest
+
+import Py_P_Pump
+import Py_P_Pump_sim
+from Py_P_Pump import PumpCommunicationError
+
+
+@pytest.fixture
+def reconnecting(sim, monkeypatch):
+    """
+    Pump with a ReconnectingTransport. Reopening the port connects a new
+    SimulatedSerial to the same simulated bus, `opens` counts the attempts.
+
+    """
+    sim_pump, bus, connect = sim
+    opens = []
+
+    def open_serial(address, timeout=2):
+        opens.append(address)
+        return Py_P_Pump_sim.SimulatedSerial(bus, timeout=timeout)
+
+    monkeypatch.setattr(Py_P_Pump, 'open_serial', open_serial)
+    events = []
+    pump = connect(address='simulated', reconnect=True, on_reconnect=events.append)
+    pump.transport.settle = 0
+    return sim_pump, bus, pump, opens, events
+
+def unplug(pump):
+    pump.transport.ser.close()
+
+
+def test_read_is_replayed(reconnecting):
+    sim_pump, bus, pump, opens, events = reconnecting
+    unplug(pump)
+    assert pump.get_pressure() == [1013.0, 2000, 0]
+    assert len(opens) == 1
+    assert events[0].replayed
+    assert pump.transport.reconnects == 1
+
+def test_state_is_restored(reconnecting):
+    sim_pump, bus, pump, opens, events = reconnecting
+    pump.set_pressure_control()
+    pump.set_target(150)
+    #The pump lost its settings, for instance after a power cycle
+    sim_pump.target = 0
+    unplug(pump)
+    assert pump.get_mode() == 0
+    assert sim_pump.target == 150
+    assert events[0].restored == {79: 150}
+
+def test_start_is_not_replayed(reconnecting):
+    sim_pump, bus, pump, opens, events = reconnecting
+    unplug(pump)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with pytest.raises(PumpCommunicationError):
+            pump.start_flow()
+    assert sim_pump.mode == 0
+    assert len(opens) == 1
+
+def test_failed_port_backs_off(reconnecting, monkeypatch):
+    sim_pump, bus, pump, opens, events = reconnecting
+    attempts = []
+
+    def open_serial(address, timeout=2):
+        attempts.append(time.monotonic())
+        raise OSError('No such device')
+
+    monkeypatch.setattr(Py_P_Pump, 'open_serial', open_serial)
+    pump.transport.reconnect_timeout = 0.05
+    unplug(pump)
+    errors = 0
+    end = time.monotonic() + 1.5
+    while time.monotonic() < end:
+        with pytest.raises(PumpCommunicationError):
+            pump.read_registers([66])
+        errors += 1
+    #The commands fail directly, the port is only tried again after a second
+    assert errors > 100
+    late = [t for t in attempts if t > end - 1.5 + 0.5]
+    assert 1 <= len(late) <= 4
+
+def test_error_after_reopening_is_wrapped(reconnecting, monkeypatch):
+    sim_pump, bus, pump, opens, events = reconnecting
+
+    class BrokenSerial(Py_P_Pump_sim.SimulatedSerial):
+        def reset_input_buffer(self):
+            raise OSError('Port vanished')
+
+    monkeypatch.setattr(Py_P_Pump, 'open_serial',
+                        lambda address, timeout=2: BrokenSerial(bus, timeout=timeout))
+    unplug(pump)
+    with pytest.raises(PumpCommunicationError):
+        pump.read_registers([66])
+
+def test_stalled_port_is_reopened(reconnecting):
+    sim_pump, bus, pump, opens, events = reconnecting
+    bus.inject_fault('timeout', count=pump.transport.stall_timeouts)
+    for _ in range(pump.transport.stall_timeouts - 1):
+        with pytest.raises(PumpCommunicationError):
+            pump.read_registers([66])
+    #The last timeout in a row reopens the port, the read is repeated
+    assert pump.read_registers([65])[65] == 2000
+    assert len(opens) == 1
+
+class Port():
+    def __init__(self, device):
+        self.device = device
+
+def fake_ports(monkeypatch, bus, devices):
+    opened = []
+
+    def open_serial(address, timeout=2):
+        opened.append(address)
+        return Py_P_Pump_sim.SimulatedSerial(bus, timeout=timeout)
+
+    class list_ports():
+        @staticmethod
+        def grep(identifier):
+            return iter([Port(d) for d in devices])
+
+    monkeypatch.setattr(Py_P_Pump, 'open_serial', open_serial)
+    monkeypatch.setattr(Py_P_Pump, 'list_ports', list_ports)
+    return opened
+
+def test_identifier_finds_the_port(sim, monkeypatch):
+    sim_pump, bus, connect = sim
+    opened = fake_ports(monkeypatch, bus, ['/dev/ttyUSB3'])
+    pump = Py_P_Pump.P_pump(name='sim', pump_id=1, verbose=False, timeout=0.1, identifier='FT232R')
+    assert pump.address == '/dev/ttyUSB3'
+    assert opened == ['/dev/ttyUSB3']
+    assert pump.get_pressure() == [1013.0, 2000, 0]
+
+@pytest.mark.parametrize('devices', [[], ['/dev/ttyUSB0', '/dev/ttyUSB1']])
+def test_identifier_must_match_one_port(sim, monkeypatch, devices):
+    sim_pump, bus, connect = sim
+    opened = fake_ports(monkeypatch, bus, devices)
+    with pytest.raises(PumpCommunicationError):
+        Py_P_Pump.P_pump(name='sim', pump_id=1, verbose=False, identifier='FT232R')
+    assert opened == []
@@ -0,0 +1,79 @@
+import os
+import time
+import pytest
+
+from Py_P_Pump_record import TelemetryRecorder, TelemetryFile, load_recording, part_path
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_read_while_recording(tmp_path):
+    path = str(tmp_path / 'run.ppr')
+    with TelemetryRecorder(path, registers=[65, 79], capacity=10) as recorder:
+        recording = TelemetryFile(path)
+        assert len(recording) == 0
+        for i in range(3):
+            recorder.append(100.0 + i, [2000, i])
+        assert len(recording) == 3
+        assert list(recording.times) == [100.0, 101.0, 102.0]
+        assert list(recording[79]) == [0, 1, 2]
+        times, values = recording.window(1)
+        assert list(times) == [101.0, 102.0]
+        assert values.tolist() == [[2000, 1], [2000, 2]]
+    with pytest.raises(ValueError):
+        recorder.append(103.0, [2000, 3])
+
+def test_negative_values_are_raw(tmp_path):
+    path = str(tmp_path / 'run.ppr')
+    with TelemetryRecorder(path, registers=[79], capacity=10) as recorder:
+        recorder.append(0.0, [-1])
+    assert list(TelemetryFile(path)[79]) == [2**32 - 1]
+
+def test_rollover(tmp_path):
+    path = str(tmp_path / 'run.ppr')
+    with TelemetryRecorder(path, registers=[66], capacity=4) as recorder:
+        for i in range(10):
+            recorder.append(float(i), [i])
+    assert recorder.paths == [path, part_path(path, 1), part_path(path, 2)]
+    assert part_path(path, 2) == str(tmp_path / 'run.2.ppr')
+    times, values = load_recording(path)
+    assert list(times) == [float(i) for i in range(10)]
+    assert list(values[66]) == list(range(10))
+    #A new recording with the same name removes the old parts
+    TelemetryRecorder(path, registers=[66], capacity=4).close()
+    assert not os.path.exists(part_path(path, 1))
+
+def test_without_rollover_samples_are_dropped(tmp_path):
+    path = str(tmp_path / 'run.ppr')
+    with TelemetryRecorder(path, registers=[66], capacity=4, rollover=False) as recorder:
+        for i in range(6):
+            recorder.append(float(i), [i])
+    assert recorder.dropped == 2
+    assert len(TelemetryFile(path)) == 4
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / 'other.ppr'
+    path.write_bytes(b'\x00' * 100)
+    with pytest.raises(ValueError):
+        TelemetryFile(str(path))
+    with pytest.raises(FileNotFoundError):
+        load_recording(str(tmp_path / 'missing.ppr'))
+
+def test_stream_recording(sim, tmp_path):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    path = str(tmp_path / 'run.ppr')
+    recorder = TelemetryRecorder(path, registers=[65, 81], capacity=1000)
+    buffer = pump.start_stream([65, 81], rate_hz=200, recorder=recorder)
+    assert wait_for(lambda: buffer.count >= 10)
+    pump.stop_stream()
+    recording = TelemetryFile(path)
+    assert len(recording) == buffer.count
+    assert set(recording[65]) == {2000}
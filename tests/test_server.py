@@ -0,0 +1,114 @@
+import time
+import threading
+import pytest
+
+import Py_P_Pump
+import Py_P_Pump_sim
+from Py_P_Pump import TareError, TargetError
+from Py_P_Pump_server import PumpServer, RemotePump
+
+
+@pytest.fixture
+def served(sim, tmp_path):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    path = str(tmp_path / 'ppump.sock')
+    server = PumpServer(path, {'p1': pump}).start()
+    clients = []
+
+    def client():
+        clients.append(RemotePump(path, 'p1', timeout=5))
+        return clients[-1]
+
+    yield sim_pump, bus, server, client
+    for c in clients:
+        c.close()
+    server.close()
+
+
+def test_calls(served):
+    sim_pump, bus, server, client = served
+    remote = client()
+    assert remote.pumps() == ['p1']
+    assert remote.get_pressure() == [1013.0, 2000, 0]
+    status = remote.get_status()
+    assert isinstance(status, Py_P_Pump.PumpStatus)
+    assert status.mode == 0
+    remote.set_pressure(120, wait=False)
+    assert (sim_pump.mode, sim_pump.target) == (1, 120)
+    remote.set_idle()
+    assert sim_pump.mode == 0
+    with pytest.raises(ValueError):
+        remote.call('close')
+
+def test_reads_are_coalesced(served):
+    sim_pump, bus, server, client = served
+    bus.latency = 0.02
+    remotes = [client() for _ in range(8)]
+    results = []
+
+    def read(remote):
+        results.extend(remote.get_pressure() for _ in range(3))
+
+    threads = [threading.Thread(target=read, args=(r,)) for r in remotes]
+    before = bus.received
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [[1013.0, 2000, 0]] * 24
+    stats = remotes[0].call('stats')
+    assert stats['clients'] == 8
+    assert stats['coalesced'] > 0
+    #Every shared read saves the three register requests of get_pressure()
+    assert bus.received - before == 3 * (24 - stats['coalesced'])
+
+def test_pump_error_round_trip(served):
+    sim_pump, bus, server, client = served
+    remote = client()
+    remote.set_pressure_control()
+    remote.set_target(10**6)
+    with pytest.raises(TargetError) as error:
+        remote.start_flow()
+    assert error.value.code == 6
+    assert str(error.value) == 'sim: Target too high'
+
+def test_error_message_is_preserved(served):
+    sim_pump, bus, server, client = served
+    sim_pump.tare_time = 10
+    remote = client()
+    with pytest.raises(TareError) as error:
+        remote.tare(expected=0.05, timeout=0.2)
+    assert error.value.code == None
+    assert 'Unknown error code' not in str(error.value)
+    assert str(error.value).startswith('sim: ')
+
+def test_subscription_rate(served):
+    sim_pump, bus, server, client = served
+    remote = client()
+    samples = []
+    subscription = remote.subscribe([65, 66], rate_hz=10, callback=lambda t, v: samples.append(v))
+    time.sleep(2.05)
+    remote.unsubscribe(subscription)
+    assert 19 <= len(samples) <= 22
+    assert samples[0] == [2000, 0]
+
+def test_refuses_to_replace_a_regular_file(sim, tmp_path):
+    sim_pump, bus, connect = sim
+    path = tmp_path / 'notes.txt'
+    path.write_text('keep')
+    with pytest.raises(FileExistsError):
+        PumpServer(str(path), {'p1': connect()})
+    assert path.read_text() == 'keep'
+
+def test_replaces_a_stale_socket(sim, tmp_path):
+    sim_pump, bus, connect = sim
+    path = str(tmp_path / 'ppump.sock')
+    PumpServer(path, {}).close()
+    stale = PumpServer(path, {})
+    stale._sock.close()
+    server = PumpServer(path, {'p1': connect()}).start()
+    remote = RemotePump(path, 'p1')
+    assert remote.get_pressure()[1] == 2000
+    remote.close()
+    server.close()
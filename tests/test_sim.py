@@ -0,0 +1,92 @@
+import time
+import pytest
+
+import Py_P_Pump_sim
+from Py_P_Pump import FrameTransport, PumpTimeoutError
+from Py_P_Pump_codec import read_request, frame_value
+
+
+def transport(bus, timeout=0.1):
+    return FrameTransport(Py_P_Pump_sim.SimulatedSerial(bus), timeout=timeout)
+
+def read_supply(t):
+    return frame_value(t.exchange(read_request(1, 65)))
+
+@pytest.fixture
+def bus():
+    return Py_P_Pump_sim.SimulatedBus([Py_P_Pump_sim.SimulatedPump(1, tau=0)], baudrate=0, seed=1)
+
+
+#_FAULT_INJECTION_____________________________________________________________
+def test_checksum_fault_is_discarded(bus):
+    t = transport(bus)
+    bus.inject_fault('checksum')
+    with pytest.raises(PumpTimeoutError):
+        read_supply(t)
+    assert t.checksum_errors >= 1
+    assert read_supply(t) == 2000
+
+@pytest.mark.parametrize('fault', ['drop', 'timeout'])
+def test_incomplete_response_times_out_and_recovers(bus, fault):
+    t = transport(bus)
+    bus.inject_fault(fault)
+    with pytest.raises(PumpTimeoutError):
+        read_supply(t)
+    assert read_supply(t) == 2000
+
+def test_garbage_before_response_is_skipped(bus):
+    t = transport(bus)
+    bus.inject_fault('garbage', count=20)
+    assert [read_supply(t) for _ in range(20)] == [2000] * 20
+
+def test_fault_rate(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    bus.inject_fault('garbage', rate=0.3)
+    for _ in range(20):
+        assert pump.get_pressure() == [1013.0, 2000, 0]
+    bus.inject_fault('garbage', rate=0)
+
+def test_unknown_fault(bus):
+    with pytest.raises(ValueError):
+        bus.inject_fault('lightning')
+
+
+#_SIMULATED_PUMP______________________________________________________________
+def test_unknown_pump_id_does_not_answer(bus):
+    t = transport(bus)
+    with pytest.raises(PumpTimeoutError):
+        t.exchange(read_request(7, 65))
+
+def test_pressure_control():
+    pump = Py_P_Pump_sim.SimulatedPump(1, tau=0)
+    assert pump.write(77, 0) and pump.write(79, 150) and pump.write(78, 1)
+    assert pump.read(81) == 1
+    assert pump.read(66) == 150
+    assert pump.write(78, 0)
+    assert pump.read(66) == 0
+
+def test_errors():
+    pump = Py_P_Pump_sim.SimulatedPump(1, tau=0)
+    pump.write(79, 10**6)
+    pump.write(78, 1)
+    assert (pump.read(81), pump.read(82)) == (3, 6)
+    #Flow control without a flow sensor
+    pump.write(78, 0)
+    pump.write(77, 1)
+    pump.write(78, 1)
+    assert (pump.read(81), pump.read(82)) == (3, 9)
+
+def test_tare_ends_by_itself():
+    pump = Py_P_Pump_sim.SimulatedPump(1, tare_time=0.05)
+    pump.write(78, Py_P_Pump_sim.REQUEST_TARE)
+    assert pump.read(81) == 2
+    time.sleep(0.06)
+    assert pump.read(81) == 0
+
+def test_latency(bus):
+    bus.latency = 0.02
+    t = transport(bus)
+    start = time.monotonic()
+    read_supply(t)
+    assert time.monotonic() - start >= 0.02
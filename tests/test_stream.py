@@ -0,0 +1,80 @@
+import time
+import pytest
+import serial
+
+from Py_P_Pump import TelemetryBuffer
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_stream_fills_buffer(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    buffer = pump.start_stream([65, 81], rate_hz=100)
+    assert wait_for(lambda: buffer.count >= 5)
+    timestamp, values = pump.latest()
+    assert list(values) == [2000, 0]
+    with pytest.raises(Exception):
+        pump.start_stream([65])
+    pump.stop_stream()
+    count = buffer.count
+    time.sleep(0.05)
+    assert buffer.count == count
+
+def test_stream_backs_off_on_port_errors(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    ser = pump.transport.ser
+    buffer = pump.start_stream([66], rate_hz=20)
+    assert wait_for(lambda: buffer.count >= 2)
+
+    def unplugged(size=1):
+        raise serial.SerialException('device reports readiness to read but returned no data')
+
+    read = ser.read
+    ser.read = unplugged
+    time.sleep(1)
+    #Waits at least one period, doubling up to a second
+    assert 1 <= pump.stream_errors <= 6
+    assert pump._stream_thread != None
+    ser.read = read
+    count = buffer.count
+    assert wait_for(lambda: buffer.count > count + 2)
+
+def test_stream_can_restart_after_unexpected_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    ser = pump.transport.ser
+    pump.start_stream([66], rate_hz=100)
+
+    def broken(size=1):
+        raise ValueError('unexpected')
+
+    read = ser.read
+    ser.read = broken
+    assert wait_for(lambda: pump._stream_thread == None)
+    ser.read = read
+    buffer = pump.start_stream([66], rate_hz=100)
+    assert wait_for(lambda: buffer.count >= 2)
+
+
+def test_buffer_wraps():
+    buffer = TelemetryBuffer([65], capacity=4)
+    assert buffer.latest() == None
+    for i in range(6):
+        buffer.append(float(i), [i])
+    timestamp, values = buffer.latest()
+    assert (timestamp, list(values)) == (5.0, [5])
+    times, values = buffer.last(10)
+    #The slot after the newest sample is never returned
+    assert list(times) == [3.0, 4.0, 5.0]
+    assert list(values[:, 0]) == [3, 4, 5]
+    times, values = buffer.window(1)
+    assert list(times) == [4.0, 5.0]
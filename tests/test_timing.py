@@ -0,0 +1,73 @@
+import time
+import statistics
+
+from Py_P_Pump import TimingEngine
+
+
+def test_observe_write():
+    timing = TimingEngine(smoothing=0.5)
+    assert timing.observe_write(79, 1000, 3000) == 2000
+    assert timing.latency_ns[79] == 1000
+    timing.observe_write(79, 10000, 16000)
+    #Running average of 1000 and 3000
+    assert timing.latency_ns[79] == 2000
+    assert timing.effective_ns[79] == 13000
+
+def test_lead_ns():
+    timing = TimingEngine()
+    assert timing.lead_ns(78) == 0
+    timing.observe_write(78, 0, 4000)
+    timing.observe_command('target', 10000)
+    assert timing.lead_ns(78) == 2000
+    assert timing.lead_ns(78, ['target', 'control']) == 12000
+
+def test_effective_since():
+    timing = TimingEngine()
+    timing.observe_write(79, 1000, 3000)
+    assert timing.effective_since(79, 1500) == 2000
+    #Older than the command: the write was confirmed by reading it back
+    now = time.monotonic_ns()
+    assert timing.effective_since(79, 2500) >= now
+    assert timing.effective_since(78, 0) >= now
+
+def test_wait_until_is_precise():
+    timing = TimingEngine()
+    errors = []
+    for _ in range(5):
+        deadline = time.monotonic_ns() + 20000000
+        timing.wait_until(deadline)
+        errors.append(time.monotonic_ns() - deadline)
+    assert min(errors) >= 0
+    #Single wakeups can be late on a busy machine
+    assert statistics.median(errors) < 1000000
+
+def test_wait_until_checks():
+    timing = TimingEngine()
+    checks = []
+    timing.wait_until(time.monotonic_ns() + 100000000, lambda: checks.append(1), 0.02)
+    assert 3 <= len(checks) <= 5
+
+def test_recipe_steps_do_not_drift(sim):
+    sim_pump, bus, connect = sim
+    bus.latency = 0.002
+    pump = connect()
+    reports = pump.run_recipe([{'mode': 'pressure', 'target': 100 + 10 * i, 'duration': 0.05}
+                               for i in range(8)], poll_interval=None)
+    start = reports[0].start_ns
+    assert [r.planned_start_ns - start for r in reports] == [i * 50000000 for i in range(8)]
+    #The target is send early by the measured latency
+    assert statistics.median(abs(r.start_ns - r.planned_start_ns) for r in reports) < 3000000
+    #A write and its readback take about 4 ms, added up over the steps 32 ms
+    assert abs(reports[-1].end_ns - (start + 8 * 50000000)) < 15000000
+
+def test_hold_ends_on_time(sim):
+    sim_pump, bus, connect = sim
+    bus.latency = 0.002
+    pump = connect()
+    pump.set_pressure_control()
+    pump.set_target(100)
+    pump.start_flow()
+    handle = pump.hold(0.2, poll_interval=0.05)
+    assert handle.wait(2)
+    assert abs(handle.end_ns - handle.deadline_ns) < 10000000
+    assert sim_pump.mode == 0
@@ -0,0 +1,66 @@
+import time
+import pytest
+
+import Py_P_Pump_sim
+from Py_P_Pump import FrameTransport, PumpTimeoutError
+from Py_P_Pump_codec import read_request, frame_value
+
+
+class SlowSerial():
+    """
+    Serial stand-in that delivers `data` in pieces, one piece every `delay`
+    seconds, and honours its read timeout like pyserial.
+
+    """
+    def __init__(self, pieces, delay):
+        self.pieces = list(pieces)
+        self.delay = delay
+        self.timeout = None
+        self.timeouts = []
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        self.timeouts.append(self.timeout)
+        if self.pieces and self.delay <= self.timeout:
+            time.sleep(self.delay)
+            return self.pieces.pop(0)
+        time.sleep(self.timeout)
+        return b''
+
+
+def test_exchange():
+    bus = Py_P_Pump_sim.SimulatedBus([Py_P_Pump_sim.SimulatedPump(1, tau=0)], baudrate=0, seed=1)
+    t = FrameTransport(Py_P_Pump_sim.SimulatedSerial(bus), timeout=0.1)
+    assert frame_value(t.exchange(read_request(1, 65))) == 2000
+
+def test_exchange_many_keeps_order():
+    bus = Py_P_Pump_sim.SimulatedBus([Py_P_Pump_sim.SimulatedPump(1, tau=0)], baudrate=0, seed=1)
+    t = FrameTransport(Py_P_Pump_sim.SimulatedSerial(bus), timeout=0.1)
+    responses = t.exchange_many([read_request(1, r) for r in (64, 65, 77, 88)])
+    assert [frame[4] for frame in responses] == [64, 65, 77, 88]
+    assert frame_value(responses[1]) == 2000
+
+def test_partial_message_does_not_extend_deadline():
+    frame = read_request(1, 65)
+    ser = SlowSerial([frame[:6]], delay=0.15)
+    t = FrameTransport(ser, timeout=0.2)
+    start = time.monotonic()
+    with pytest.raises(PumpTimeoutError):
+        t.read_frame()
+    assert time.monotonic() - start < 0.3
+    assert ser.timeouts[1] < 0.1
+
+def test_message_in_pieces():
+    frame = read_request(1, 65)
+    ser = SlowSerial([frame[:3], frame[3:8], frame[8:]], delay=0.01)
+    t = FrameTransport(ser, timeout=0.2)
+    assert t.read_frame() == frame
@@ -0,0 +1,76 @@
+import time
+import pytest
+
+import Py_P_Pump
+from Py_P_Pump import TargetError
+
+
+@pytest.mark.parametrize('verify, messages', [('ack', 1), ('on_failure', 1), ('readback', 2)])
+def test_verify_messages(sim, verify, messages):
+    sim_pump, bus, connect = sim
+    pump = connect(verify=verify)
+    before = bus.received
+    pump.set_target(100)
+    assert bus.received - before == messages
+    assert sim_pump.target == 100
+    assert pump.state[79] == 100
+
+def test_on_failure_reads_back_a_lost_ack(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(verify='on_failure')
+    bus.inject_fault('timeout')
+    before = bus.received
+    pump.set_target(100)
+    #Write, whose ack was lost, then the read back; no repeat
+    assert bus.received - before == 2
+    assert sim_pump.target == 100
+
+def test_unknown_verify_policy(sim):
+    sim_pump, bus, connect = sim
+    with pytest.raises(ValueError):
+        connect(verify='never')
+
+def test_retries_back_off(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(verify='ack', backoff=0.05, timeout=0.05)
+    bus.inject_fault('timeout', count=2)
+    before = bus.received
+    start = time.monotonic()
+    pump.set_target(100)
+    elapsed = time.monotonic() - start
+    assert bus.received - before == 3
+    #Two timeouts and waits of 0.05 and 0.1 seconds
+    assert elapsed >= 0.05 * 2 + 0.05 + 0.1
+    assert pump.state[79] == 100
+
+def test_failed_set_sets_idle_and_raises(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(verify='ack', retries=2, backoff=0.001, timeout=0.05)
+    pump.set_pressure_control()
+    pump.set_target(100)
+    pump.start_flow()
+    assert sim_pump.mode == 1
+    bus.inject_fault('timeout', count=3)
+    with pytest.raises(Exception, match='Stopped'):
+        pump.set_target(200)
+    assert sim_pump.mode == 0
+
+def test_failed_set_raises_pump_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect(retries=1, backoff=0.001)
+    pump.set_pressure_control()
+    pump.set_target(10**6)
+    #Out of range target: the pump goes to error mode instead of control
+    with pytest.raises(TargetError) as error:
+        pump.start_flow()
+    assert error.value.code == 6
+    assert sim_pump.mode == 0
+
+def test_get_mode_raises_typed_error(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    sim_pump.fail(1)
+    with pytest.raises(Py_P_Pump.SupplyPressureError):
+        pump.get_mode()
+    assert sim_pump.mode == 0
+
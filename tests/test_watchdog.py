@@ -0,0 +1,98 @@
+import time
+import pytest
+
+from Py_P_Pump import TargetError, SupplyPressureError
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def start_pressure(pump, target=100):
+    pump.set_pressure_control()
+    pump.set_target(target)
+    pump.start_flow()
+
+
+def test_watchdog_trips_and_idles(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump)
+    faults = []
+    watchdog = pump.start_watchdog(period=0.05, on_fault=lambda p, e: faults.append(e))
+    sim_pump.fail(6)
+    assert wait_for(lambda: len(faults) == 1)
+    assert isinstance(faults[0], TargetError)
+    assert sim_pump.mode == 0
+    with pytest.raises(TargetError):
+        pump.check_errors()
+    #The error is raised only once
+    pump.check_errors()
+
+def test_watchdog_hold_restarts(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    start_pressure(pump, 150)
+    watchdog = pump.start_watchdog(period=0.05, action='hold')
+    sim_pump.fail(5)
+    assert wait_for(lambda: watchdog.faults == 1 and sim_pump.mode == 1)
+    assert sim_pump.target == 150
+
+def test_watchdog_survives_failing_action(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+
+    def action(pump, error):
+        pump.set_idle()
+        raise RuntimeError('action failed')
+
+    watchdog = pump.start_watchdog(period=0.05, action=action)
+    sim_pump.fail(5)
+    assert wait_for(lambda: watchdog.faults == 1 and watchdog.exception != None)
+    sim_pump.fail(6)
+    assert wait_for(lambda: watchdog.faults == 2)
+    assert watchdog._thread.is_alive()
+
+def test_watchdog_survives_failing_on_fault(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+
+    def on_fault(pump, error):
+        raise RuntimeError('on_fault failed')
+
+    watchdog = pump.start_watchdog(period=0.05, on_fault=on_fault)
+    sim_pump.fail(5)
+    assert wait_for(lambda: watchdog.faults == 1)
+    sim_pump.fail(6)
+    assert wait_for(lambda: watchdog.faults == 2)
+
+def test_check_errors_without_running_watchdog(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    watchdog = pump.start_watchdog(period=0.05)
+    watchdog.stop()
+    sim_pump.fail(1)
+    #The watchdog thread ended, the pump is read directly
+    with pytest.raises(SupplyPressureError):
+        pump.check_errors()
+
+def test_watchdog_uses_stream(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    pump.start_stream([81, 82], rate_hz=100)
+    watchdog = pump.start_watchdog(period=0.05)
+    assert wait_for(lambda: watchdog.stream_checks > 2)
+    sim_pump.fail(6)
+    assert wait_for(lambda: watchdog.faults == 1)
+    with pytest.raises(TargetError):
+        pump.check_errors()
+
+def test_invalid_action(sim):
+    sim_pump, bus, connect = sim
+    pump = connect()
+    with pytest.raises(ValueError):
+        pump.start_watchdog(action='panic')